@@ -0,0 +1,42 @@
+import argparse
+import os
+import sys
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE))
+
+from utils import read_pickle, write_point_store, write_info_store
+
+
+def pack_points(data_root, prefix, split):
+    """Pack the infos of one split into <prefix>_infos_<split>/ and its point clouds into
+    <prefix>_points_<split>/, read by Waymo(packed=True).
+
+    Args:
+        data_root (str): Path of the kitti format data root with the info files.
+        prefix (str): Prefix of the info file, 'waymo' or 'painted_waymo'.
+        split (str): One of train, val, trainval, test.
+    """
+    data_infos = read_pickle(os.path.join(data_root, f'{prefix}_infos_{split}.pkl'))
+    write_info_store(data_infos, os.path.join(data_root, f'{prefix}_infos_{split}'))
+    keys = [info['point_cloud']['velodyne_path'] for info in data_infos]
+    file_paths = [os.path.join(data_root, key) for key in keys]
+    dim = data_infos[0]['point_cloud']['num_features']
+    saved_path = os.path.join(data_root, f'{prefix}_points_{split}')
+    print(f'Packing {len(keys)} {split} frames to {saved_path}')
+    write_point_store(saved_path, keys, file_paths, dim)
+
+
+def main(args):
+    prefix = 'waymo'
+    if args.painted:
+        prefix = 'painted_waymo'
+    for split in args.splits:
+        pack_points(args.data_root, prefix, split)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Configuration Parameters')
+    parser.add_argument('--data_root', help='your kitti format data root for waymo', required=True)
+    parser.add_argument('--painted', action='store_true', help='if using painted lidar points')
+    parser.add_argument('--splits', nargs='*', default=['train', 'val'], help='splits to pack')
+    args = parser.parse_args()
+    main(args)
@@ -1,3 +1,3 @@
 from .data_aug import point_range_filter, data_augment
 from .waymo import Waymo
-from .dataloader import get_dataloader
+from .dataloader import get_dataloader, to_device
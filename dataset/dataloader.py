@@ -39,12 +39,47 @@ def collate_fn(list_data):
     return rt_data_dict
 
 
-def get_dataloader(dataset, batch_size, num_workers, rank, world_size, shuffle=True, drop_last=False, val=False):
+def collate_fn_concat(list_data):
+    '''
+    Same as collate_fn, except that the points of all samples are concatenated:
+    batched_pts: (n1 + n2 + ... + nb, 1 + c), the batch index is the first column
+    batched_pts_offsets: (bs + 1, ), points of sample i are batched_pts[offsets[i]:offsets[i + 1]]
+    '''
+    rt_data_dict = collate_fn(list_data)
+    pts_list = rt_data_dict['batched_pts']
+    offsets = np.zeros(len(pts_list) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(pts) for pts in pts_list])
+    batched_pts = torch.empty((offsets[-1], 1 + pts_list[0].size(1)), dtype=torch.float32)
+    for i, pts in enumerate(pts_list):
+        batched_pts[offsets[i]:offsets[i + 1], 0] = i
+        batched_pts[offsets[i]:offsets[i + 1], 1:] = pts
+    rt_data_dict['batched_pts'] = batched_pts
+    rt_data_dict['batched_pts_offsets'] = torch.from_numpy(offsets)
+    return rt_data_dict
+
+
+def to_device(data_dict, device):
+    '''
+    Moves the tensors and lists of tensors of a collated batch to device, asynchronously when pinned.
+    '''
+    for key, value in data_dict.items():
+        if torch.is_tensor(value):
+            data_dict[key] = value.to(device, non_blocking=True)
+        elif isinstance(value, list):
+            data_dict[key] = [item.to(device, non_blocking=True) if torch.is_tensor(item) else item for item in value]
+    return data_dict
+
+
+def get_dataloader(dataset, batch_size, num_workers, rank, world_size, shuffle=True, drop_last=False, val=False, concat_pts=False):
+    # concat_pts: one pinned points tensor per batch, see collate_fn_concat
+    # val: rank r gets the samples r, r + world_size, ... in order, each sample on exactly one rank
     params = {"batch_size": batch_size,
                 "num_workers": num_workers,
-                'collate_fn': collate_fn}
+                'collate_fn': collate_fn_concat if concat_pts else collate_fn,
+                'pin_memory': concat_pts}
     sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle, drop_last=drop_last)
     if val:
-        sampler = None
+        # unlike DistributedSampler no samples are repeated to even out the ranks
+        sampler = list(range(rank, len(dataset), world_size))
     dataloader = DataLoader(dataset, sampler=sampler, **params)
     return (dataloader, sampler)
@@ -7,7 +7,7 @@ import sys
 BASE = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(BASE))
 
-from utils import read_pickle, read_points, bbox_camera2lidar
+from utils import read_pickle, read_points, bbox_camera2lidar, PointStore, InfoStore
 from dataset import point_range_filter, data_augment
 from torchvision import transforms
 from PIL import Image
@@ -43,7 +43,7 @@ class Waymo(Dataset):
         'Car': 2
         }
 
-    def __init__(self, data_root, split, pts_prefix='velodyne_reduced', painted=False, cam_sync=False, inference=False, interval=1):
+    def __init__(self, data_root, split, pts_prefix='velodyne_reduced', painted=False, cam_sync=False, inference=False, interval=1, packed=False):
         assert split in ['train', 'val', 'trainval', 'test']
         self.data_root = data_root
         self.split = split
@@ -53,7 +53,13 @@ class Waymo(Dataset):
             info_file = f'painted_waymo_infos_{split}.pkl'
         else:
             info_file = f'waymo_infos_{split}.pkl'
-        self.data_infos = read_pickle(os.path.join(data_root, info_file))
+        # infos and points of the whole split in memory-mapped files shared by all workers, see data_prep/pack_points.py
+        self.point_store = None
+        if packed:
+            self.data_infos = InfoStore(os.path.join(data_root, info_file[:-len('.pkl')]))
+            self.point_store = PointStore(os.path.join(data_root, info_file[:-len('.pkl')].replace('infos', 'points')))
+        else:
+            self.data_infos = read_pickle(os.path.join(data_root, info_file))
         self.sorted_ids = range(len(self.data_infos))
         self.painted = painted
         self.cam_sync = cam_sync
@@ -103,7 +109,12 @@ class Waymo(Dataset):
         pts_path = os.path.join(self.data_root, velodyne_path)
         if self.cam_sync:
             annos_info = data_info['cam_sync_annos']
-        if self.painted and not self.inference:
+        if self.point_store is not None:
+            columns = slice(None) if self.painted and not self.inference else slice(0, 5)
+            pts = self.point_store.read(velodyne_path, columns)
+            if self.split in ['train', 'trainval']:
+                pts = np.ascontiguousarray(pts) # augmentation modifies the points in place
+        elif self.painted and not self.inference:
             pts = read_points(pts_path, 11)
         elif self.cam_sync:
             pts = read_points(pts_path, 11)
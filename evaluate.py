@@ -7,31 +7,11 @@ from tqdm import tqdm
 
 from utils import setup_seed, keep_bbox_from_image_range, \
     keep_bbox_from_lidar_range, write_pickle, write_label, \
-    iou2d, iou3d_camera, iou_bev
-from dataset import Waymo, get_dataloader
+    IncrementalEvaluator, EVAL_TYPES, MIN_IOUS
+from dataset import Waymo, get_dataloader, to_device
 from model import PointPillars
 
 
-def get_score_thresholds(tp_scores, total_num_valid_gt, num_sample_pts=41):
-    score_thresholds = []
-    tp_scores = sorted(tp_scores)[::-1]
-    cur_recall, pts_ind = 0, 0
-    for i, score in enumerate(tp_scores):
-        lrecall = (i + 1) / total_num_valid_gt
-        rrecall = (i + 2) / total_num_valid_gt
-
-        if i == len(tp_scores) - 1:
-            score_thresholds.append(score)
-            break
-
-        if (lrecall + rrecall) / 2 < cur_recall:
-            continue
-
-        score_thresholds.append(score)
-        pts_ind += 1
-        cur_recall = pts_ind / (num_sample_pts - 1)
-    return score_thresholds
-
 def convert_calib(calib, cuda):
     result = {}
     if cuda:
@@ -44,273 +24,57 @@ def convert_calib(calib, cuda):
         result['Tr_velo_to_cam_' + str(i)] = torch.from_numpy(calib['Tr_velo_to_cam_' + str(i)]).to(device=device, dtype=torch.float)
     return result
 
-def do_eval(det_results, gt_results, CLASSES, saved_path, cam_sync=False):
+def write_results(ap_results, aos_results, f=None):
     '''
-    det_results: list,
-    gt_results: dict(id -> det_results)
-    CLASSES: dict
+    ap_results: dict(eval_type -> dict(cls -> [AP])), aos_results: dict(cls -> [AOS])
+    f: file, the results are printed and written to f if given
     '''
-    assert len(det_results) == len(gt_results)
-    f = open(os.path.join(saved_path, 'eval_results.txt'), 'w')
-
-    # 1. calculate iou
-    ious = {
-        'bbox_2d': [],
-        'bbox_bev': [],
-        'bbox_3d': []
-    }
-    #ids = list(sorted([g['image']['image_idx'] for g in gt_results]))
-    if cam_sync:
-        annos_label = 'cam_sync_annos'
-    else:
-        annos_label = 'annos'
-    for id in range(len(gt_results)):
-        gt_result = gt_results[id][annos_label]
-        det_result = det_results[gt_results[id]['image']['image_idx']]
-        # 1.1, 2d bboxes iou
-        gt_bboxes2d = gt_result['bbox'].astype(np.float32)
-        det_bboxes2d = det_result['bbox'].astype(np.float32)
-        iou2d_v = iou2d(torch.from_numpy(gt_bboxes2d), torch.from_numpy(det_bboxes2d))
-        ious['bbox_2d'].append(iou2d_v.cpu().numpy())
-
-        # 1.2, bev iou
-        gt_location = gt_result['location'].astype(np.float32)
-        gt_dimensions = gt_result['dimensions'].astype(np.float32)
-        gt_rotation_y = gt_result['rotation_y'].astype(np.float32)
-        det_location = det_result['location'].astype(np.float32).reshape(-1, 3)
-        det_dimensions = det_result['dimensions'].astype(np.float32).reshape(-1, 3)
-        det_rotation_y = det_result['rotation_y'].astype(np.float32)
-
-        gt_bev = np.concatenate([gt_location[:, [0, 2]], gt_dimensions[:, [0, 2]], gt_rotation_y[:, None]], axis=-1)
-        det_bev = np.concatenate([det_location[:, [0, 2]], det_dimensions[:, [0, 2]], det_rotation_y[:, None]], axis=-1)
-        iou_bev_v = iou_bev(torch.from_numpy(gt_bev).cuda(), torch.from_numpy(det_bev).cuda())
-        ious['bbox_bev'].append(iou_bev_v.cpu().numpy())
-
-        # 1.3, 3dbboxes iou
-        gt_bboxes3d = np.concatenate([gt_location, gt_dimensions, gt_rotation_y[:, None]], axis=-1)
-        det_bboxes3d = np.concatenate([det_location, det_dimensions, det_rotation_y[:, None]], axis=-1)
-        iou3d_v = iou3d_camera(torch.from_numpy(gt_bboxes3d).cuda(), torch.from_numpy(det_bboxes3d).cuda())
-        ious['bbox_3d'].append(iou3d_v.cpu().numpy())
-
-    MIN_IOUS = {
-        'Pedestrian': [0.5, 0.5, 0.5],
-        'Cyclist': [0.5, 0.5, 0.5],
-        'Car': [0.7, 0.7, 0.7]
-    }
-    MIN_HEIGHT = [-1, -1, -1]
+    def output(line):
+        print(line)
+        if f is not None:
+            print(line, file=f)
 
     overall_results = {}
-    for e_ind, eval_type in enumerate(['bbox_2d', 'bbox_bev', 'bbox_3d']):
-        eval_ious = ious[eval_type]
-        eval_ap_results, eval_aos_results = {}, {}
-        for cls in CLASSES:
-            eval_ap_results[cls] = []
-            eval_aos_results[cls] = []
-            CLS_MIN_IOU = MIN_IOUS[cls][e_ind]
-            for difficulty in [0]:
-                # 1. bbox property
-                total_gt_ignores, total_det_ignores, total_dc_bboxes, total_scores = [], [], [], []
-                total_gt_alpha, total_det_alpha = [], []
-                for id in range(len(gt_results)):
-                    gt_result = gt_results[id][annos_label]
-                    det_result = det_results[gt_results[id]['image']['image_idx']]
-                    
-                    # 1.1 gt bbox property
-                    cur_gt_names = gt_result['name']
-                    cur_difficulty = gt_result['difficulty']
-                    gt_ignores, dc_bboxes = [], []
-                    for j, cur_gt_name in enumerate(cur_gt_names):
-                        ignore = cur_difficulty[j] < 0 or cur_difficulty[j] > difficulty
-                        if cur_gt_name == cls:
-                            valid_class = 1
-                        elif cls == 'Pedestrian' and cur_gt_name == 'Person_sitting':
-                            valid_class = 0
-                        elif cls == 'Car' and cur_gt_name == 'Van':
-                            valid_class = 0
-                        else:
-                            valid_class = -1
-                        
-                        if valid_class == 1 and not ignore:
-                            gt_ignores.append(0)
-                        elif valid_class == 0 or (valid_class == 1 and ignore):
-                            gt_ignores.append(1)
-                        else:
-                            gt_ignores.append(-1)
-                        
-                        if cur_gt_name == 'DontCare':
-                            dc_bboxes.append(gt_result['bbox'][j])
-                    total_gt_ignores.append(gt_ignores)
-                    total_dc_bboxes.append(np.array(dc_bboxes))
-                    total_gt_alpha.append(gt_result['alpha'])
-
-                    # 1.2 det bbox property
-                    cur_det_names = det_result['name']
-                    if len(cur_det_names) == 0:
-                        cur_det_heights = np.empty_like(det_result['bbox'])
-                    else:
-                        cur_det_heights = det_result['bbox'][:, 3] - det_result['bbox'][:, 1]
-                    det_ignores = []
-                    for j, cur_det_name in enumerate(cur_det_names):
-                        if cur_det_heights[j] < MIN_HEIGHT[difficulty]:
-                            det_ignores.append(1)
-                        elif cur_det_name == cls:
-                            det_ignores.append(0)
-                        else:
-                            det_ignores.append(-1)
-                    total_det_ignores.append(det_ignores)
-                    total_scores.append(det_result['score'])
-                    total_det_alpha.append(det_result['alpha'])
-
-                # 2. calculate scores thresholds for PR curve
-                tp_scores = []
-                for i in range(len(gt_results)):
-                    cur_eval_ious = eval_ious[i]
-                    gt_ignores, det_ignores = total_gt_ignores[i], total_det_ignores[i]
-                    scores = total_scores[i]
-
-                    nn, mm = cur_eval_ious.shape
-                    assigned = np.zeros((mm, ), dtype=np.bool_)
-                    for j in range(nn):
-                        if gt_ignores[j] == -1:
-                            continue
-                        match_id, match_score = -1, -1
-                        for k in range(mm):
-                            if not assigned[k] and det_ignores[k] >= 0 and cur_eval_ious[j, k] > CLS_MIN_IOU and scores[k] > match_score:
-                                match_id = k
-                                match_score = scores[k]
-                        if match_id != -1:
-                            assigned[match_id] = True
-                            if det_ignores[match_id] == 0 and gt_ignores[j] == 0:
-                                tp_scores.append(match_score)
-                total_num_valid_gt = np.sum([np.sum(np.array(gt_ignores) == 0) for gt_ignores in total_gt_ignores])
-                score_thresholds = get_score_thresholds(tp_scores, total_num_valid_gt)    
-            
-                # 3. draw PR curve and calculate mAP
-                tps, fns, fps, total_aos = [], [], [], []
-
-                for score_threshold in score_thresholds:
-                    tp, fn, fp = 0, 0, 0
-                    aos = 0
-                    for i in range(len(gt_results)):
-                        cur_eval_ious = eval_ious[i]
-                        gt_ignores, det_ignores = total_gt_ignores[i], total_det_ignores[i]
-                        gt_alpha, det_alpha = total_gt_alpha[i], total_det_alpha[i]
-                        scores = total_scores[i]
-
-                        nn, mm = cur_eval_ious.shape
-                        assigned = np.zeros((mm, ), dtype=np.bool_)
-                        for j in range(nn):
-                            if gt_ignores[j] == -1:
-                                continue
-                            match_id, match_iou = -1, -1
-                            for k in range(mm):
-                                if not assigned[k] and det_ignores[k] >= 0 and scores[k] >= score_threshold and cur_eval_ious[j, k] > CLS_MIN_IOU:
-    
-                                    if det_ignores[k] == 0 and cur_eval_ious[j, k] > match_iou:
-                                        match_iou = cur_eval_ious[j, k]
-                                        match_id = k
-                                    elif det_ignores[k] == 1 and match_iou == -1:
-                                        match_id = k
-
-                            if match_id != -1:
-                                assigned[match_id] = True
-                                if det_ignores[match_id] == 0 and gt_ignores[j] == 0:
-                                    tp += 1
-                                    if eval_type == 'bbox_2d':
-                                        aos += (1 + np.cos(gt_alpha[j] - det_alpha[match_id])) / 2
-                            else:
-                                if gt_ignores[j] == 0:
-                                    fn += 1
-                            
-                        for k in range(mm):
-                            if det_ignores[k] == 0 and scores[k] >= score_threshold and not assigned[k]:
-                                fp += 1
-                        
-                        # In case 2d bbox evaluation, we should consider dontcare bboxes
-                        if eval_type == 'bbox_2d':
-                            dc_bboxes = total_dc_bboxes[i]
-                            det_bboxes = det_results[gt_results[i]['image']['image_idx']]['bbox']
-                            if len(dc_bboxes) > 0:
-                                ious_dc_det = iou2d(torch.from_numpy(det_bboxes), torch.from_numpy(dc_bboxes), metric=1).numpy().T
-                                for j in range(len(dc_bboxes)):
-                                    for k in range(len(det_bboxes)):
-                                        if det_ignores[k] == 0 and scores[k] >= score_threshold and not assigned[k]:
-                                            if ious_dc_det[j, k] > CLS_MIN_IOU:
-                                                fp -= 1
-                                                assigned[k] = True
-                            
-                    tps.append(tp)
-                    fns.append(fn)
-                    fps.append(fp)
-                    if eval_type == 'bbox_2d':
-                        total_aos.append(aos)
-
-                tps, fns, fps = np.array(tps), np.array(fns), np.array(fps)
-
-                recalls = tps / (tps + fns)
-                precisions = tps / (tps + fps)
-                for i in range(len(score_thresholds)):
-                    precisions[i] = np.max(precisions[i:])
-                
-                sums_AP = 0
-                for i in range(0, len(score_thresholds), 4):
-                    sums_AP += precisions[i]
-                mAP = sums_AP / 11 * 100
-                eval_ap_results[cls].append(mAP)
-
-                if eval_type == 'bbox_2d':
-                    total_aos = np.array(total_aos)
-                    similarity = total_aos / (tps + fps)
-                    for i in range(len(score_thresholds)):
-                        similarity[i] = np.max(similarity[i:])
-                    sums_similarity = 0
-                    for i in range(0, len(score_thresholds), 4):
-                        sums_similarity += similarity[i]
-                    mSimilarity = sums_similarity / 11 * 100
-                    eval_aos_results[cls].append(mSimilarity)
-
-        print(f'=========={eval_type.upper()}==========')
-        print(f'=========={eval_type.upper()}==========', file=f)
+    for e_ind, eval_type in enumerate(EVAL_TYPES):
+        eval_ap_results = ap_results[eval_type]
+        output(f'=========={eval_type.upper()}==========')
         for k, v in eval_ap_results.items():
-            print(f'{k} AP@{MIN_IOUS[k][e_ind]}: {v[0]:.4f}')
-            print(f'{k} AP@{MIN_IOUS[k][e_ind]}: {v[0]:.4f}', file=f)
+            output(f'{k} AP@{MIN_IOUS[k][e_ind]}: {v[0]:.4f}')
         if eval_type == 'bbox_2d':
-            print(f'==========AOS==========')
-            print(f'==========AOS==========', file=f)
-            for k, v in eval_aos_results.items():
-                print(f'{k} AOS@{MIN_IOUS[k][e_ind]}: {v[0]:.4f}')
-                print(f'{k} AOS@{MIN_IOUS[k][e_ind]}: {v[0]:.4f}', file=f)
-        
+            output(f'==========AOS==========')
+            for k, v in aos_results.items():
+                output(f'{k} AOS@{MIN_IOUS[k][e_ind]}: {v[0]:.4f}')
+
         overall_results[eval_type] = np.mean(list(eval_ap_results.values()), 0)
         if eval_type == 'bbox_2d':
-            overall_results['AOS'] = np.mean(list(eval_aos_results.values()), 0)
-    
-    print(f'\n==========Overall==========')
-    print(f'\n==========Overall==========', file=f)
+            overall_results['AOS'] = np.mean(list(aos_results.values()), 0)
+
+    output(f'\n==========Overall==========')
     for k, v in overall_results.items():
-        print(f'{k} AP: {v[0]:.4f}')
-        print(f'{k} AP: {v[0]:.4f}', file=f)
-    f.close()
-    
+        output(f'{k} AP: {v[0]:.4f}')
 
-def main(args):
+
+def main(rank, args, world_size):
     val_dataset = Waymo(data_root=args.data_root,
-                        split='val', painted=args.painted, cam_sync=args.cam_sync)
-    val_dataloader, _ = get_dataloader(dataset=val_dataset, 
+                        split='val', painted=args.painted, cam_sync=args.cam_sync, packed=args.packed)
+    # the ranks infer and evaluate disjoint shards of the val split
+    val_dataloader, frame_inds = get_dataloader(dataset=val_dataset, 
                                     batch_size=args.batch_size, 
                                     num_workers=args.num_workers,
-                                    rank=0,
-                                    world_size=1,
-                                    shuffle=False)
+                                    rank=rank,
+                                    world_size=world_size,
+                                    shuffle=False,
+                                    val=True,
+                                    concat_pts=args.concat_pts)
     CLASSES = Waymo.CLASSES
     LABEL2CLASSES = {v:k for k, v in CLASSES.items()}
 
     if not args.no_cuda:
-        model = PointPillars(nclasses=args.nclasses, painted=args.painted).cuda()
-        checkpoint = torch.load(args.ckpt)
+        model = PointPillars(nclasses=args.nclasses, painted=args.painted, max_num_points=args.max_num_points, dynamic_pillars=args.dynamic_pillars).cuda()
+        checkpoint = torch.load(args.ckpt, map_location=torch.device('cuda'))
         model.load_state_dict(checkpoint["model_state_dict"])
     else:
-        model = PointPillars(nclasses=args.nclasses, painted=args.painted)
+        model = PointPillars(nclasses=args.nclasses, painted=args.painted, max_num_points=args.max_num_points, dynamic_pillars=args.dynamic_pillars)
         checkpoint = torch.load(args.ckpt, map_location=torch.device('cpu'))
         model.load_state_dict(checkpoint["model_state_dict"])
     
@@ -321,17 +85,25 @@ def main(args):
 
     pcd_limit_range = torch.tensor([-74.88, -74.88, -2, 74.88, 74.88, 4])
 
+    # the detections are matched while inference runs, the results are ready at its end
+    annos_label = 'cam_sync_annos' if args.cam_sync else 'annos'
+    # fail before the inference if the levels cannot be computed
+    if args.levels and len(frame_inds) > 0 and 'num_points_in_gt' not in val_dataset.data_infos[frame_inds[0]][annos_label]:
+        raise ValueError('--levels needs num_points_in_gt in the annos of the infos, '
+                         'the infos of data_prep/create_info.py do not have it')
+    evaluator = IncrementalEvaluator(CLASSES, device='cpu' if args.no_cuda else 'cuda',
+                                     range_bins=args.range_bins, levels=args.levels,
+                                     score_bins=args.score_bins or None)
+    frame_pos = 0
+
     model.eval()
     with torch.inference_mode():
         format_results = {}
         print('Predicting and Formatting the results.')
-        for i, data_dict in enumerate(tqdm(val_dataloader)):
+        for i, data_dict in enumerate(tqdm(val_dataloader, disable=rank != 0)):
             if not args.no_cuda:
                 # move the tensors to the cuda
-                for key in data_dict:
-                    for j, item in enumerate(data_dict[key]):
-                        if torch.is_tensor(item):
-                            data_dict[key][j] = data_dict[key][j].cuda()
+                data_dict = to_device(data_dict, 'cuda')
             
             batched_pts = data_dict['batched_pts']
             batched_gt_bboxes = data_dict['batched_gt_bboxes']
@@ -340,7 +112,8 @@ def main(args):
             batch_results = model(batched_pts=batched_pts, 
                                   mode='val',
                                   batched_gt_bboxes=batched_gt_bboxes, 
-                                  batched_gt_labels=batched_labels)
+                                  batched_gt_labels=batched_labels,
+                                  batched_pts_offsets=data_dict.get('batched_pts_offsets'))
             # pdb.set_trace()
             for j, result in enumerate(batch_results):
                 format_result = {
@@ -354,7 +127,7 @@ def main(args):
                     'rotation_y': [],
                     'score': []
                 }
-                data_dict['batched_calib_info'][0] = convert_calib(data_dict['batched_calib_info'][0], False)
+                data_dict['batched_calib_info'][j] = convert_calib(data_dict['batched_calib_info'][j], False)
                 calib_info = data_dict['batched_calib_info'][j]
                 image_info = data_dict['batched_img_info'][j]
                 idx = data_dict['batched_img_info'][j]['image_idx']
@@ -382,11 +155,34 @@ def main(args):
                     format_result['dimensions'] = torch.stack(format_result['dimensions'])
                     format_result['location'] = torch.stack(format_result['location'])
                 format_results[idx] = {k:np.array(v) for k, v in format_result.items()}
+                evaluator.update(idx, format_results[idx], val_dataset.data_infos[frame_inds[frame_pos]][annos_label])
+                frame_pos += 1
+
+            if args.eval_interval > 0 and (i + 1) % args.eval_interval == 0 and rank == 0:
+                print(f'\nResults of the first {frame_pos} frames of rank 0')
+                write_results(*evaluator.compute())
         
-        write_pickle(format_results, os.path.join(saved_path, 'results.pkl'))
+        if world_size > 1:
+            write_pickle(format_results, os.path.join(saved_path, f'results_rank{rank}.pkl'))
+        else:
+            write_pickle(format_results, os.path.join(saved_path, 'results.pkl'))
     
-    print('Evaluating.. Please wait several seconds.')
-    do_eval(format_results, val_dataset.data_infos, CLASSES, saved_path, cam_sync=args.cam_sync)
+    # the statistics of the shards add up to those of the whole split
+    if world_size > 1:
+        states = [None] * world_size if rank == 0 else None
+        torch.distributed.gather_object(evaluator.state_dict(), states, dst=0)
+        if rank == 0:
+            for state in states[1:]:
+                evaluator.merge(state)
+
+    if rank == 0:
+        print('Evaluating.. Please wait several seconds.')
+        with open(os.path.join(saved_path, 'eval_results.txt'), 'w') as f:
+            write_results(*evaluator.compute(), f)
+            for breakdown in evaluator.breakdowns[1:]:
+                print(f'\n##########{breakdown}##########')
+                print(f'\n##########{breakdown}##########', file=f)
+                write_results(*evaluator.compute(breakdown), f)
 
 
 if __name__ == '__main__':
@@ -399,8 +195,33 @@ if __name__ == '__main__':
     parser.add_argument('--nclasses', type=int, default=3)
     parser.add_argument('--painted', action='store_true', help='if using painted lidar points')
     parser.add_argument('--cam_sync', action='store_true', help='only use objects visible to a camera')
+    parser.add_argument('--packed', action='store_true', help='read infos and points from the packed stores of data_prep/pack_points.py')
+    parser.add_argument('--concat_pts', action='store_true', help='collate the points of a batch into one pinned tensor')
+    parser.add_argument('--dynamic_pillars', action='store_true', help='encode pillars from the flat point list instead of padding them to max_num_points')
+    parser.add_argument('--max_num_points', type=int, default=20, help='max points per pillar, -1 keeps all points with --dynamic_pillars')
+    parser.add_argument('--eval_interval', type=int, default=0, help='print the results of the frames so far every this many batches, 0 only at the end')
+    parser.add_argument('--score_bins', type=int, default=0,
+                        help='round the det scores to this many bins to bound the evaluator state on long runs, 0 keeps them exact')
+    parser.add_argument('--range_bins', type=float, nargs='*', default=None,
+                        help='edges of the range bins in m to break the results down by, e.g. 0 30 50, the last bin is open ended')
+    parser.add_argument('--levels', action='store_true',
+                        help='break the results down by LEVEL_1/LEVEL_2, needs num_points_in_gt in the annos')
     parser.add_argument('--no_cuda', action='store_true',
                         help='whether to use cuda')
+    parser.add_argument('--dist_backend', default=None, choices=['nccl', 'gloo'],
+                        help='backend when launched with torchrun, gloo by default with --no_cuda else nccl')
     args = parser.parse_args()
 
-    main(args)
+    # one process per device with torchrun, each evaluates a shard of the val split
+    if 'WORLD_SIZE' in os.environ:
+        if args.dist_backend is None:
+            args.dist_backend = 'gloo' if args.no_cuda else 'nccl'
+        torch.distributed.init_process_group(args.dist_backend, init_method='env://')
+        world_size = torch.distributed.get_world_size()
+        rank = torch.distributed.get_rank()
+        if not args.no_cuda:
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', rank)))
+        main(rank, args, world_size)
+        torch.distributed.destroy_process_group()
+    else:
+        main(0, args, 1)
@@ -14,8 +14,8 @@ import deeplabv3plus.network as network
 from painting.painting import Painter
 from utils import setup_seed, keep_bbox_from_image_range, \
     keep_bbox_from_lidar_range, write_pickle, write_label, \
-    iou2d, iou3d_camera, iou_bev
-from evaluate import do_eval
+    iou2d, iou3d_camera, iou_bev, IncrementalEvaluator
+from evaluate import write_results
 
 def convert_calib(calib, cuda):
     result = {}
@@ -39,7 +39,8 @@ def change_calib_device(calib, cuda):
 
 def main(args):
     val_dataset = Waymo(data_root=args.data_root,
-                        split='val', painted=args.painted, cam_sync=args.cam_sync, inference=True)
+                        split='val', painted=args.painted, cam_sync=args.cam_sync, inference=True,
+                        packed=args.packed)
     val_dataloader, _ = get_dataloader(dataset=val_dataset, 
                                     batch_size=1, 
                                     num_workers=args.num_workers,
@@ -50,17 +51,18 @@ def main(args):
     LABEL2CLASSES = {v:k for k, v in CLASSES.items()}
 
     if not args.no_cuda:
-        model = PointPillars(nclasses=args.nclasses, painted=args.painted).cuda()
+        model = PointPillars(nclasses=args.nclasses, painted=args.painted, max_num_points=args.max_num_points, dynamic_pillars=args.dynamic_pillars).cuda()
         checkpoint = torch.load(args.lidar_detector)
         model.load_state_dict(checkpoint["model_state_dict"])
     else:
-        model = PointPillars(nclasses=args.nclasses, painted=args.painted)
+        model = PointPillars(nclasses=args.nclasses, painted=args.painted, max_num_points=args.max_num_points, dynamic_pillars=args.dynamic_pillars)
         checkpoint = torch.load(args.lidar_detector, map_location=torch.device('cpu'))
         model.load_state_dict(checkpoint["model_state_dict"])
-    PaintArgs = namedtuple('PaintArgs', ['training_path', 'model_path', 'cam_sync'])
-    painting_args = PaintArgs(os.path.join(args.data_root, 'training'), args.segmentor, args.cam_sync)
+    PaintArgs = namedtuple('PaintArgs', ['training_path', 'model_path', 'cam_sync',
+                                         'score_cache_dir', 'score_cache_size', 'score_cache_dtype'])
+    painting_args = PaintArgs(os.path.join(args.data_root, 'training'), args.segmentor, args.cam_sync,
+                              args.score_cache_dir, args.score_cache_size, args.score_cache_dtype)
     painter = Painter(painting_args)
-    deeplab = painter.model
     saved_path = args.saved_path
     os.makedirs(saved_path, exist_ok=True)
     saved_submit_path = os.path.join(saved_path, 'submit')
@@ -68,6 +70,12 @@ def main(args):
 
     pcd_limit_range = torch.tensor([-74.88, -74.88, -2, 74.88, 74.88, 4])
 
+    # the detections are matched while inference runs, the results are ready at its end
+    annos_label = 'cam_sync_annos' if args.cam_sync else 'annos'
+    evaluator = IncrementalEvaluator(CLASSES, device='cpu' if args.no_cuda else 'cuda',
+                                     score_bins=args.score_bins or None)
+    frame_pos = 0
+
     model.eval()
     with torch.inference_mode():
         format_results = {}
@@ -90,11 +98,15 @@ def main(args):
             batched_gt_bboxes = data_dict['batched_gt_bboxes']
             batched_labels = data_dict['batched_labels']
             #batched_images = data_dict['batched_images'][0]
-            scores_from_cam = []
             start_time = time.perf_counter()
-            for i in range(len(data_dict['batched_images'][0])):
-                segmentation_score = deeplab(data_dict['batched_images'][0][i])[0]
-                scores_from_cam.append(painter.get_score(segmentation_score))
+            images = data_dict['batched_images'][0]
+            image_idx = data_dict['batched_img_info'][0]['image_idx']
+            keys = [(image_idx, i) for i in range(len(images))]
+            if painter.score_cache is not None:
+                cached = [painter.score_cache.get(*key) for key in keys]
+            else:
+                cached = None
+            scores_from_cam = painter.get_scores(images, cached, keys)
 
             points = painter.augment_lidar_class_scores_both(scores_from_cam, batched_pts[0], data_dict['batched_calib_info'][0])
             batch_results = model(batched_pts=[points], 
@@ -147,13 +159,20 @@ def main(args):
                     format_result['dimensions'] = torch.stack(format_result['dimensions'])
                     format_result['location'] = torch.stack(format_result['location'])
                 format_results[idx] = {k:np.array(v) for k, v in format_result.items()}
+                evaluator.update(idx, format_results[idx], val_dataset.data_infos[frame_pos][annos_label])
+                frame_pos += 1
+
+            if args.eval_interval > 0 and frame_pos % args.eval_interval == 0:
+                print(f'\nResults of the first {frame_pos} frames')
+                write_results(*evaluator.compute())
         
         write_pickle(format_results, os.path.join(saved_path, 'results.pkl'))
     
     with open('latency.txt', 'w', newline='') as f:
         f.writelines(latency_results)
     print('Evaluating.. Please wait several seconds.')
-    do_eval(format_results, val_dataset.data_infos, CLASSES, saved_path, cam_sync=args.cam_sync)
+    with open(os.path.join(saved_path, 'eval_results.txt'), 'w') as f:
+        write_results(*evaluator.compute(), f)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Configuration Parameters')
@@ -165,6 +184,15 @@ if __name__ == '__main__':
     parser.add_argument('--nclasses', type=int, default=3)
     parser.add_argument('--painted', action='store_true', help='if using painted lidar points')
     parser.add_argument('--cam_sync', action='store_true', help='only use objects visible to a camera')
+    parser.add_argument('--packed', action='store_true', help='read infos and points from the packed stores of data_prep/pack_points.py')
+    parser.add_argument('--dynamic_pillars', action='store_true', help='encode pillars from the flat point list instead of padding them to max_num_points')
+    parser.add_argument('--max_num_points', type=int, default=20, help='max points per pillar, -1 keeps all points with --dynamic_pillars')
+    parser.add_argument('--score_cache_dir', default=None, help='cache segmentation scores here, keyed by checkpoint and image')
+    parser.add_argument('--score_cache_size', type=float, default=100., help='max size of the score cache in GB')
+    parser.add_argument('--score_cache_dtype', default='float16', choices=['float16', 'uint8'], help='storage type of cached scores')
+    parser.add_argument('--eval_interval', type=int, default=0, help='print the results of the frames so far every this many frames, 0 only at the end')
+    parser.add_argument('--score_bins', type=int, default=0,
+                        help='round the det scores to this many bins to bound the evaluator state on long runs, 0 keeps them exact')
     parser.add_argument('--no_cuda', action='store_true',
                         help='whether to use cuda')
     args = parser.parse_args()
@@ -1,6 +1,6 @@
 import torch
 import math
-from utils import limit_period, iou2d_nearest
+from utils import limit_period, iou2d_aligned, nearest_bev
 
 
 class Anchors():
@@ -9,16 +9,18 @@ class Anchors():
         self.ranges = ranges
         self.sizes = sizes
         self.rotations = rotations
+        # multi anchors of the last (feature_map_size, device)
+        self.cache_key, self.cache = None, None
+        # center, size and rotation tables of get_anchors_by_index for the last (feature_map_size, device)
+        self.index_cache_key, self.index_cache = None, None
 
-    def get_anchors(self, feature_map_size, anchor_range, anchor_size, rotations):
+    def get_centers(self, feature_map_size, anchor_range):
         '''
         feature_map_size: (y_l, x_l)
         anchor_range: [x1, y1, z1, x2, y2, z2]
-        anchor_size: [w, l, h]
-        rotations: [0, 1.57]
-        return: shape=(y_l, x_l, 2, 7)
+        return: x_centers (x_l, ), y_centers (y_l, ), z_centers (1, )
         '''
-        device = feature_map_size.device
+        device = anchor_range.device
         x_centers = torch.linspace(anchor_range[0], anchor_range[3], feature_map_size[1] + 1, device=device)
         y_centers = torch.linspace(anchor_range[1], anchor_range[4], feature_map_size[0] + 1, device=device)
         z_centers = torch.linspace(anchor_range[2], anchor_range[5], 1 + 1, device=device)
@@ -29,6 +31,17 @@ class Anchors():
         x_centers = x_centers[:feature_map_size[1]] + x_shift # (feature_map_size[1], )
         y_centers = y_centers[:feature_map_size[0]] + y_shift # (feature_map_size[0], )
         z_centers = z_centers[:1] + z_shift  # (1, )
+        return x_centers, y_centers, z_centers
+
+    def get_anchors(self, feature_map_size, anchor_range, anchor_size, rotations):
+        '''
+        feature_map_size: (y_l, x_l)
+        anchor_range: [x1, y1, z1, x2, y2, z2]
+        anchor_size: [w, l, h]
+        rotations: [0, 1.57]
+        return: shape=(y_l, x_l, 2, 7)
+        '''
+        x_centers, y_centers, z_centers = self.get_centers(feature_map_size, anchor_range)
 
         # [feature_map_size[1], feature_map_size[0], 1, 2] * 4
         meshgrids = torch.meshgrid(x_centers, y_centers, z_centers, rotations)
@@ -44,15 +57,20 @@ class Anchors():
         return anchors.squeeze(0)
 
 
-    def get_multi_anchors(self, feature_map_size):
+    def get_multi_anchors(self, feature_map_size, device=None):
         '''
-        feature_map_size: (y_l, x_l)
+        feature_map_size: (y_l, x_l), a tensor or, with device, a tuple
         ranges: [[x1, y1, z1, x2, y2, z2], [x1, y1, z1, x2, y2, z2], [x1, y1, z1, x2, y2, z2]]
         sizes: [[w, l, h], [w, l, h], [w, l, h]]
         rotations: [0, 1.57]
-        return: shape=(y_l, x_l, 3, 2, 7)
+        return: shape=(y_l, x_l, 3, 2, 7), built once per feature map size and device, do not modify it
         '''
-        device = feature_map_size.device
+        if device is None:
+            device = feature_map_size.device
+        feature_map_size = tuple(int(size) for size in feature_map_size)
+        if self.cache_key == (feature_map_size, device):
+            return self.cache
+
         ranges = torch.tensor(self.ranges, device=device)  
         sizes = torch.tensor(self.sizes, device=device) 
         rotations = torch.tensor(self.rotations, device=device)
@@ -65,8 +83,40 @@ class Anchors():
             multi_anchors.append(anchors[:, :, None, :, :])
         multi_anchors = torch.cat(multi_anchors, dim=2)
 
+        self.cache_key, self.cache = (feature_map_size, device), multi_anchors
         return multi_anchors
 
+    def get_anchors_by_index(self, feature_map_size, inds):
+        '''
+        feature_map_size: (y_l, x_l)
+        inds: (k, ), indices into get_multi_anchors(feature_map_size).reshape(-1, 7)
+        return: shape=(k, 7), the same anchors, computed without building the others
+        '''
+        device = inds.device
+        y_l, x_l = (int(size) for size in feature_map_size)
+        # the tables are built once per feature map size and device, building them waits for the device
+        if self.index_cache_key != ((y_l, x_l), device):
+            ranges = torch.tensor(self.ranges, device=device)
+            sizes = torch.tensor(self.sizes, device=device)
+            rotations = torch.tensor(self.rotations, device=device)
+            centers = [self.get_centers((y_l, x_l), anchor_range) for anchor_range in ranges]
+            x_centers, y_centers, z_centers = (torch.stack(axis_centers, dim=0) for axis_centers in zip(*centers)) # (3, x_l), (3, y_l), (3, 1)
+            self.index_cache_key = ((y_l, x_l), device)
+            self.index_cache = x_centers, y_centers, z_centers, sizes, rotations
+        x_centers, y_centers, z_centers, sizes, rotations = self.index_cache
+
+        n_rotations, n_sizes = len(rotations), len(sizes)
+        rotation_inds = inds % n_rotations
+        size_inds = inds // n_rotations % n_sizes
+        x_inds = inds // (n_rotations * n_sizes) % x_l
+        y_inds = inds // (n_rotations * n_sizes * x_l)
+        anchors = torch.cat([x_centers[size_inds, x_inds, None],
+                             y_centers[size_inds, y_inds, None],
+                             z_centers[size_inds],
+                             sizes[size_inds],
+                             rotations[rotation_inds, None]], dim=-1) # (k, 7)
+        return anchors
+
 
 def anchors2bboxes(anchors, deltas):
     '''
@@ -115,9 +165,50 @@ def bboxes2deltas(bboxes, anchors):
     return deltas
 
 
+def anchor_overlaps(gt_bboxes, gt_samples, gt_assigners, anchors):
+    '''
+    The nearest bev iou of every gt bbox and the anchors of its sample and assigner, only computed for the
+    anchors within the window of feature map cells around the gt bbox, the others have iou 0.
+    gt_bboxes: (n, 7)
+    gt_samples: (n, ), gt_assigners: (n, ), the anchors of gt bbox i are anchors[gt_samples[i], :, :, gt_assigners[i]]
+    anchors: (bs, y_l, x_l, 3, 2, 7), on the feature map grid
+    return: gt_inds (k, ), anchor_inds (k, ) into anchors.reshape(-1, 7), overlaps (k, ), in gt order
+    '''
+    device = anchors.device
+    bs, y_l, x_l, n_assigners, n_rotations = anchors.size()[:5]
+    anchor_sets = gt_samples * n_assigners + gt_assigners # (n, )
+    x_centers = anchors[:, 0, :, :, 0, 0].permute(0, 2, 1).reshape(-1, x_l) # (bs * 3, x_l)
+    y_centers = anchors[:, :, 0, :, 0, 1].permute(0, 2, 1).reshape(-1, y_l) # (bs * 3, y_l)
+    gt_bev = nearest_bev(gt_bboxes) # (n, 4)
+
+    # cells whose anchors can reach the gt bbox, widened by one cell against rounding. the bev
+    # extent of an anchor only depends on its size and rotation, the anchors of cell (0, 0) have them all
+    cell_bev = nearest_bev(anchors[:, 0, 0].reshape(-1, 7)).reshape(-1, n_rotations, 4) # (bs * 3, 2, 4)
+    x_half = torch.amax(cell_bev[:, :, 2] - cell_bev[:, :, 0], dim=1)[anchor_sets] / 2
+    y_half = torch.amax(cell_bev[:, :, 3] - cell_bev[:, :, 1], dim=1)[anchor_sets] / 2
+    x_centers, y_centers = x_centers[anchor_sets], y_centers[anchor_sets] # (n, x_l), (n, y_l)
+    x_lo = torch.clamp(torch.searchsorted(x_centers, (gt_bev[:, 0] - x_half)[:, None])[:, 0] - 1, min=0)
+    x_hi = torch.clamp(torch.searchsorted(x_centers, (gt_bev[:, 2] + x_half)[:, None], right=True)[:, 0] + 1, max=x_l)
+    y_lo = torch.clamp(torch.searchsorted(y_centers, (gt_bev[:, 1] - y_half)[:, None])[:, 0] - 1, min=0)
+    y_hi = torch.clamp(torch.searchsorted(y_centers, (gt_bev[:, 3] + y_half)[:, None], right=True)[:, 0] + 1, max=y_l)
+    x_w = torch.clamp(x_hi - x_lo, min=0) * n_rotations
+    npairs = torch.clamp(y_hi - y_lo, min=0) * x_w # (n, )
+
+    # every (gt, anchor) pair of the windows
+    gt_inds = torch.repeat_interleave(torch.arange(len(gt_bboxes), device=device), npairs)
+    pair_inds = torch.arange(len(gt_inds), device=device) - (torch.cumsum(npairs, dim=0) - npairs)[gt_inds]
+    x_w = x_w[gt_inds]
+    y_inds = y_lo[gt_inds] + pair_inds // x_w
+    x_inds = x_lo[gt_inds] + pair_inds % x_w // n_rotations
+    anchor_inds = (((gt_samples[gt_inds] * y_l + y_inds) * x_l + x_inds) * n_assigners + gt_assigners[gt_inds]) \
+        * n_rotations + pair_inds % n_rotations
+    overlaps = iou2d_aligned(gt_bev[gt_inds], nearest_bev(anchors.reshape(-1, 7)[anchor_inds]))
+    return gt_inds, anchor_inds, overlaps
+
+
 def anchor_target(batched_anchors, batched_gt_bboxes, batched_gt_labels, assigners, nclasses):
     '''
-    batched_anchors: [(y_l, x_l, 3, 2, 7), (y_l, x_l, 3, 2, 7), ... ]
+    batched_anchors: [(y_l, x_l, 3, 2, 7), (y_l, x_l, 3, 2, 7), ... ], usually the same tensor for every sample
     batched_gt_bboxes: [(n1, 7), (n2, 7), ...]
     batched_gt_labels: [(n1, ), (n2, ), ...]
     return: 
@@ -131,104 +222,102 @@ def anchor_target(batched_anchors, batched_gt_bboxes, batched_gt_labels, assigne
     assert len(batched_anchors) == len(batched_gt_bboxes) == len(batched_gt_labels)
     batch_size = len(batched_anchors)
     n_assigners = len(assigners)
-    batched_labels, batched_label_weights = [], []
-    batched_bbox_reg, batched_bbox_reg_weights = [], []
-    batched_dir_labels, batched_dir_labels_weights = [], []
-    for i in range(batch_size):
-        anchors = batched_anchors[i]
-        gt_bboxes, gt_labels = batched_gt_bboxes[i], batched_gt_labels[i]
-        # what we want to get next ?
-        # 1. identify positive anchors and negative anchors  -> cls
-        # 2. identify the regresstion values  -> reg
-        # 3. indentify the direction  -> dir_cls
-        multi_labels, multi_label_weights = [], []
-        multi_bbox_reg, multi_bbox_reg_weights = [], []
-        multi_dir_labels, multi_dir_labels_weights = [], []
-        d1, d2, d3, d4, d5 = anchors.size()
-        for j in range(n_assigners): # multi anchors
-            assigner = assigners[j]
-            pos_iou_thr, neg_iou_thr, min_iou_thr = \
-            assigner['pos_iou_thr'], assigner['neg_iou_thr'], assigner['min_iou_thr']
-            cur_anchors = anchors[:, :, j, :, :].reshape(-1, 7)
-            overlaps = iou2d_nearest(gt_bboxes, cur_anchors)
-            if overlaps.shape[0] == 0:
-                max_overlaps = torch.zeros_like(cur_anchors[:, 0], dtype=cur_anchors.dtype)
-                max_overlaps_idx = torch.zeros_like(cur_anchors[:, 0], dtype=torch.long)
-            else:    
-                max_overlaps, max_overlaps_idx = torch.max(overlaps, dim=0)
-                gt_max_overlaps, _ = torch.max(overlaps, dim=1)
-
-            assigned_gt_inds = -torch.ones_like(cur_anchors[:, 0], dtype=torch.long)
-            # a. negative anchors
-            assigned_gt_inds[max_overlaps < neg_iou_thr] = 0
-
-            # b. positive anchors
-            # rule 1
-            assigned_gt_inds[max_overlaps >= pos_iou_thr] = max_overlaps_idx[max_overlaps >= pos_iou_thr] + 1
-            
-            # rule 2
-            # support one bbox to multi anchors, only if the anchors are with the highest iou.
-            # rule2 may modify the labels generated by rule 1
-            for i in range(len(gt_bboxes)):
-                if gt_max_overlaps[i] >= min_iou_thr:
-                    assigned_gt_inds[overlaps[i] == gt_max_overlaps[i]] = i + 1
-
-            pos_flag = assigned_gt_inds > 0
-            neg_flag = assigned_gt_inds == 0
-            # 1. anchor labels
-            assigned_gt_labels = torch.zeros_like(cur_anchors[:, 0], dtype=torch.long) + nclasses # -1 is not optimal, for some bboxes are with labels -1
-            assigned_gt_labels[pos_flag] = gt_labels[assigned_gt_inds[pos_flag] - 1].long()
-            assigned_gt_labels_weights = torch.zeros_like(cur_anchors[:, 0])
-            assigned_gt_labels_weights[pos_flag] = 1
-            assigned_gt_labels_weights[neg_flag] = 1
-
-            # 2. anchor regression
-            assigned_gt_reg_weights = torch.zeros_like(cur_anchors[:, 0])
-            assigned_gt_reg_weights[pos_flag] = 1
-
-            assigned_gt_reg = torch.zeros_like(cur_anchors)
-            positive_anchors = cur_anchors[pos_flag]
-            corr_gt_bboxes = gt_bboxes[assigned_gt_inds[pos_flag] - 1]
-            assigned_gt_reg[pos_flag] = bboxes2deltas(corr_gt_bboxes, positive_anchors)
-
-            # 3. anchor direction
-            assigned_gt_dir_weights = torch.zeros_like(cur_anchors[:, 0])
-            assigned_gt_dir_weights[pos_flag] = 1
-
-            assigned_gt_dir = torch.zeros_like(cur_anchors[:, 0], dtype=torch.long)
-            dir_cls_targets = limit_period(corr_gt_bboxes[:, 6].cpu(), 0, 2 * math.pi).to(corr_gt_bboxes)
-            dir_cls_targets = torch.floor(dir_cls_targets / math.pi).long()
-            assigned_gt_dir[pos_flag] = torch.clamp(dir_cls_targets, min=0, max=1)
-
-            multi_labels.append(assigned_gt_labels.reshape(d1, d2, 1, d4))
-            multi_label_weights.append(assigned_gt_labels_weights.reshape(d1, d2, 1, d4))
-            multi_bbox_reg.append(assigned_gt_reg.reshape(d1, d2, 1, d4, -1))
-            multi_bbox_reg_weights.append(assigned_gt_reg_weights.reshape(d1, d2, 1, d4))
-            multi_dir_labels.append(assigned_gt_dir.reshape(d1, d2, 1, d4))
-            multi_dir_labels_weights.append(assigned_gt_dir_weights.reshape(d1, d2, 1, d4))
-        
-        multi_labels = torch.cat(multi_labels, dim=-2).reshape(-1)
-        multi_label_weights = torch.cat(multi_label_weights, dim=-2).reshape(-1)
-        multi_bbox_reg = torch.cat(multi_bbox_reg, dim=-3).reshape(-1, d5)
-        multi_bbox_reg_weights = torch.cat(multi_bbox_reg_weights, dim=-2).reshape(-1)
-        multi_dir_labels = torch.cat(multi_dir_labels, dim=-2).reshape(-1)
-        multi_dir_labels_weights = torch.cat(multi_dir_labels_weights, dim=-2).reshape(-1)
-
-        batched_labels.append(multi_labels)
-        batched_label_weights.append(multi_label_weights)
-        batched_bbox_reg.append(multi_bbox_reg)
-        batched_bbox_reg_weights.append(multi_bbox_reg_weights)
-        batched_dir_labels.append(multi_dir_labels) 
-        batched_dir_labels_weights.append(multi_dir_labels_weights)
-    
+    # the anchors are only stacked if the samples do not share them
+    anchors = batched_anchors[0]
+    if all(sample_anchors is anchors for sample_anchors in batched_anchors):
+        anchors = anchors[None]
+    else:
+        anchors = torch.stack(batched_anchors, dim=0)
+    d0, d1, d2, d3, d4, d5 = anchors.size()
+    assert d3 == n_assigners
+    device = anchors.device
+    n_anchors = d1 * d2 * d3 * d4
+
+    # all gt bboxes of the batch, every one is matched with the anchors of every assigner
+    gt_bboxes, gt_labels = torch.cat(batched_gt_bboxes, dim=0), torch.cat(batched_gt_labels, dim=0)
+    n_gts = torch.tensor([len(sample_gt_bboxes) for sample_gt_bboxes in batched_gt_bboxes], device=device)
+    gt_samples = torch.repeat_interleave(torch.arange(batch_size, device=device), n_gts)
+    pair_gts = torch.arange(len(gt_bboxes), device=device).repeat_interleave(n_assigners) # gt of (gt, assigner) pair
+    pair_assigners = torch.arange(n_assigners, device=device).repeat(len(gt_bboxes))
+    anchor_samples = gt_samples if d0 > 1 else torch.zeros_like(gt_samples)
+    # the same max overlaps as of the dense iou2d_nearest(gt_bboxes, anchors) of every sample and
+    # assigner, but only the pairs that can overlap are computed
+    pair_inds, anchor_inds, overlaps = anchor_overlaps(gt_bboxes[pair_gts], anchor_samples[pair_gts],
+                                                       pair_assigners, anchors)
+    gt_inds = pair_gts[pair_inds]
+    # into the anchors of all samples, (bs, n_anchors) flattened
+    anchor_inds = gt_samples[gt_inds] * n_anchors + anchor_inds % n_anchors
+
+    max_overlaps = gt_bboxes.new_zeros(batch_size * n_anchors).scatter_reduce_(0, anchor_inds, overlaps, 'amax')
+    pair_max_overlaps = gt_bboxes.new_zeros(len(pair_gts)).scatter_reduce_(0, pair_inds, overlaps, 'amax')
+    # like torch.max, the first gt of the sample with the max overlap, the first gt if all overlaps are 0
+    max_overlaps_idx = torch.full_like(max_overlaps, len(gt_bboxes), dtype=torch.long)
+    is_max = overlaps == max_overlaps[anchor_inds]
+    max_overlaps_idx.scatter_reduce_(0, anchor_inds[is_max], gt_inds[is_max], 'amin')
+    first_gts = (torch.cumsum(n_gts, dim=0) - n_gts).repeat_interleave(n_anchors)
+    max_overlaps_idx = torch.where(max_overlaps == 0, first_gts, max_overlaps_idx)
+
+    # the thresholds of the assigner of every anchor, the anchors of assigner j are anchors[..., j, :, :]
+    pos_iou_thr, neg_iou_thr, min_iou_thr = (
+        torch.tensor([assigner[key] for assigner in assigners], dtype=max_overlaps.dtype, device=device)
+        for key in ['pos_iou_thr', 'neg_iou_thr', 'min_iou_thr'])
+    max_overlaps = max_overlaps.view(-1, d3, d4)
+    max_overlaps_idx = max_overlaps_idx.view(-1, d3, d4)
+    assigned_gt_inds = -torch.ones_like(max_overlaps_idx)
+    # a. negative anchors
+    assigned_gt_inds[max_overlaps < neg_iou_thr[:, None]] = 0
+
+    # b. positive anchors
+    # rule 1
+    is_pos = max_overlaps >= pos_iou_thr[:, None]
+    assigned_gt_inds[is_pos] = max_overlaps_idx[is_pos] + 1
+    assigned_gt_inds = assigned_gt_inds.reshape(-1)
+
+    # rule 2
+    # support one bbox to multi anchors, only if the anchors are with the highest iou.
+    # rule2 may modify the labels generated by rule 1, when several bboxes claim
+    # an anchor the last one wins. a gt bbox that overlaps no anchor claims none,
+    # even with a min_iou_thr of 0
+    gt_max_overlaps = pair_max_overlaps[pair_inds]
+    is_gt_max = (overlaps == gt_max_overlaps) & (gt_max_overlaps >= min_iou_thr[pair_assigners[pair_inds]]) & \
+        (gt_max_overlaps > 0)
+    rule2_assigned_gt_inds = torch.zeros_like(assigned_gt_inds)
+    rule2_assigned_gt_inds.scatter_reduce_(0, anchor_inds[is_gt_max], gt_inds[is_gt_max] + 1, 'amax')
+    assigned_gt_inds = torch.where(rule2_assigned_gt_inds > 0, rule2_assigned_gt_inds, assigned_gt_inds)
+
+    # targets of all samples, in the order of anchors.reshape(-1, 7) of every sample
+    anchors = anchors.reshape(-1, d5)
+    pos_flag = assigned_gt_inds > 0
+    neg_flag = assigned_gt_inds == 0
+    pos_inds = torch.nonzero(pos_flag, as_tuple=True)[0]
+    # 1. anchor labels
+    assigned_gt_labels = torch.zeros_like(assigned_gt_inds) + nclasses # -1 is not optimal, for some bboxes are with labels -1
+    assigned_gt_labels[pos_inds] = gt_labels[assigned_gt_inds[pos_inds] - 1].long()
+    assigned_gt_labels_weights = (pos_flag | neg_flag).to(anchors.dtype)
+
+    # 2. anchor regression
+    assigned_gt_reg_weights = pos_flag.to(anchors.dtype)
+
+    assigned_gt_reg = anchors.new_zeros((batch_size * n_anchors, d5))
+    positive_anchors = anchors[pos_inds % len(anchors)]
+    corr_gt_bboxes = gt_bboxes[assigned_gt_inds[pos_inds] - 1]
+    assigned_gt_reg[pos_inds] = bboxes2deltas(corr_gt_bboxes, positive_anchors)
+
+    # 3. anchor direction
+    assigned_gt_dir_weights = pos_flag.to(anchors.dtype)
+
+    assigned_gt_dir = torch.zeros_like(assigned_gt_inds)
+    dir_cls_targets = limit_period(corr_gt_bboxes[:, 6], 0, 2 * math.pi)
+    dir_cls_targets = torch.floor(dir_cls_targets / math.pi).long()
+    assigned_gt_dir[pos_inds] = torch.clamp(dir_cls_targets, min=0, max=1)
+
     rt_dict = dict(
-        batched_labels=torch.stack(batched_labels, 0), # (bs, y_l * x_l * 3 * 2)
-        batched_label_weights=torch.stack(batched_label_weights, 0), # (bs, y_l * x_l * 3 * 2)
-        batched_bbox_reg=torch.stack(batched_bbox_reg, 0), # (bs, y_l * x_l * 3 * 2, 7)
-        batched_bbox_reg_weights=torch.stack(batched_bbox_reg_weights, 0), # (bs, y_l * x_l * 3 * 2)
-        batched_dir_labels=torch.stack(batched_dir_labels, 0), # (bs, y_l * x_l * 3 * 2)
-        batched_dir_labels_weights=torch.stack(batched_dir_labels_weights, 0) # (bs, y_l * x_l * 3 * 2)
+        batched_labels=assigned_gt_labels.reshape(batch_size, n_anchors), # (bs, y_l * x_l * 3 * 2)
+        batched_label_weights=assigned_gt_labels_weights.reshape(batch_size, n_anchors), # (bs, y_l * x_l * 3 * 2)
+        batched_bbox_reg=assigned_gt_reg.reshape(batch_size, n_anchors, d5), # (bs, y_l * x_l * 3 * 2, 7)
+        batched_bbox_reg_weights=assigned_gt_reg_weights.reshape(batch_size, n_anchors), # (bs, y_l * x_l * 3 * 2)
+        batched_dir_labels=assigned_gt_dir.reshape(batch_size, n_anchors), # (bs, y_l * x_l * 3 * 2)
+        batched_dir_labels_weights=assigned_gt_dir_weights.reshape(batch_size, n_anchors) # (bs, y_l * x_l * 3 * 2)
     )
 
     return rt_dict
-            
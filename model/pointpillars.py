@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from model.anchors import Anchors, anchor_target, anchors2bboxes
-from ops import Voxelization, nms_cuda
+from ops import Voxelization, batched_nms
 from utils import limit_period
 import math
 
@@ -13,16 +13,23 @@ class PillarLayer(nn.Module):
                                         point_cloud_range=point_cloud_range,
                                         max_num_points=max_num_points,
                                         max_voxels=max_voxels)
+        self.max_num_points = max_num_points
 
     @torch.no_grad()
-    def forward(self, batched_pts):
+    def forward(self, batched_pts, batched_pts_offsets=None):
         '''
         batched_pts: list[tensor], len(batched_pts) = bs
+                     or (n1 + n2 + ... + nb, 1 + c) tensor, batch index first, with batched_pts_offsets (bs + 1, )
         return: 
                pillars: (p1 + p2 + ... + pb, num_points, c), 
                coors_batch: (p1 + p2 + ... + pb, 1 + 3), 
                num_points_per_pillar: (p1 + p2 + ... + pb, ), (b: batch size)
         '''
+        if batched_pts_offsets is not None:
+            # all samples voxelized in one call
+            pillars, coors_batch, npoints_per_pillar = self.voxel_layer.forward_batch(batched_pts[:, 1:], batched_pts_offsets)
+            return pillars, coors_batch.long(), npoints_per_pillar
+
         pillars, coors, npoints_per_pillar = [], [], []
         for i, pts in enumerate(batched_pts):
             voxels_out, coors_out, num_points_per_voxel_out = self.voxel_layer(pts) 
@@ -41,6 +48,46 @@ class PillarLayer(nn.Module):
 
         return pillars, coors_batch, npoints_per_pillar
 
+    @torch.no_grad()
+    def forward_dynamic(self, batched_pts, batched_pts_offsets=None):
+        '''
+        batched_pts: list[tensor], len(batched_pts) = bs
+                     or (n1 + n2 + ... + nb, 1 + c) tensor, batch index first, with batched_pts_offsets (bs + 1, )
+        return:
+               points: (n, c), the points inside the point cloud range,
+               coors_batch: (p1 + p2 + ... + pb, 1 + 3),
+               point_to_pillar: (n, ), the pillar of every point,
+               npoints_per_pillar: (p1 + p2 + ... + pb, )
+        with max_num_points == -1 every point is kept, otherwise as in forward only the first
+        max_num_points points of a pillar are.
+        '''
+        if batched_pts_offsets is None:
+            batched_pts = torch.cat([F.pad(pts, (1, 0), value=i) for i, pts in enumerate(batched_pts)], dim=0)
+        coors = self.voxel_layer.forward_dynamic(batched_pts[:, 1:]).long() # (n1 + n2 + ... + nb, 3)
+        in_range = coors[:, 0] >= 0
+        batched_pts, coors = batched_pts[in_range], coors[in_range]
+
+        # pillars are numbered in (b, z, y, x) order
+        x_l, y_l, z_l = self.voxel_layer.grid_size.tolist()
+        pillar_keys = ((batched_pts[:, 0].long() * z_l + coors[:, 2]) * y_l + coors[:, 1]) * x_l + coors[:, 0]
+        pillar_keys, point_to_pillar, npoints_per_pillar = torch.unique(pillar_keys, return_inverse=True, return_counts=True)
+
+        if self.max_num_points != -1:
+            # rank of every point in its pillar, in point order
+            order = torch.argsort(point_to_pillar, stable=True)
+            first_point = torch.cumsum(npoints_per_pillar, dim=0) - npoints_per_pillar
+            rank = torch.empty_like(order)
+            rank[order] = torch.arange(len(order), device=order.device) - first_point[point_to_pillar[order]]
+            kept = rank < self.max_num_points
+            batched_pts, point_to_pillar = batched_pts[kept], point_to_pillar[kept]
+            npoints_per_pillar = torch.clamp(npoints_per_pillar, max=self.max_num_points)
+
+        coors_batch = torch.stack([pillar_keys // (x_l * y_l * z_l),
+                                   pillar_keys % x_l,
+                                   pillar_keys // x_l % y_l,
+                                   pillar_keys // (x_l * y_l) % z_l], dim=1) # (p1 + p2 + ... + pb, 1 + 3)
+        return batched_pts[:, 1:], coors_batch, point_to_pillar, npoints_per_pillar.int()
+
 
 class PillarEncoder(nn.Module):
     def __init__(self, voxel_size, point_cloud_range, in_channel, out_channel):
@@ -55,11 +102,12 @@ class PillarEncoder(nn.Module):
         self.conv = nn.Conv1d(in_channel, out_channel, 1, bias=False)
         self.bn = nn.BatchNorm1d(out_channel, eps=1e-3, momentum=0.01)
 
-    def forward(self, pillars, coors_batch, npoints_per_pillar):
+    def forward(self, pillars, coors_batch, npoints_per_pillar, batch_size=None):
         '''
         pillars: (p1 + p2 + ... + pb, num_points, c), c = 4
         coors_batch: (p1 + p2 + ... + pb, 1 + 3)
         npoints_per_pillar: (p1 + p2 + ... + pb, )
+        batch_size: int, bs, taken from the last pillar if None
         return:  (bs, out_channel, y_l, x_l)
         '''
         device = pillars.device
@@ -90,21 +138,61 @@ class PillarEncoder(nn.Module):
         pooling_features = torch.max(features, dim=-1)[0] # (p1 + p2 + ... + pb, out_channels)
 
         # 6. pillar scatter
-        batched_canvas = []
-        bs = coors_batch[-1, 0] + 1
-        for i in range(bs):
-            cur_coors_idx = coors_batch[:, 0] == i
-            cur_coors = coors_batch[cur_coors_idx, :]
-            cur_features = pooling_features[cur_coors_idx]
-
-            canvas = torch.zeros((self.x_l, self.y_l, self.out_channel), dtype=torch.float32, device=device)
-            canvas[cur_coors[:, 1], cur_coors[:, 2]] = cur_features
-            canvas = canvas.permute(2, 1, 0).contiguous()
-            batched_canvas.append(canvas)
-        batched_canvas = torch.stack(batched_canvas, dim=0) # (bs, in_channel, self.y_l, self.x_l)
+        return self.scatter(pooling_features, coors_batch, batch_size)
+
+    def scatter(self, pooling_features, coors_batch, batch_size=None):
+        '''
+        pooling_features: (p1 + p2 + ... + pb, out_channel)
+        coors_batch: (p1 + p2 + ... + pb, 1 + 3)
+        return:  (bs, out_channel, y_l, x_l), written straight in this layout
+        '''
+        if batch_size is None:
+            batch_size = int(coors_batch[-1, 0]) + 1
+        batched_canvas = pooling_features.new_zeros((batch_size, self.out_channel, self.y_l * self.x_l))
+        pillar_inds = coors_batch[:, 2] * self.x_l + coors_batch[:, 1] # (p1 + p2 + ... + pb, )
+        batched_canvas[coors_batch[:, 0], :, pillar_inds] = pooling_features
+        batched_canvas = batched_canvas.view(batch_size, self.out_channel, self.y_l, self.x_l) # (bs, out_channel, self.y_l, self.x_l)
         return batched_canvas
 
 
+class DynamicPillarEncoder(PillarEncoder):
+    def forward(self, points, coors_batch, point_to_pillar, npoints_per_pillar, batch_size=None):
+        '''
+        The features of PillarEncoder computed on the flat point list, no padding to max_num_points.
+        points: (n, c), c = 4
+        coors_batch: (p1 + p2 + ... + pb, 1 + 3)
+        point_to_pillar: (n, )
+        npoints_per_pillar: (p1 + p2 + ... + pb, )
+        batch_size: int, bs, taken from the last pillar if None
+        return:  (bs, out_channel, y_l, x_l)
+        '''
+        # 1. calculate offset to the points center (in each pillar)
+        pillar_center = points.new_zeros((len(npoints_per_pillar), 3)).index_add_(0, point_to_pillar, points[:, :3])
+        pillar_center = pillar_center / npoints_per_pillar[:, None] # (p1 + p2 + ... + pb, 3)
+        offset_pt_center = points[:, :3] - pillar_center[point_to_pillar] # (n, 3)
+
+        # 2. calculate offset to the pillar center
+        point_coors = coors_batch[point_to_pillar] # (n, 1 + 3)
+        x_offset_pi_center = points[:, :1] - (point_coors[:, 1:2] * self.vx + self.x_offset) # (n, 1)
+        y_offset_pi_center = points[:, 1:2] - (point_coors[:, 2:3] * self.vy + self.y_offset) # (n, 1)
+
+        # 3. encoder
+        features = torch.cat([points, offset_pt_center, x_offset_pi_center, y_offset_pi_center], dim=-1) # (n, 9)
+        features[:, 0:1] = x_offset_pi_center # tmp
+        features[:, 1:2] = y_offset_pi_center # tmp
+
+        # 4. embedding, the 1x1 conv of PillarEncoder applied point-wise
+        features = F.linear(features, self.conv.weight[:, :, 0])
+        features = F.relu(self.bn(features)) # (n, out_channels)
+
+        # 5. max over the points of every pillar, features are >= 0 after relu
+        pooling_features = features.new_zeros((len(npoints_per_pillar), self.out_channel))
+        pooling_features.scatter_reduce_(0, point_to_pillar[:, None].expand(-1, self.out_channel), features, 'amax') # (p1 + p2 + ... + pb, out_channels)
+
+        # 6. pillar scatter
+        return self.scatter(pooling_features, coors_batch, batch_size)
+
+
 class Backbone(nn.Module):
     def __init__(self, in_channel, out_channels, layer_nums, layer_strides=[2, 2, 2]):
         super().__init__()
@@ -222,9 +310,16 @@ class PointPillars(nn.Module):
                  point_cloud_range=[-74.88, -74.88, -2, 74.88, 74.88, 4],
                  max_num_points=20,
                  max_voxels=(32000, 32000),
-                 painted=False):
+                 painted=False,
+                 dynamic_pillars=False):
+        '''
+        dynamic_pillars: encode the pillars from the flat point list instead of padding every
+                         pillar to max_num_points, max_num_points=-1 then keeps all points
+        '''
         super().__init__()
         self.nclasses = nclasses
+        assert dynamic_pillars or max_num_points != -1, 'max_num_points=-1 needs dynamic_pillars'
+        self.dynamic_pillars = dynamic_pillars
         self.pillar_layer = PillarLayer(voxel_size=voxel_size, 
                                         point_cloud_range=point_cloud_range, 
                                         max_num_points=max_num_points, 
@@ -233,10 +328,11 @@ class PointPillars(nn.Module):
             pillar_channel = 16
         else:
             pillar_channel = 10
-        self.pillar_encoder = PillarEncoder(voxel_size=voxel_size, 
-                                            point_cloud_range=point_cloud_range, 
-                                            in_channel=pillar_channel,
-                                            out_channel=64)
+        pillar_encoder = DynamicPillarEncoder if dynamic_pillars else PillarEncoder
+        self.pillar_encoder = pillar_encoder(voxel_size=voxel_size, 
+                                             point_cloud_range=point_cloud_range, 
+                                             in_channel=pillar_channel,
+                                             out_channel=64)
         self.backbone = Backbone(in_channel=64, 
                                  out_channels=[64, 128, 256], 
                                  layer_nums=[3, 5, 5],
@@ -269,129 +365,148 @@ class PointPillars(nn.Module):
         self.score_thr = 0.1
         self.max_num = 500
 
-    def get_predicted_bboxes_single(self, bbox_cls_pred, bbox_pred, bbox_dir_cls_pred, anchors):
+    def get_predicted_bboxes_single(self, bbox_cls_pred, bbox_pred, bbox_dir_cls_pred, anchors=None):
         '''
         bbox_cls_pred: (n_anchors*3, 248, 216) 
         bbox_pred: (n_anchors*7, 248, 216)
         bbox_dir_cls_pred: (n_anchors*2, 248, 216)
-        anchors: (y_l, x_l, 3, 2, 7)
+        anchors: (y_l, x_l, 3, 2, 7), or None to compute only the selected anchors
         return: 
             bboxes: (k, 7)
             labels: (k, )
             scores: (k, ) 
         '''
-        # 0. pre-process 
-        bbox_cls_pred = bbox_cls_pred.permute(1, 2, 0).reshape(-1, self.nclasses)
-        bbox_pred = bbox_pred.permute(1, 2, 0).reshape(-1, 7)
-        bbox_dir_cls_pred = bbox_dir_cls_pred.permute(1, 2, 0).reshape(-1, 2)
-        anchors = anchors.reshape(-1, 7)
-        
-        bbox_cls_pred = torch.sigmoid(bbox_cls_pred)
-        bbox_dir_cls_pred = torch.max(bbox_dir_cls_pred, dim=1)[1]
+        return self.get_predicted_bboxes(bbox_cls_pred=bbox_cls_pred[None],
+                                         bbox_pred=bbox_pred[None],
+                                         bbox_dir_cls_pred=bbox_dir_cls_pred[None],
+                                         batched_anchors=None if anchors is None else anchors[None])[0]
 
-        # 1. obtain self.nms_pre bboxes based on scores
-        inds = bbox_cls_pred.max(1)[0].topk(self.nms_pre)[1]
-        bbox_cls_pred = bbox_cls_pred[inds]
-        bbox_pred = bbox_pred[inds]
-        bbox_dir_cls_pred = bbox_dir_cls_pred[inds]
-        anchors = anchors[inds]
-
-        # 2. decode predicted offsets to bboxes
-        bbox_pred = anchors2bboxes(anchors, bbox_pred)
-
-        # 3. nms
-        bbox_pred2d_xy = bbox_pred[:, [0, 1]]
-        bbox_pred2d_lw = bbox_pred[:, [3, 4]]
-        bbox_pred2d = torch.cat([bbox_pred2d_xy - bbox_pred2d_lw / 2,
-                                 bbox_pred2d_xy + bbox_pred2d_lw / 2,
-                                 bbox_pred[:, 6:]], dim=-1) # (n_anchors, 5)
-
-        ret_bboxes, ret_labels, ret_scores = [], [], []
-        for i in range(self.nclasses):
-            # 3.1 filter bboxes with scores below self.score_thr
-            cur_bbox_cls_pred = bbox_cls_pred[:, i]
-            score_inds = cur_bbox_cls_pred > self.score_thr
-            if score_inds.sum() == 0:
-                continue
-
-            cur_bbox_cls_pred = cur_bbox_cls_pred[score_inds]
-            cur_bbox_pred2d = bbox_pred2d[score_inds]
-            cur_bbox_pred = bbox_pred[score_inds]
-            cur_bbox_dir_cls_pred = bbox_dir_cls_pred[score_inds]
-            
-            # 3.2 nms core
-            keep_inds = nms_cuda(boxes=cur_bbox_pred2d, 
-                                 scores=cur_bbox_cls_pred, 
-                                 thresh=self.nms_thr, 
-                                 pre_maxsize=None, 
-                                 post_max_size=None)
-
-            cur_bbox_cls_pred = cur_bbox_cls_pred[keep_inds]
-            cur_bbox_pred = cur_bbox_pred[keep_inds]
-            cur_bbox_dir_cls_pred = cur_bbox_dir_cls_pred[keep_inds]
-            cur_bbox_pred[:, -1] = limit_period(cur_bbox_pred[:, -1].detach().cpu(), 1, math.pi).to(cur_bbox_pred) # [-pi, 0]
-            cur_bbox_pred[:, -1] += (1 - cur_bbox_dir_cls_pred) * math.pi
-
-            ret_bboxes.append(cur_bbox_pred)
-            ret_labels.append(torch.zeros_like(cur_bbox_pred[:, 0], dtype=torch.long) + i)
-            ret_scores.append(cur_bbox_cls_pred)
-
-        # 4. filter some bboxes if bboxes number is above self.max_num
-        if len(ret_bboxes) == 0:
-            return {
-            'lidar_bboxes': torch.empty((0, 7)).detach().cpu(),
-            'labels': torch.empty(0).detach().cpu(),
-            'scores': torch.empty(0).detach().cpu()
-            }
-        ret_bboxes = torch.cat(ret_bboxes, 0)
-        ret_labels = torch.cat(ret_labels, 0)
-        ret_scores = torch.cat(ret_scores, 0)
-        if ret_bboxes.size(0) > self.max_num:
-            final_inds = ret_scores.topk(self.max_num)[1]
-            ret_bboxes = ret_bboxes[final_inds]
-            ret_labels = ret_labels[final_inds]
-            ret_scores = ret_scores[final_inds]
-        result = {
-            'lidar_bboxes': ret_bboxes.detach().cpu(),
-            'labels': ret_labels.detach().cpu(),
-            'scores': ret_scores.detach().cpu()
-        }
-        return result
-
-
-    def get_predicted_bboxes(self, bbox_cls_pred, bbox_pred, bbox_dir_cls_pred, batched_anchors):
+    def get_predicted_bboxes(self, bbox_cls_pred, bbox_pred, bbox_dir_cls_pred, batched_anchors=None, to_cpu=True):
         '''
         bbox_cls_pred: (bs, n_anchors*3, 248, 216) 
         bbox_pred: (bs, n_anchors*7, 248, 216)
         bbox_dir_cls_pred: (bs, n_anchors*2, 248, 216)
-        batched_anchors: (bs, y_l, x_l, 3, 2, 7)
+        batched_anchors: (bs, y_l, x_l, 3, 2, 7), or None to compute only the selected anchors
         return: 
             bboxes: [(k1, 7), (k2, 7), ... ]
             labels: [(k1, ), (k2, ), ... ]
             scores: [(k1, ), (k2, ), ... ] 
+        to_cpu: return the results on the host, with one copy at the end
+        The whole batch goes through one nms call. Like the per class nms, the bboxes of a sample
+        are ordered by class and then by score, or only by score if more than self.max_num were left.
         '''
-        results = []
+        # 0. pre-process 
         bs = bbox_cls_pred.size(0)
-        for i in range(bs):
-            result = self.get_predicted_bboxes_single(bbox_cls_pred=bbox_cls_pred[i],
-                                                      bbox_pred=bbox_pred[i], 
-                                                      bbox_dir_cls_pred=bbox_dir_cls_pred[i], 
-                                                      anchors=batched_anchors[i])
-            results.append(result)
+        feature_map_size = bbox_cls_pred.size()[-2:]
+        bbox_cls_pred = bbox_cls_pred.permute(0, 2, 3, 1).reshape(bs, -1, self.nclasses)
+        bbox_pred = bbox_pred.permute(0, 2, 3, 1).reshape(bs, -1, 7)
+        bbox_dir_cls_pred = bbox_dir_cls_pred.permute(0, 2, 3, 1).reshape(bs, -1, 2)
+
+        bbox_cls_pred = torch.sigmoid(bbox_cls_pred)
+        bbox_dir_cls_pred = torch.max(bbox_dir_cls_pred, dim=-1)[1]
+
+        # 1. obtain self.nms_pre bboxes of each sample based on scores
+        inds = bbox_cls_pred.max(-1)[0].topk(self.nms_pre, dim=1)[1] # (bs, nms_pre)
+        batch_inds = torch.arange(bs, device=inds.device)[:, None]
+        bbox_cls_pred = bbox_cls_pred[batch_inds, inds].reshape(-1, self.nclasses)
+        bbox_pred = bbox_pred[batch_inds, inds].reshape(-1, 7)
+        bbox_dir_cls_pred = bbox_dir_cls_pred[batch_inds, inds].reshape(-1)
+        if batched_anchors is None:
+            anchors = self.anchors_generator.get_anchors_by_index(feature_map_size, inds.reshape(-1))
+        else:
+            anchors = batched_anchors.reshape(bs, -1, 7)[batch_inds, inds].reshape(-1, 7)
+
+        # 2. decode predicted offsets to bboxes
+        bbox_pred = anchors2bboxes(anchors, bbox_pred) # (bs*nms_pre, 7)
+
+        # 3. nms
+        bbox_pred2d_xy = bbox_pred[:, [0, 1]]
+        bbox_pred2d_lw = bbox_pred[:, [3, 4]]
+        bbox_pred2d = torch.cat([bbox_pred2d_xy - bbox_pred2d_lw / 2,
+                                 bbox_pred2d_xy + bbox_pred2d_lw / 2,
+                                 bbox_pred[:, 6:]], dim=-1) # (bs*nms_pre, 5)
+
+        # 3.1 (bbox, class) pairs with scores above self.score_thr, the pairs of a sample are padded
+        #     to the largest count of the batch, so nms is not run over the pairs below the threshold.
+        #     the count is the only value read back from the device before the results
+        n_pairs = self.nms_pre * self.nclasses
+        scores = bbox_cls_pred.reshape(bs, n_pairs)
+        labels = torch.arange(n_pairs, device=scores.device) % self.nclasses
+        valid = scores > self.score_thr
+        n_valid = int(valid.sum(1).max())
+        cand_inds = torch.where(valid, scores, -1).sort(dim=1, descending=True, stable=True)[1][:, :n_valid] # (bs, n_valid)
+        cand_valid = valid.gather(1, cand_inds)
+        # the padding pairs get a group of their own so nms never compares them
+        cand_groups = torch.where(cand_valid, labels[cand_inds], -1 - torch.arange(n_valid, device=scores.device))
+
+        # 3.2 nms core, within each class of each sample
+        cand_boxes = bbox_pred2d.reshape(bs, self.nms_pre, 5)[batch_inds, torch.div(cand_inds, self.nclasses, rounding_mode='floor')]
+        cand_keep = batched_nms(boxes=cand_boxes,
+                                scores=scores.gather(1, cand_inds),
+                                idxs=cand_groups,
+                                thresh=self.nms_thr,
+                                return_mask=True) & cand_valid # (bs, n_valid)
+        keep = torch.zeros_like(valid).scatter_(1, cand_inds, cand_keep) # (bs, n_pairs)
+
+        # 4. keep the self.max_num highest scoring bboxes of each sample
+        scores, keep = scores.reshape(-1), keep.reshape(-1)
+        sample_inds = torch.div(torch.arange(bs * n_pairs, device=scores.device), n_pairs, rounding_mode='floor')
+        by_score = scores.sort(descending=True, stable=True)[1]
+        by_score = by_score[sample_inds[by_score].sort(stable=True)[1]]
+        counts = keep.reshape(bs, n_pairs).sum(1)
+        ranks = torch.cumsum(keep[by_score], 0) - 1 - (torch.cumsum(counts, 0) - counts)[sample_inds[by_score]]
+        kept = torch.empty_like(keep)
+        kept[by_score] = keep[by_score] & (ranks < self.max_num)
+
+        # 5. the bboxes of a sample by class and then by score, or only by score if more than
+        #    self.max_num bboxes were left and the highest scoring ones were picked
+        by_class = torch.where(counts > self.max_num, 0, 1)[sample_inds] * labels.repeat(bs)
+        pair_inds = by_score[(by_class + sample_inds * self.nclasses)[by_score].sort(stable=True)[1]]
+        box_inds = torch.div(pair_inds, self.nclasses, rounding_mode='floor')
+        bboxes = bbox_pred[box_inds]
+        bboxes[:, -1] = limit_period(bboxes[:, -1], 1, math.pi) # [-pi, 0]
+        bboxes[:, -1] += (1 - bbox_dir_cls_pred[box_inds]) * math.pi
+        outputs = [bboxes.detach(), pair_inds % self.nclasses, scores[pair_inds].detach(),
+                   kept[pair_inds], kept.reshape(bs, n_pairs).sum(1)]
+
+        # 6. apart from the pair count nothing above waited for the device, the results are copied to the host in one go
+        if to_cpu and bboxes.is_cuda:
+            outputs = [torch.empty(output.size(), dtype=output.dtype, pin_memory=True).copy_(output, non_blocking=True)
+                       for output in outputs]
+            torch.cuda.current_stream(bboxes.device).synchronize()
+        elif to_cpu:
+            outputs = [output.cpu() for output in outputs]
+        bboxes, labels, scores, kept, counts = outputs
+        split = counts.tolist()
+        results = []
+        for ret_bboxes, ret_labels, ret_scores in zip(bboxes[kept].split(split),
+                                                      labels[kept].split(split),
+                                                      scores[kept].split(split)):
+            results.append({
+                'lidar_bboxes': ret_bboxes,
+                'labels': ret_labels,
+                'scores': ret_scores
+            })
         return results
 
-    def forward(self, batched_pts, mode='test', batched_gt_bboxes=None, batched_gt_labels=None):
-        batch_size = len(batched_pts)
-        # batched_pts: list[tensor] -> pillars: (p1 + p2 + ... + pb, num_points, c), 
+    def forward(self, batched_pts, mode='test', batched_gt_bboxes=None, batched_gt_labels=None, batched_pts_offsets=None):
+        batch_size = len(batched_pts) if batched_pts_offsets is None else len(batched_pts_offsets) - 1
+        # batched_pts: list[tensor] or (n1 + n2 + ... + nb, 1 + c) with batched_pts_offsets
+        #                           -> pillars: (p1 + p2 + ... + pb, num_points, c), 
         #                              coors_batch: (p1 + p2 + ... + pb, 1 + 3), 
         #                              num_points_per_pillar: (p1 + p2 + ... + pb, ), (b: batch size)
-        pillars, coors_batch, npoints_per_pillar = self.pillar_layer(batched_pts)
+        if self.dynamic_pillars:
+            # points: (n, c), point_to_pillar: (n, ) -> pillar_features: (bs, out_channel, y_l, x_l)
+            points, coors_batch, point_to_pillar, npoints_per_pillar = self.pillar_layer.forward_dynamic(batched_pts, batched_pts_offsets)
+            pillar_features = self.pillar_encoder(points, coors_batch, point_to_pillar, npoints_per_pillar, batch_size)
+        else:
+            pillars, coors_batch, npoints_per_pillar = self.pillar_layer(batched_pts, batched_pts_offsets)
 
-        # pillars: (p1 + p2 + ... + pb, num_points, c), c = 4
-        # coors_batch: (p1 + p2 + ... + pb, 1 + 3)
-        # npoints_per_pillar: (p1 + p2 + ... + pb, )
-        #                     -> pillar_features: (bs, out_channel, y_l, x_l)
-        pillar_features = self.pillar_encoder(pillars, coors_batch, npoints_per_pillar)
+            # pillars: (p1 + p2 + ... + pb, num_points, c), c = 4
+            # coors_batch: (p1 + p2 + ... + pb, 1 + 3)
+            # npoints_per_pillar: (p1 + p2 + ... + pb, )
+            #                     -> pillar_features: (bs, out_channel, y_l, x_l)
+            pillar_features = self.pillar_encoder(pillars, coors_batch, npoints_per_pillar, batch_size)
 
         # xs:  [(bs, 64, 248, 216), (bs, 128, 124, 108), (bs, 256, 62, 54)]
         xs = self.backbone(pillar_features)
@@ -404,13 +519,10 @@ class PointPillars(nn.Module):
         # bbox_dir_cls_pred: (bs, n_anchors*2, 248, 216)
         bbox_cls_pred, bbox_pred, bbox_dir_cls_pred = self.head(x)
 
-        # anchors
-        device = bbox_cls_pred.device
-        feature_map_size = torch.tensor(list(bbox_cls_pred.size()[-2:]), device=device)
-        anchors = self.anchors_generator.get_multi_anchors(feature_map_size)
-        batched_anchors = [anchors for _ in range(batch_size)]
-
         if mode == 'train':
+            # anchors, built once per feature map size
+            anchors = self.anchors_generator.get_multi_anchors(bbox_cls_pred.size()[-2:], bbox_cls_pred.device)
+            batched_anchors = [anchors for _ in range(batch_size)]
             anchor_target_dict = anchor_target(batched_anchors=batched_anchors, 
                                                batched_gt_bboxes=batched_gt_bboxes, 
                                                batched_gt_labels=batched_gt_labels, 
@@ -419,17 +531,17 @@ class PointPillars(nn.Module):
             
             return bbox_cls_pred, bbox_pred, bbox_dir_cls_pred, anchor_target_dict
         elif mode == 'val':
+            # only the anchors of the top scoring predictions are computed
             results = self.get_predicted_bboxes(bbox_cls_pred=bbox_cls_pred, 
                                                 bbox_pred=bbox_pred, 
-                                                bbox_dir_cls_pred=bbox_dir_cls_pred, 
-                                                batched_anchors=batched_anchors)
+                                                bbox_dir_cls_pred=bbox_dir_cls_pred)
             return results
 
         elif mode == 'test':
+            # only the anchors of the top scoring predictions are computed
             results = self.get_predicted_bboxes(bbox_cls_pred=bbox_cls_pred, 
                                                 bbox_pred=bbox_pred, 
-                                                bbox_dir_cls_pred=bbox_dir_cls_pred, 
-                                                batched_anchors=batched_anchors)
+                                                bbox_dir_cls_pred=bbox_dir_cls_pred)
             return results
         else:
             raise ValueError
@@ -1,2 +1,3 @@
 from .voxel_module import Voxelization
-from .iou3d_module import boxes_iou_bev, nms_cuda, boxes_overlap_bev
\ No newline at end of file
+from .iou3d_module import boxes_iou_bev, nms_cuda, batched_nms, boxes_overlap_bev, \
+    boxes_overlap_bev_aligned, boxes_iou_bev_aligned
@@ -0,0 +1,98 @@
+import argparse
+import os
+import sys
+import time
+import torch
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE))
+
+from ops.iou3d_op import nms_forward
+from ops.iou3d_module import batched_nms
+
+
+def timeit(fn, repeat, cuda=False):
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def random_boxes(batch_size, num_boxes, num_groups, extent, generator):
+    # [x1, y1, x2, y2, ry] boxes of car to pedestrian size, crowded enough to suppress each other
+    centers = torch.rand(batch_size, num_boxes, 2, generator=generator) * extent
+    sizes = torch.rand(batch_size, num_boxes, 2, generator=generator) * 4 + 0.5
+    rotations = (torch.rand(batch_size, num_boxes, 1, generator=generator) - 0.5) * 6.28
+    boxes = torch.cat([centers - sizes / 2, centers + sizes / 2, rotations], dim=-1)
+    scores = torch.rand(batch_size, num_boxes, generator=generator)
+    idxs = torch.randint(0, num_groups, (batch_size, num_boxes), generator=generator)
+    return boxes, scores, idxs
+
+
+def per_group_nms(boxes, scores, idxs, thresh):
+    '''
+    The nms of every sample and group on its own with the nms op, the kept boxes as a mask like
+    batched_nms(..., return_mask=True) gives.
+    '''
+    kept = torch.zeros_like(scores, dtype=torch.bool)
+    for b in range(boxes.size(0)):
+        for idx in torch.unique(idxs[b]):
+            inds = (idxs[b] == idx).nonzero(as_tuple=False).view(-1)
+            order = inds[scores[b, inds].sort(0, descending=True)[1]]
+            keep = torch.zeros(len(order), dtype=torch.long)
+            num_out = nms_forward(boxes[b, order].contiguous(), keep, thresh, boxes.device.index or 0)
+            kept[b, order[keep[:num_out].to(boxes.device)]] = True
+    return kept
+
+
+def main(args):
+    generator = torch.Generator().manual_seed(0)
+    cuda = args.cuda and torch.cuda.is_available()
+    print(f'{args.batch_size} samples, {args.num_groups} groups, torch threads {torch.get_num_threads()}')
+    print(f'{"boxes":>6} {"cpu loop ms":>11} {"cpu batch ms":>12} {"match":>6}' +
+          (f' {"cuda loop ms":>12} {"cuda batch ms":>13} {"cuda loop match":>15} {"cuda batch match":>16}'
+           if cuda else ''))
+    for num_boxes in args.num_boxes:
+        boxes, scores, idxs = random_boxes(args.batch_size, num_boxes, args.num_groups,
+                                           args.extent, generator)
+        def cpu_loop():
+            return per_group_nms(boxes, scores, idxs, args.thresh)
+        def cpu_batch():
+            return batched_nms(boxes, scores, idxs, args.thresh, return_mask=True)
+        cpu_loop_ms = timeit(cpu_loop, args.repeat)
+        cpu_batch_ms = timeit(cpu_batch, args.repeat)
+        ref = cpu_loop()
+        line = f'{num_boxes:>6} {cpu_loop_ms:>11.1f} {cpu_batch_ms:>12.1f} {str(torch.equal(cpu_batch(), ref)):>6}'
+
+        if cuda:
+            # the host reduced nms op per group and the device reduced batched op, both
+            # have to keep the same boxes as the cpu ops
+            cuda_boxes, cuda_scores, cuda_idxs = boxes.cuda(), scores.cuda(), idxs.cuda()
+            def cuda_loop():
+                return per_group_nms(cuda_boxes, cuda_scores, cuda_idxs, args.thresh)
+            def cuda_batch():
+                return batched_nms(cuda_boxes, cuda_scores, cuda_idxs, args.thresh, return_mask=True)
+            cuda_loop_ms = timeit(cuda_loop, args.repeat, cuda=True)
+            cuda_batch_ms = timeit(cuda_batch, args.repeat, cuda=True)
+            cuda_loop_match = torch.equal(cuda_loop().cpu(), ref)
+            cuda_batch_match = torch.equal(cuda_batch().cpu(), ref)
+            line += f' {cuda_loop_ms:>12.1f} {cuda_batch_ms:>13.1f} {str(cuda_loop_match):>15} {str(cuda_batch_match):>16}'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Configuration Parameters')
+    parser.add_argument('--num_boxes', type=int, nargs='*', default=[64, 500, 4096, 12288],
+                        help='boxes per sample')
+    parser.add_argument('--batch_size', type=int, default=4, help='samples in the batched run')
+    parser.add_argument('--num_groups', type=int, default=3, help='groups (classes) per sample')
+    parser.add_argument('--extent', type=float, default=150, help='x/y extent of the box centers')
+    parser.add_argument('--thresh', type=float, default=0.25, help='nms iou threshold')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per setting')
+    parser.add_argument('--cuda', action='store_true', help='also time the cuda ops and check them against the cpu loop')
+    args = parser.parse_args()
+    main(args)
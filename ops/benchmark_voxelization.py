@@ -0,0 +1,133 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import torch
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE))
+
+from ops.voxel_module import points_to_voxel, hard_voxelize, hard_voxelize_batch
+
+
+def timeit(fn, repeat, cuda=False):
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def random_points(num_points, point_cloud_range, num_features, rng):
+    low = np.array(point_cloud_range[:3]) - 2
+    high = np.array(point_cloud_range[3:]) + 2
+    points = rng.random((num_points, num_features)).astype(np.float32)
+    points[:, :3] = points[:, :3] * (high - low) + low
+    return points
+
+
+def main(args):
+    rng = np.random.default_rng(0)
+    point_cloud_range = args.point_cloud_range
+    batch = [random_points(args.num_points, point_cloud_range, args.num_features, rng)
+             for _ in range(args.batch_size)]
+    offsets = torch.from_numpy(np.cumsum([0] + [len(pts) for pts in batch]))
+    batched_pts = torch.from_numpy(np.concatenate(batch))
+    points = torch.from_numpy(batch[0])
+    max_voxels, max_points = args.max_voxels, args.max_num_points
+
+    cuda = args.cuda and torch.cuda.is_available()
+    print(f'{args.num_points} points, {args.batch_size} samples, torch threads {torch.get_num_threads()}')
+    print(f'{"voxel size":>18} {"grid":>16} {"dense map MB":>12} {"numba ms":>9} {"cpu ms":>8} '
+          f'{"numba x bs ms":>13} {"cpu batch ms":>12} {"match":>6}' +
+          (f' {"cuda x bs ms":>12} {"cuda batch ms":>13} {"cuda match":>10}' if cuda else ''))
+    for voxel_size in args.voxel_sizes:
+        voxel_size = [voxel_size, voxel_size, args.voxel_size_z]
+        grid_size = np.round((np.array(point_cloud_range[3:]) - point_cloud_range[:3]) / voxel_size).astype(np.int64)
+
+        voxels = points.new_zeros((max_voxels, max_points, points.size(1)))
+        coors = points.new_zeros((max_voxels, 3), dtype=torch.int)
+        num_points_per_voxel = points.new_zeros((max_voxels, ), dtype=torch.int)
+        def cpu_op():
+            num_points_per_voxel.zero_()
+            return hard_voxelize(points, voxels, coors, num_points_per_voxel, voxel_size,
+                                 point_cloud_range, max_points, max_voxels, 3, True)
+
+        batch_voxels = batched_pts.new_empty((args.batch_size * max_voxels, max_points, batched_pts.size(1)))
+        batch_coors = batched_pts.new_empty((args.batch_size * max_voxels, 1 + 3), dtype=torch.int)
+        batch_num_points = batched_pts.new_empty((args.batch_size * max_voxels, ), dtype=torch.int)
+        def cpu_batch_op():
+            return hard_voxelize_batch(batched_pts, offsets, batch_voxels, batch_coors, batch_num_points,
+                                       voxel_size, point_cloud_range, max_points, max_voxels, 3)
+
+        numba_ms = timeit(lambda: points_to_voxel(batch[0], voxel_size, point_cloud_range, max_points,
+                                                  reverse_index=False, max_voxels=max_voxels), args.repeat)
+        cpu_ms = timeit(cpu_op, args.repeat)
+        numba_batch_ms = timeit(lambda: [points_to_voxel(pts, voxel_size, point_cloud_range, max_points,
+                                                         reverse_index=False, max_voxels=max_voxels)
+                                         for pts in batch], args.repeat)
+        cpu_batch_ms = timeit(cpu_batch_op, args.repeat)
+
+        # both follow points_to_voxel, so the batched output must be the same
+        voxel_num = cpu_batch_op()
+        ref = [points_to_voxel(pts, voxel_size, point_cloud_range, max_points,
+                               reverse_index=False, max_voxels=max_voxels) for pts in batch]
+        match = voxel_num == sum(len(item[0]) for item in ref) and \
+            np.array_equal(batch_voxels[:voxel_num].numpy(), np.concatenate([item[0] for item in ref])) and \
+            np.array_equal(batch_coors[:voxel_num, 1:].numpy(), np.concatenate([item[1] for item in ref]))
+
+        line = f'{str(voxel_size):>18} {str(grid_size.tolist()):>16} {grid_size.prod() * 4 / 2 ** 20:>12.1f} ' \
+               f'{numba_ms:>9.1f} {cpu_ms:>8.1f} {numba_batch_ms:>13.1f} {cpu_batch_ms:>12.1f} {str(match):>6}'
+
+        if cuda:
+            # the per-sample cuda op against the batched one, both from device memory
+            cuda_batch = [torch.from_numpy(pts).cuda() for pts in batch]
+            cuda_pts, cuda_offsets = batched_pts.cuda(), offsets.cuda()
+            cuda_voxels = cuda_pts.new_zeros((max_voxels, max_points, cuda_pts.size(1)))
+            cuda_coors = cuda_pts.new_zeros((max_voxels, 3), dtype=torch.int)
+            cuda_num_points = cuda_pts.new_zeros((max_voxels, ), dtype=torch.int)
+            def cuda_op():
+                for pts in cuda_batch:
+                    cuda_num_points.zero_()
+                    hard_voxelize(pts, cuda_voxels, cuda_coors, cuda_num_points, voxel_size,
+                                  point_cloud_range, max_points, max_voxels, 3, True)
+            cuda_batch_voxels = cuda_pts.new_zeros((args.batch_size * max_voxels, max_points, cuda_pts.size(1)))
+            cuda_batch_coors = cuda_pts.new_zeros((args.batch_size * max_voxels, 1 + 3), dtype=torch.int)
+            cuda_batch_num_points = cuda_pts.new_zeros((args.batch_size * max_voxels, ), dtype=torch.int)
+            def cuda_batch_op():
+                # the outputs have to be zero like in Voxelization.forward_batch
+                cuda_batch_voxels.zero_()
+                cuda_batch_num_points.zero_()
+                return hard_voxelize_batch(cuda_pts, cuda_offsets, cuda_batch_voxels, cuda_batch_coors,
+                                           cuda_batch_num_points, voxel_size, point_cloud_range, max_points, max_voxels, 3)
+            cuda_ms = timeit(cuda_op, args.repeat, cuda=True)
+            cuda_batch_ms = timeit(cuda_batch_op, args.repeat, cuda=True)
+            cuda_voxel_num = cuda_batch_op()
+            cuda_match = cuda_voxel_num == voxel_num and \
+                torch.equal(cuda_batch_voxels[:voxel_num].cpu(), batch_voxels[:voxel_num]) and \
+                torch.equal(cuda_batch_coors[:voxel_num].cpu(), batch_coors[:voxel_num]) and \
+                torch.equal(cuda_batch_num_points[:voxel_num].cpu(), batch_num_points[:voxel_num])
+            line += f' {cuda_ms:>12.1f} {cuda_batch_ms:>13.1f} {str(cuda_match):>10}'
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Configuration Parameters')
+    parser.add_argument('--num_points', type=int, default=180000, help='points per sample')
+    parser.add_argument('--num_features', type=int, default=5, help='features per point')
+    parser.add_argument('--batch_size', type=int, default=4, help='samples in the batched run')
+    parser.add_argument('--voxel_sizes', type=float, nargs='*', default=[0.32, 0.16, 0.08, 0.04],
+                        help='x/y voxel sizes to benchmark')
+    parser.add_argument('--voxel_size_z', type=float, default=6, help='z voxel size')
+    parser.add_argument('--point_cloud_range', type=float, nargs=6,
+                        default=[-74.88, -74.88, -2, 74.88, 74.88, 4], help='x/y/z min and max')
+    parser.add_argument('--max_num_points', type=int, default=20, help='max points per voxel')
+    parser.add_argument('--max_voxels', type=int, default=32000, help='max voxels per sample')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per setting')
+    parser.add_argument('--cuda', action='store_true', help='also time the cuda ops and check the batched one against the cpu op')
+    args = parser.parse_args()
+    main(args)
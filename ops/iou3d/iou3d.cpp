@@ -7,14 +7,30 @@ Written by Shaoshuai Shi
 All Rights Reserved 2019-2020.
 */
 
-#include <cuda.h>
-#include <cuda_runtime_api.h>
 #include <torch/extension.h>
 #include <torch/serialize/tensor.h>
 
 #include <cstdint>
 #include <vector>
 
+int boxes_overlap_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                          at::Tensor ans_overlap);
+int boxes_iou_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                      at::Tensor ans_iou);
+int boxes_overlap_bev_aligned_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                                  at::Tensor ans_overlap);
+int boxes_iou_bev_aligned_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                              at::Tensor ans_iou);
+int nms_cpu(at::Tensor boxes, at::Tensor keep, float nms_overlap_thresh);
+int batched_nms_cpu(at::Tensor boxes, at::Tensor idxs, at::Tensor keep,
+                    float nms_overlap_thresh);
+int nms_normal_cpu(at::Tensor boxes, at::Tensor keep,
+                   float nms_overlap_thresh);
+
+#ifdef WITH_CUDA
+#include <cuda.h>
+#include <cuda_runtime_api.h>
+
 #define CHECK_CUDA(x) \
   TORCH_CHECK(x.device().is_cuda(), #x, " must be a CUDAtensor ")
 #define CHECK_CONTIGUOUS(x) \
@@ -43,8 +59,15 @@ void boxesoverlapLauncher(const int num_a, const float *boxes_a,
                           float *ans_overlap);
 void boxesioubevLauncher(const int num_a, const float *boxes_a, const int num_b,
                          const float *boxes_b, float *ans_iou);
-void nmsLauncher(const float *boxes, unsigned long long *mask, int boxes_num,
-                 float nms_overlap_thresh);
+void boxesoverlapAlignedLauncher(const int num, const float *boxes_a,
+                                 const float *boxes_b, float *ans_overlap);
+void boxesioubevAlignedLauncher(const int num, const float *boxes_a,
+                                const float *boxes_b, float *ans_iou);
+void nmsLauncher(const float *boxes, const int64_t *idxs,
+                 unsigned long long *mask, int boxes_num,
+                 float nms_overlap_thresh, int batch_size = 1);
+void nmsKeepLauncher(const unsigned long long *mask, int boxes_num,
+                     bool *keep, int batch_size = 1);
 void nmsNormalLauncher(const float *boxes, unsigned long long *mask,
                        int boxes_num, float nms_overlap_thresh);
 
@@ -93,6 +116,40 @@ int boxes_iou_bev_gpu(at::Tensor boxes_a, at::Tensor boxes_b,
   return 1;
 }
 
+int boxes_overlap_bev_aligned_gpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                                  at::Tensor ans_overlap) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (N, 5)
+  // params ans_overlap: (N), overlap of boxes_a[i] and boxes_b[i]
+
+  CHECK_INPUT(boxes_a);
+  CHECK_INPUT(boxes_b);
+  CHECK_INPUT(ans_overlap);
+
+  boxesoverlapAlignedLauncher(boxes_a.size(0), boxes_a.data_ptr<float>(),
+                              boxes_b.data_ptr<float>(),
+                              ans_overlap.data_ptr<float>());
+
+  return 1;
+}
+
+int boxes_iou_bev_aligned_gpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                              at::Tensor ans_iou) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (N, 5)
+  // params ans_iou: (N), iou of boxes_a[i] and boxes_b[i]
+
+  CHECK_INPUT(boxes_a);
+  CHECK_INPUT(boxes_b);
+  CHECK_INPUT(ans_iou);
+
+  boxesioubevAlignedLauncher(boxes_a.size(0), boxes_a.data_ptr<float>(),
+                             boxes_b.data_ptr<float>(),
+                             ans_iou.data_ptr<float>());
+
+  return 1;
+}
+
 int nms_gpu(at::Tensor boxes, at::Tensor keep,
 	    float nms_overlap_thresh, int device_id) {
   // params boxes: (N, 5) [x1, y1, x2, y2, ry]
@@ -111,7 +168,7 @@ int nms_gpu(at::Tensor boxes, at::Tensor keep,
   unsigned long long *mask_data = NULL;
   CHECK_ERROR(cudaMalloc((void **)&mask_data,
                          boxes_num * col_blocks * sizeof(unsigned long long)));
-  nmsLauncher(boxes_data, mask_data, boxes_num, nms_overlap_thresh);
+  nmsLauncher(boxes_data, NULL, mask_data, boxes_num, nms_overlap_thresh);
 
   // unsigned long long mask_cpu[boxes_num * col_blocks];
   // unsigned long long *mask_cpu = new unsigned long long [boxes_num *
@@ -147,6 +204,35 @@ int nms_gpu(at::Tensor boxes, at::Tensor keep,
   return num_to_keep;
 }
 
+int batched_nms_gpu(at::Tensor boxes, at::Tensor idxs, at::Tensor keep,
+                    float nms_overlap_thresh, int device_id) {
+  // params boxes: (B, N, 5) [x1, y1, x2, y2, ry]
+  // params idxs: (B, N), boxes only suppress boxes of the same batch and idx
+  // params keep: (B, N) bool on the device of the boxes
+
+  // unlike nms_gpu the mask is reduced on the device, nothing is copied to
+  // the host and the mask comes from the caching allocator, so there is no
+  // synchronization with the host
+  CHECK_INPUT(boxes);
+  CHECK_INPUT(idxs);
+  CHECK_INPUT(keep);
+  cudaSetDevice(device_id);
+
+  int batch_size = boxes.size(0);
+  int boxes_num = boxes.size(1);
+  const int col_blocks = DIVUP(boxes_num, THREADS_PER_BLOCK_NMS);
+  at::Tensor mask = at::empty({batch_size, boxes_num, col_blocks},
+                              boxes.options().dtype(at::kLong));
+  unsigned long long *mask_data =
+      reinterpret_cast<unsigned long long *>(mask.data_ptr<int64_t>());
+
+  nmsLauncher(boxes.data_ptr<float>(), idxs.data_ptr<int64_t>(), mask_data,
+              boxes_num, nms_overlap_thresh, batch_size);
+  nmsKeepLauncher(mask_data, boxes_num, keep.data_ptr<bool>(), batch_size);
+
+  return 1;
+}
+
 int nms_normal_gpu(at::Tensor boxes, at::Tensor keep,
                    float nms_overlap_thresh, int device_id) {
   // params boxes: (N, 5) [x1, y1, x2, y2, ry]
@@ -201,10 +287,103 @@ int nms_normal_gpu(at::Tensor boxes, at::Tensor keep,
   return num_to_keep;
 }
 
+#endif
+
+// Interface for Python, dispatch on the device of the boxes
+int boxes_overlap_bev_forward(at::Tensor boxes_a, at::Tensor boxes_b,
+                              at::Tensor ans_overlap) {
+  if (boxes_a.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return boxes_overlap_bev_gpu(boxes_a, boxes_b, ans_overlap);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return boxes_overlap_bev_cpu(boxes_a, boxes_b, ans_overlap);
+}
+
+int boxes_iou_bev_forward(at::Tensor boxes_a, at::Tensor boxes_b,
+                          at::Tensor ans_iou) {
+  if (boxes_a.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return boxes_iou_bev_gpu(boxes_a, boxes_b, ans_iou);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return boxes_iou_bev_cpu(boxes_a, boxes_b, ans_iou);
+}
+
+int boxes_overlap_bev_aligned_forward(at::Tensor boxes_a, at::Tensor boxes_b,
+                                      at::Tensor ans_overlap) {
+  if (boxes_a.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return boxes_overlap_bev_aligned_gpu(boxes_a, boxes_b, ans_overlap);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return boxes_overlap_bev_aligned_cpu(boxes_a, boxes_b, ans_overlap);
+}
+
+int boxes_iou_bev_aligned_forward(at::Tensor boxes_a, at::Tensor boxes_b,
+                                  at::Tensor ans_iou) {
+  if (boxes_a.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return boxes_iou_bev_aligned_gpu(boxes_a, boxes_b, ans_iou);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return boxes_iou_bev_aligned_cpu(boxes_a, boxes_b, ans_iou);
+}
+
+int nms_forward(at::Tensor boxes, at::Tensor keep, float nms_overlap_thresh,
+                int device_id) {
+  if (boxes.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return nms_gpu(boxes, keep, nms_overlap_thresh, device_id);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return nms_cpu(boxes, keep, nms_overlap_thresh);
+}
+
+int batched_nms_forward(at::Tensor boxes, at::Tensor idxs, at::Tensor keep,
+                        float nms_overlap_thresh, int device_id) {
+  if (boxes.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return batched_nms_gpu(boxes, idxs, keep, nms_overlap_thresh, device_id);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return batched_nms_cpu(boxes, idxs, keep, nms_overlap_thresh);
+}
+
+int nms_normal_forward(at::Tensor boxes, at::Tensor keep,
+                       float nms_overlap_thresh, int device_id) {
+  if (boxes.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return nms_normal_gpu(boxes, keep, nms_overlap_thresh, device_id);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return nms_normal_cpu(boxes, keep, nms_overlap_thresh);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
-  m.def("boxes_overlap_bev_gpu", &boxes_overlap_bev_gpu,
+  m.def("boxes_overlap_bev_forward", &boxes_overlap_bev_forward,
         "oriented boxes overlap");
-  m.def("boxes_iou_bev_gpu", &boxes_iou_bev_gpu, "oriented boxes iou");
-  m.def("nms_gpu", &nms_gpu, "oriented nms gpu");
-  m.def("nms_normal_gpu", &nms_normal_gpu, "nms gpu");
+  m.def("boxes_iou_bev_forward", &boxes_iou_bev_forward, "oriented boxes iou");
+  m.def("boxes_overlap_bev_aligned_forward", &boxes_overlap_bev_aligned_forward,
+        "oriented boxes overlap of aligned pairs");
+  m.def("boxes_iou_bev_aligned_forward", &boxes_iou_bev_aligned_forward,
+        "oriented boxes iou of aligned pairs");
+  m.def("nms_forward", &nms_forward, "oriented nms");
+  m.def("batched_nms_forward", &batched_nms_forward,
+        "oriented nms within the boxes of the same idx");
+  m.def("nms_normal_forward", &nms_normal_forward, "nms");
 }
@@ -0,0 +1,436 @@
+// CPU version of iou3d_kernel.cu, the box geometry is the same
+
+#include <torch/extension.h>
+
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <vector>
+
+#define CHECK_CPU(x) \
+  TORCH_CHECK(x.device().is_cpu(), #x, " must be a CPU tensor ")
+#define CHECK_CONTIGUOUS(x) \
+  TORCH_CHECK(x.is_contiguous(), #x, " must be contiguous ")
+#define CHECK_INPUT(x) \
+  CHECK_CPU(x);        \
+  CHECK_CONTIGUOUS(x)
+
+namespace {
+
+const float EPS = 1e-8;
+// below this many boxes nms runs on one thread, the barrier after every kept
+// box costs more than the ious it splits
+const int kMinParallelNmsBoxes = 512;
+struct Point {
+  float x, y;
+  Point() {}
+  Point(double _x, double _y) { x = _x, y = _y; }
+
+  void set(float _x, float _y) {
+    x = _x;
+    y = _y;
+  }
+
+  Point operator+(const Point &b) const { return Point(x + b.x, y + b.y); }
+
+  Point operator-(const Point &b) const { return Point(x - b.x, y - b.y); }
+};
+
+inline float cross(const Point &a, const Point &b) {
+  return a.x * b.y - a.y * b.x;
+}
+
+inline float cross(const Point &p1, const Point &p2, const Point &p0) {
+  return (p1.x - p0.x) * (p2.y - p0.y) - (p2.x - p0.x) * (p1.y - p0.y);
+}
+
+inline int check_rect_cross(const Point &p1, const Point &p2, const Point &q1,
+                            const Point &q2) {
+  int ret = std::min(p1.x, p2.x) <= std::max(q1.x, q2.x) &&
+            std::min(q1.x, q2.x) <= std::max(p1.x, p2.x) &&
+            std::min(p1.y, p2.y) <= std::max(q1.y, q2.y) &&
+            std::min(q1.y, q2.y) <= std::max(p1.y, p2.y);
+  return ret;
+}
+
+inline int check_in_box2d(const float *box, const Point &p) {
+  // params: box (5) [x1, y1, x2, y2, angle]
+  const float MARGIN = 1e-5;
+
+  float center_x = (box[0] + box[2]) / 2;
+  float center_y = (box[1] + box[3]) / 2;
+  float angle_cos = cosf(-box[4]),
+        angle_sin =
+            sinf(-box[4]);  // rotate the point in the opposite direction of box
+  float rot_x =
+      (p.x - center_x) * angle_cos + (p.y - center_y) * angle_sin + center_x;
+  float rot_y =
+      -(p.x - center_x) * angle_sin + (p.y - center_y) * angle_cos + center_y;
+  return (rot_x > box[0] - MARGIN && rot_x < box[2] + MARGIN &&
+          rot_y > box[1] - MARGIN && rot_y < box[3] + MARGIN);
+}
+
+inline int intersection(const Point &p1, const Point &p0, const Point &q1,
+                        const Point &q0, Point &ans) {
+  // fast exclusion
+  if (check_rect_cross(p0, p1, q0, q1) == 0) return 0;
+
+  // check cross standing
+  float s1 = cross(q0, p1, p0);
+  float s2 = cross(p1, q1, p0);
+  float s3 = cross(p0, q1, q0);
+  float s4 = cross(q1, p1, q0);
+
+  if (!(s1 * s2 > 0 && s3 * s4 > 0)) return 0;
+
+  // calculate intersection of two lines
+  float s5 = cross(q1, p1, p0);
+  if (fabs(s5 - s1) > EPS) {
+    ans.x = (s5 * q0.x - s1 * q1.x) / (s5 - s1);
+    ans.y = (s5 * q0.y - s1 * q1.y) / (s5 - s1);
+
+  } else {
+    float a0 = p0.y - p1.y, b0 = p1.x - p0.x, c0 = p0.x * p1.y - p1.x * p0.y;
+    float a1 = q0.y - q1.y, b1 = q1.x - q0.x, c1 = q0.x * q1.y - q1.x * q0.y;
+    float D = a0 * b1 - a1 * b0;
+
+    ans.x = (b0 * c1 - b1 * c0) / D;
+    ans.y = (a1 * c0 - a0 * c1) / D;
+  }
+
+  return 1;
+}
+
+inline void rotate_around_center(const Point &center, const float angle_cos,
+                                 const float angle_sin, Point &p) {
+  float new_x =
+      (p.x - center.x) * angle_cos + (p.y - center.y) * angle_sin + center.x;
+  float new_y =
+      -(p.x - center.x) * angle_sin + (p.y - center.y) * angle_cos + center.y;
+  p.set(new_x, new_y);
+}
+
+inline int point_cmp(const Point &a, const Point &b, const Point &center) {
+  return atan2f(a.y - center.y, a.x - center.x) >
+         atan2f(b.y - center.y, b.x - center.x);
+}
+
+inline float box_overlap(const float *box_a, const float *box_b) {
+  // params: box_a (5) [x1, y1, x2, y2, angle]
+  // params: box_b (5) [x1, y1, x2, y2, angle]
+
+  float a_x1 = box_a[0], a_y1 = box_a[1], a_x2 = box_a[2], a_y2 = box_a[3],
+        a_angle = box_a[4];
+  float b_x1 = box_b[0], b_y1 = box_b[1], b_x2 = box_b[2], b_y2 = box_b[3],
+        b_angle = box_b[4];
+
+  Point center_a((a_x1 + a_x2) / 2, (a_y1 + a_y2) / 2);
+  Point center_b((b_x1 + b_x2) / 2, (b_y1 + b_y2) / 2);
+
+  Point box_a_corners[5];
+  box_a_corners[0].set(a_x1, a_y1);
+  box_a_corners[1].set(a_x2, a_y1);
+  box_a_corners[2].set(a_x2, a_y2);
+  box_a_corners[3].set(a_x1, a_y2);
+
+  Point box_b_corners[5];
+  box_b_corners[0].set(b_x1, b_y1);
+  box_b_corners[1].set(b_x2, b_y1);
+  box_b_corners[2].set(b_x2, b_y2);
+  box_b_corners[3].set(b_x1, b_y2);
+
+  // get oriented corners
+  float a_angle_cos = cosf(a_angle), a_angle_sin = sinf(a_angle);
+  float b_angle_cos = cosf(b_angle), b_angle_sin = sinf(b_angle);
+
+  for (int k = 0; k < 4; k++) {
+    rotate_around_center(center_a, a_angle_cos, a_angle_sin, box_a_corners[k]);
+    rotate_around_center(center_b, b_angle_cos, b_angle_sin, box_b_corners[k]);
+  }
+
+  box_a_corners[4] = box_a_corners[0];
+  box_b_corners[4] = box_b_corners[0];
+
+  // get intersection of lines
+  Point cross_points[16];
+  Point poly_center;
+  int cnt = 0, flag = 0;
+
+  poly_center.set(0, 0);
+  for (int i = 0; i < 4; i++) {
+    for (int j = 0; j < 4; j++) {
+      flag = intersection(box_a_corners[i + 1], box_a_corners[i],
+                          box_b_corners[j + 1], box_b_corners[j],
+                          cross_points[cnt]);
+      if (flag) {
+        poly_center = poly_center + cross_points[cnt];
+        cnt++;
+      }
+    }
+  }
+
+  // check corners
+  for (int k = 0; k < 4; k++) {
+    if (check_in_box2d(box_a, box_b_corners[k])) {
+      poly_center = poly_center + box_b_corners[k];
+      cross_points[cnt] = box_b_corners[k];
+      cnt++;
+    }
+    if (check_in_box2d(box_b, box_a_corners[k])) {
+      poly_center = poly_center + box_a_corners[k];
+      cross_points[cnt] = box_a_corners[k];
+      cnt++;
+    }
+  }
+
+  poly_center.x /= cnt;
+  poly_center.y /= cnt;
+
+  // sort the points of polygon
+  Point temp;
+  for (int j = 0; j < cnt - 1; j++) {
+    for (int i = 0; i < cnt - j - 1; i++) {
+      if (point_cmp(cross_points[i], cross_points[i + 1], poly_center)) {
+        temp = cross_points[i];
+        cross_points[i] = cross_points[i + 1];
+        cross_points[i + 1] = temp;
+      }
+    }
+  }
+
+  // get the overlap areas
+  float area = 0;
+  for (int k = 0; k < cnt - 1; k++) {
+    area += cross(cross_points[k] - cross_points[0],
+                  cross_points[k + 1] - cross_points[0]);
+  }
+
+  return fabs(area) / 2.0;
+}
+
+inline float iou_bev(const float *box_a, const float *box_b) {
+  // params: box_a (5) [x1, y1, x2, y2, angle]
+  // params: box_b (5) [x1, y1, x2, y2, angle]
+  float sa = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1]);
+  float sb = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1]);
+  float s_overlap = box_overlap(box_a, box_b);
+  return s_overlap / std::max(sa + sb - s_overlap, EPS);
+}
+
+inline float iou_normal(float const *const a, float const *const b) {
+  float left = std::max(a[0], b[0]), right = std::min(a[2], b[2]);
+  float top = std::max(a[1], b[1]), bottom = std::min(a[3], b[3]);
+  float width = std::max(right - left, 0.f), height = std::max(bottom - top, 0.f);
+  float interS = width * height;
+  float Sa = (a[2] - a[0]) * (a[3] - a[1]);
+  float Sb = (b[2] - b[0]) * (b[3] - b[1]);
+  return interS / std::max(Sa + Sb - interS, EPS);
+}
+
+// greedy nms over the boxes sorted by score, a box is kept if no kept box
+// before it overlaps it by more than the threshold, as the mask of the cuda
+// version gives. one parallel region runs the whole greedy loop, every thread
+// walks the same kept boxes and suppresses its share of the later boxes, so
+// the threads are started once and not for every kept box
+template <float (*iou)(const float *, const float *)>
+int nms_kernel(const float *boxes, int64_t *keep_data, const int boxes_num,
+               const float nms_overlap_thresh) {
+  std::vector<char> removed(boxes_num, 0);
+  int num_to_keep = 0;
+#pragma omp parallel if (boxes_num >= kMinParallelNmsBoxes)
+  for (int i = 0; i < boxes_num; i++) {
+    // removed[i] is final, the barrier of the loop below ran after the last
+    // write to it
+    if (removed[i]) continue;
+#pragma omp single nowait
+    keep_data[num_to_keep++] = i;
+    const float *cur_box = boxes + i * 5;
+#pragma omp for schedule(static)
+    for (int j = i + 1; j < boxes_num; j++) {
+      if (!removed[j] && iou(cur_box, boxes + j * 5) > nms_overlap_thresh) {
+        removed[j] = 1;
+      }
+    }
+  }
+  return num_to_keep;
+}
+
+// the same within each batch and idx, the groups are independent so they run
+// in parallel and a box is never compared with the boxes of other groups
+template <float (*iou)(const float *, const float *)>
+void batched_nms_kernel(const float *boxes, const int64_t *idxs,
+                        bool *keep_data, const int batch_size,
+                        const int boxes_num, const float nms_overlap_thresh) {
+  // boxes of a group in score order
+  const int total_num = batch_size * boxes_num;
+  auto group_less = [idxs, boxes_num](int a, int b) {
+    return a / boxes_num < b / boxes_num ||
+           (a / boxes_num == b / boxes_num && idxs[a] < idxs[b]);
+  };
+  std::vector<int> order(total_num);
+  for (int i = 0; i < total_num; i++) order[i] = i;
+  std::stable_sort(order.begin(), order.end(), group_less);
+  std::vector<int> group_starts;
+  for (int i = 0; i < total_num; i++) {
+    if (i == 0 || group_less(order[i - 1], order[i])) group_starts.push_back(i);
+  }
+  group_starts.push_back(total_num);
+
+  std::fill(keep_data, keep_data + total_num, false);
+  const int num_groups = group_starts.size() - 1;
+#pragma omp parallel for schedule(dynamic)
+  for (int g = 0; g < num_groups; g++) {
+    const int start = group_starts[g], end = group_starts[g + 1];
+    std::vector<char> removed(end - start, 0);
+    for (int i = start; i < end; i++) {
+      if (removed[i - start]) continue;
+      keep_data[order[i]] = true;
+      const float *cur_box = boxes + order[i] * 5;
+      for (int j = i + 1; j < end; j++) {
+        if (!removed[j - start] &&
+            iou(cur_box, boxes + order[j] * 5) > nms_overlap_thresh) {
+          removed[j - start] = 1;
+        }
+      }
+    }
+  }
+}
+
+// pairwise over the rows, box i of a with box i of b
+template <float (*fn)(const float *, const float *)>
+void aligned_kernel(const float *boxes_a, const float *boxes_b, float *ans,
+                    const int64_t num) {
+#pragma omp parallel for schedule(static)
+  for (int64_t i = 0; i < num; i++) {
+    ans[i] = fn(boxes_a + i * 5, boxes_b + i * 5);
+  }
+}
+
+}  // namespace
+
+int boxes_overlap_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                          at::Tensor ans_overlap) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (M, 5)
+  // params ans_overlap: (N, M)
+
+  CHECK_INPUT(boxes_a);
+  CHECK_INPUT(boxes_b);
+  CHECK_INPUT(ans_overlap);
+
+  int num_a = boxes_a.size(0);
+  int num_b = boxes_b.size(0);
+
+  const float *boxes_a_data = boxes_a.data_ptr<float>();
+  const float *boxes_b_data = boxes_b.data_ptr<float>();
+  float *ans_overlap_data = ans_overlap.data_ptr<float>();
+
+#pragma omp parallel for schedule(static)
+  for (int a_idx = 0; a_idx < num_a; a_idx++) {
+    for (int b_idx = 0; b_idx < num_b; b_idx++) {
+      ans_overlap_data[(int64_t)a_idx * num_b + b_idx] =
+          box_overlap(boxes_a_data + a_idx * 5, boxes_b_data + b_idx * 5);
+    }
+  }
+
+  return 1;
+}
+
+int boxes_iou_bev_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                      at::Tensor ans_iou) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (M, 5)
+  // params ans_overlap: (N, M)
+
+  CHECK_INPUT(boxes_a);
+  CHECK_INPUT(boxes_b);
+  CHECK_INPUT(ans_iou);
+
+  int num_a = boxes_a.size(0);
+  int num_b = boxes_b.size(0);
+
+  const float *boxes_a_data = boxes_a.data_ptr<float>();
+  const float *boxes_b_data = boxes_b.data_ptr<float>();
+  float *ans_iou_data = ans_iou.data_ptr<float>();
+
+#pragma omp parallel for schedule(static)
+  for (int a_idx = 0; a_idx < num_a; a_idx++) {
+    for (int b_idx = 0; b_idx < num_b; b_idx++) {
+      ans_iou_data[(int64_t)a_idx * num_b + b_idx] =
+          iou_bev(boxes_a_data + a_idx * 5, boxes_b_data + b_idx * 5);
+    }
+  }
+
+  return 1;
+}
+
+int boxes_overlap_bev_aligned_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                                  at::Tensor ans_overlap) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (N, 5)
+  // params ans_overlap: (N), overlap of boxes_a[i] and boxes_b[i]
+
+  CHECK_INPUT(boxes_a);
+  CHECK_INPUT(boxes_b);
+  CHECK_INPUT(ans_overlap);
+
+  aligned_kernel<box_overlap>(boxes_a.data_ptr<float>(),
+                              boxes_b.data_ptr<float>(),
+                              ans_overlap.data_ptr<float>(), boxes_a.size(0));
+  return 1;
+}
+
+int boxes_iou_bev_aligned_cpu(at::Tensor boxes_a, at::Tensor boxes_b,
+                              at::Tensor ans_iou) {
+  // params boxes_a: (N, 5) [x1, y1, x2, y2, ry]
+  // params boxes_b: (N, 5)
+  // params ans_iou: (N), iou of boxes_a[i] and boxes_b[i]
+
+  CHECK_INPUT(boxes_a);
+  CHECK_INPUT(boxes_b);
+  CHECK_INPUT(ans_iou);
+
+  aligned_kernel<iou_bev>(boxes_a.data_ptr<float>(), boxes_b.data_ptr<float>(),
+                          ans_iou.data_ptr<float>(), boxes_a.size(0));
+  return 1;
+}
+
+int nms_cpu(at::Tensor boxes, at::Tensor keep, float nms_overlap_thresh) {
+  // params boxes: (N, 5) [x1, y1, x2, y2, ry]
+  // params keep: (N)
+
+  CHECK_INPUT(boxes);
+  CHECK_CONTIGUOUS(keep);
+
+  return nms_kernel<iou_bev>(boxes.data_ptr<float>(), keep.data_ptr<int64_t>(),
+                             boxes.size(0), nms_overlap_thresh);
+}
+
+int batched_nms_cpu(at::Tensor boxes, at::Tensor idxs, at::Tensor keep,
+                    float nms_overlap_thresh) {
+  // params boxes: (B, N, 5) [x1, y1, x2, y2, ry]
+  // params idxs: (B, N), boxes only suppress boxes of the same batch and idx
+  // params keep: (B, N) bool
+
+  CHECK_INPUT(boxes);
+  CHECK_INPUT(idxs);
+  CHECK_INPUT(keep);
+
+  batched_nms_kernel<iou_bev>(boxes.data_ptr<float>(), idxs.data_ptr<int64_t>(),
+                              keep.data_ptr<bool>(), boxes.size(0),
+                              boxes.size(1), nms_overlap_thresh);
+  return 1;
+}
+
+int nms_normal_cpu(at::Tensor boxes, at::Tensor keep,
+                   float nms_overlap_thresh) {
+  // params boxes: (N, 5) [x1, y1, x2, y2, ry]
+  // params keep: (N)
+
+  CHECK_INPUT(boxes);
+  CHECK_CONTIGUOUS(keep);
+
+  return nms_kernel<iou_normal>(boxes.data_ptr<float>(),
+                                keep.data_ptr<int64_t>(), boxes.size(0),
+                                nms_overlap_thresh);
+}
@@ -7,8 +7,10 @@ Written by Shaoshuai Shi
 All Rights Reserved 2019-2020.
 */
 
+#include <stdint.h>
 #include <stdio.h>
 #define THREADS_PER_BLOCK 16
+#define THREADS_PER_BLOCK_ALIGNED 256
 #define DIVUP(m, n) ((m) / (n) + ((m) % (n) > 0))
 
 //#define DEBUG
@@ -281,14 +283,44 @@ __global__ void boxes_iou_bev_kernel(const int num_a, const float *boxes_a,
   ans_iou[a_idx * num_b + b_idx] = cur_iou_bev;
 }
 
+__global__ void boxes_overlap_aligned_kernel(const int num,
+                                             const float *boxes_a,
+                                             const float *boxes_b,
+                                             float *ans_overlap) {
+  // one thread per row, box i of a with box i of b
+  const int idx = blockIdx.x * THREADS_PER_BLOCK_ALIGNED + threadIdx.x;
+  if (idx >= num) {
+    return;
+  }
+  ans_overlap[idx] = box_overlap(boxes_a + idx * 5, boxes_b + idx * 5);
+}
+
+__global__ void boxes_iou_bev_aligned_kernel(const int num,
+                                             const float *boxes_a,
+                                             const float *boxes_b,
+                                             float *ans_iou) {
+  const int idx = blockIdx.x * THREADS_PER_BLOCK_ALIGNED + threadIdx.x;
+  if (idx >= num) {
+    return;
+  }
+  ans_iou[idx] = iou_bev(boxes_a + idx * 5, boxes_b + idx * 5);
+}
+
 __global__ void nms_kernel(const int boxes_num, const float nms_overlap_thresh,
-                           const float *boxes, unsigned long long *mask) {
-  // params: boxes (N, 5) [x1, y1, x2, y2, ry]
-  // params: mask (N, N/THREADS_PER_BLOCK_NMS)
+                           const float *boxes, const int64_t *idxs,
+                           unsigned long long *mask) {
+  // params: boxes (B, N, 5) [x1, y1, x2, y2, ry]
+  // params: idxs (B, N), boxes only suppress boxes of the same idx, or NULL
+  // params: mask (B, N, N/THREADS_PER_BLOCK_NMS)
+  // the B = gridDim.z batches of boxes are independent
 
   const int row_start = blockIdx.y;
   const int col_start = blockIdx.x;
 
+  boxes += blockIdx.z * boxes_num * 5;
+  if (idxs != NULL) idxs += blockIdx.z * boxes_num;
+  mask += blockIdx.z * boxes_num * DIVUP(boxes_num, THREADS_PER_BLOCK_NMS);
+
   // if (row_start > col_start) return;
 
   const int row_size = fminf(boxes_num - row_start * THREADS_PER_BLOCK_NMS,
@@ -323,6 +355,10 @@ __global__ void nms_kernel(const int boxes_num, const float nms_overlap_thresh,
       start = threadIdx.x + 1;
     }
     for (i = start; i < col_size; i++) {
+      if (idxs != NULL &&
+          idxs[cur_box_idx] != idxs[THREADS_PER_BLOCK_NMS * col_start + i]) {
+        continue;
+      }
       if (iou_bev(cur_box, block_boxes + i * 5) > nms_overlap_thresh) {
         t |= 1ULL << i;
       }
@@ -332,6 +368,42 @@ __global__ void nms_kernel(const int boxes_num, const float nms_overlap_thresh,
   }
 }
 
+__global__ void nms_keep_kernel(const int boxes_num,
+                                const unsigned long long *mask, bool *keep) {
+  // params: mask (B, N, N/THREADS_PER_BLOCK_NMS)
+  // params: keep (B, N)
+  // the greedy scan of the host code in nms_gpu, one block per batch. every
+  // thread follows the scan, the threads share the or of the masks of the
+  // kept boxes over the later column blocks.
+
+  const int col_blocks = DIVUP(boxes_num, THREADS_PER_BLOCK_NMS);
+  mask += blockIdx.x * boxes_num * col_blocks;
+  keep += blockIdx.x * boxes_num;
+  extern __shared__ unsigned long long remv[];
+  for (int j = threadIdx.x; j < col_blocks; j += blockDim.x) remv[j] = 0;
+  __syncthreads();
+
+  for (int nblock = 0; nblock < col_blocks; nblock++) {
+    unsigned long long removed = remv[nblock];
+    const int block_size =
+        min(boxes_num - nblock * THREADS_PER_BLOCK_NMS, THREADS_PER_BLOCK_NMS);
+    for (int inblock = 0; inblock < block_size; inblock++) {
+      const int i = nblock * THREADS_PER_BLOCK_NMS + inblock;
+      const bool kept = !(removed & (1ULL << inblock));
+      if (threadIdx.x == 0) keep[i] = kept;
+      if (kept) {
+        const unsigned long long *p = mask + i * col_blocks;
+        removed |= p[nblock];
+        for (int j = nblock + 1 + threadIdx.x; j < col_blocks;
+             j += blockDim.x) {
+          remv[j] |= p[j];
+        }
+      }
+    }
+    __syncthreads();
+  }
+}
+
 __device__ inline float iou_normal(float const *const a, float const *const b) {
   float left = fmaxf(a[0], b[0]), right = fminf(a[2], b[2]);
   float top = fmaxf(a[1], b[1]), bottom = fminf(a[3], b[3]);
@@ -421,12 +493,36 @@ void boxesioubevLauncher(const int num_a, const float *boxes_a, const int num_b,
                                             ans_iou);
 }
 
-void nmsLauncher(const float *boxes, unsigned long long *mask, int boxes_num,
-                 float nms_overlap_thresh) {
+void boxesoverlapAlignedLauncher(const int num, const float *boxes_a,
+                                 const float *boxes_b, float *ans_overlap) {
+  boxes_overlap_aligned_kernel<<<DIVUP(num, THREADS_PER_BLOCK_ALIGNED),
+                                 THREADS_PER_BLOCK_ALIGNED>>>(
+      num, boxes_a, boxes_b, ans_overlap);
+}
+
+void boxesioubevAlignedLauncher(const int num, const float *boxes_a,
+                                const float *boxes_b, float *ans_iou) {
+  boxes_iou_bev_aligned_kernel<<<DIVUP(num, THREADS_PER_BLOCK_ALIGNED),
+                                 THREADS_PER_BLOCK_ALIGNED>>>(
+      num, boxes_a, boxes_b, ans_iou);
+}
+
+void nmsLauncher(const float *boxes, const int64_t *idxs,
+                 unsigned long long *mask, int boxes_num,
+                 float nms_overlap_thresh, int batch_size) {
   dim3 blocks(DIVUP(boxes_num, THREADS_PER_BLOCK_NMS),
-              DIVUP(boxes_num, THREADS_PER_BLOCK_NMS));
+              DIVUP(boxes_num, THREADS_PER_BLOCK_NMS), batch_size);
   dim3 threads(THREADS_PER_BLOCK_NMS);
-  nms_kernel<<<blocks, threads>>>(boxes_num, nms_overlap_thresh, boxes, mask);
+  nms_kernel<<<blocks, threads>>>(boxes_num, nms_overlap_thresh, boxes, idxs,
+                                  mask);
+}
+
+void nmsKeepLauncher(const unsigned long long *mask, int boxes_num,
+                     bool *keep, int batch_size) {
+  const int col_blocks = DIVUP(boxes_num, THREADS_PER_BLOCK_NMS);
+  nms_keep_kernel<<<batch_size, 256,
+                    col_blocks * sizeof(unsigned long long)>>>(
+      boxes_num, mask, keep);
 }
 
 void nmsNormalLauncher(const float *boxes, unsigned long long *mask,
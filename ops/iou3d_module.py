@@ -1,7 +1,8 @@
 # This file is modified from https://github.com/open-mmlab/mmdetection3d/blob/master/mmdet3d/ops/iou3d/iou3d_utils.py
 
 import torch
-from .iou3d_op import boxes_overlap_bev_gpu, boxes_iou_bev_gpu, nms_gpu, nms_normal_gpu
+from .iou3d_op import boxes_overlap_bev_forward, boxes_iou_bev_forward, boxes_overlap_bev_aligned_forward, \
+    boxes_iou_bev_aligned_forward, batched_nms_forward, nms_normal_forward
 
 
 def boxes_overlap_bev(boxes_a, boxes_b):
@@ -18,7 +19,7 @@ def boxes_overlap_bev(boxes_a, boxes_b):
         torch.Size((boxes_a.shape[0], boxes_b.shape[0])))
     if ans_overlap.size(0)*ans_overlap.size(1) == 0:
         return ans_overlap
-    boxes_overlap_bev_gpu(boxes_a.contiguous(), boxes_b.contiguous(), ans_overlap)
+    boxes_overlap_bev_forward(boxes_a.contiguous(), boxes_b.contiguous(), ans_overlap)
 
     return ans_overlap
 
@@ -38,13 +39,51 @@ def boxes_iou_bev(boxes_a, boxes_b):
 
     if ans_iou.size(0)*ans_iou.size(1) == 0:
         return ans_iou
-    boxes_iou_bev_gpu(boxes_a.contiguous(), boxes_b.contiguous(), ans_iou)
+    boxes_iou_bev_forward(boxes_a.contiguous(), boxes_b.contiguous(), ans_iou)
+
+    return ans_iou
+
+
+def boxes_overlap_bev_aligned(boxes_a, boxes_b):
+    """Calculate the bird view overlap of boxes_a[i] and boxes_b[i].
+
+    Args:
+        boxes_a (torch.Tensor): Input boxes a with shape (N, 5).
+        boxes_b (torch.Tensor): Input boxes b with shape (N, 5).
+
+    Returns:
+        ans_overlap (torch.Tensor): Overlap result with shape (N, ), the
+            same values as the diagonal of boxes_overlap_bev.
+    """
+    ans_overlap = boxes_a.new_zeros(torch.Size((boxes_a.shape[0], )))
+    if ans_overlap.size(0) == 0:
+        return ans_overlap
+    boxes_overlap_bev_aligned_forward(boxes_a.contiguous(), boxes_b.contiguous(), ans_overlap)
+
+    return ans_overlap
+
+
+def boxes_iou_bev_aligned(boxes_a, boxes_b):
+    """Calculate the bird view IoU of boxes_a[i] and boxes_b[i].
+
+    Args:
+        boxes_a (torch.Tensor): Input boxes a with shape (N, 5).
+        boxes_b (torch.Tensor): Input boxes b with shape (N, 5).
+
+    Returns:
+        ans_iou (torch.Tensor): IoU result with shape (N, ), the same values
+            as the diagonal of boxes_iou_bev.
+    """
+    ans_iou = boxes_a.new_zeros(torch.Size((boxes_a.shape[0], )))
+    if ans_iou.size(0) == 0:
+        return ans_iou
+    boxes_iou_bev_aligned_forward(boxes_a.contiguous(), boxes_b.contiguous(), ans_iou)
 
     return ans_iou
 
 
 def nms_cuda(boxes, scores, thresh, pre_maxsize=None, post_max_size=None):
-    """Nms function with gpu implementation.
+    """Nms function with gpu and cpu implementation, run on the device of the boxes.
 
     Args:
         boxes (torch.Tensor): Input boxes with the shape of [N, 5]
@@ -63,16 +102,64 @@ def nms_cuda(boxes, scores, thresh, pre_maxsize=None, post_max_size=None):
         order = order[:pre_maxsize]
     boxes = boxes[order].contiguous()
 
-    keep = torch.zeros(boxes.size(0), dtype=torch.long)
-    num_out = nms_gpu(boxes, keep, thresh, boxes.device.index)
-    keep = order[keep[:num_out].cuda(boxes.device)].contiguous()
+    # the kept boxes are reduced to a mask on the device of the boxes, only
+    # the number of kept boxes is read back by the indexing
+    keep = torch.zeros((1, boxes.size(0)), dtype=torch.bool, device=boxes.device)
+    if keep.numel() > 0:
+        batched_nms_forward(boxes[None], torch.zeros_like(keep, dtype=torch.long), keep, thresh,
+                            boxes.device.index or 0)
+    keep = order[keep[0]]
     if post_max_size is not None:
         keep = keep[:post_max_size]
     return keep
 
 
+def batched_nms(boxes, scores, idxs, thresh, split_thr=20000, return_mask=False):
+    """Nms within the boxes of the same idx, e.g. the class, for all idxs and
+    optionally for a batch of independent sets of boxes in one kernel call.
+
+    Args:
+        boxes (torch.Tensor): Input boxes with the shape of [N, 5] or
+            [B, N, 5] ([x1, y1, x2, y2, ry]).
+        scores (torch.Tensor): Scores of boxes with the shape of [N] or [B, N].
+        idxs (torch.Tensor): Group of boxes with the shape of [N] or [B, N],
+            a box only suppresses the boxes of its own batch and group.
+        thresh (int): Threshold.
+        split_thr (int): On gpu the kernel needs a (B, N, N / 64) mask, above
+            this many boxes the groups of unbatched boxes run one by one.
+            Default: 20000.
+        return_mask (bool): Return the kept boxes as a mask, which unlike
+            the indexes needs no synchronization with the host. Default: False.
+
+    Returns:
+        torch.Tensor: Indexes after nms, in descending score order, or with
+            return_mask a bool mask with the shape of [N] or [B, N].
+    """
+    if boxes.dim() == 2 and boxes.is_cuda and boxes.size(0) > split_thr:
+        kept = torch.zeros_like(scores, dtype=torch.bool)
+        for idx in torch.unique(idxs):
+            inds = (idxs == idx).nonzero(as_tuple=False).view(-1)
+            kept[inds[nms_cuda(boxes[inds], scores[inds], thresh)]] = True
+    else:
+        batched_boxes, batched_scores, batched_idxs = boxes, scores, idxs
+        if boxes.dim() == 2:
+            batched_boxes, batched_scores, batched_idxs = boxes[None], scores[None], idxs[None]
+        order = batched_scores.sort(-1, descending=True)[1]
+        keep = torch.zeros_like(batched_scores, dtype=torch.bool)
+        if keep.numel() > 0:
+            batched_nms_forward(batched_boxes.gather(1, order[..., None].expand(-1, -1, 5)).contiguous(),
+                                batched_idxs.gather(1, order).long().contiguous(), keep, thresh,
+                                boxes.device.index or 0)
+        kept = torch.empty_like(keep).scatter_(1, order, keep).view(scores.size())
+    if return_mask:
+        return kept
+    assert boxes.dim() == 2, 'batched boxes need return_mask'
+    keep = kept.nonzero(as_tuple=False).view(-1)
+    return keep[scores[keep].sort(0, descending=True)[1]]
+
+
 def nms_normal_gpu(boxes, scores, thresh):
-    """Normal non maximum suppression on GPU.
+    """Normal non maximum suppression on GPU or CPU, run on the device of the boxes.
 
     Args:
         boxes (torch.Tensor): Input boxes with shape (N, 5).
@@ -87,6 +174,5 @@ def nms_normal_gpu(boxes, scores, thresh):
     boxes = boxes[order].contiguous()
 
     keep = torch.zeros(boxes.size(0), dtype=torch.long)
-    num_out = nms_normal_gpu(boxes, keep, thresh,
-                                        boxes.device.index)
-    return order[keep[:num_out].cuda(boxes.device)].contiguous()
+    num_out = nms_normal_forward(boxes, keep, thresh, boxes.device.index or 0)
+    return order[keep[:num_out].to(boxes.device)].contiguous()
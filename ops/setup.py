@@ -1,25 +1,46 @@
+import torch
 from setuptools import setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+from torch.utils.cpp_extension import BuildExtension, CppExtension, CUDAExtension, CUDA_HOME
+
+# without nvcc only the cpu kernels are built, the ops then run with --no_cuda
+WITH_CUDA = torch.cuda.is_available() and CUDA_HOME is not None
+
+
+def make_extension(name, sources, cuda_sources):
+    if WITH_CUDA:
+        return CUDAExtension(
+            name=name,
+            sources=sources + cuda_sources,
+            define_macros=[('WITH_CUDA', None)],
+            extra_compile_args={'cxx': ['-fopenmp'], 'nvcc': []},
+            extra_link_args=['-fopenmp']
+        )
+    return CppExtension(
+        name=name,
+        sources=sources,
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp']
+    )
+
 
 setup(
     name='pointpillars',
     ext_modules=[
-        CUDAExtension(
-            name='voxel_op', 
+        make_extension(
+            name='voxel_op',
             sources=['voxelization/voxelization.cpp',
                      'voxelization/voxelization_cpu.cpp',
-                     'voxelization/voxelization_cuda.cu',
                     ],
-            define_macros=[('WITH_CUDA', None)]    
+            cuda_sources=['voxelization/voxelization_cuda.cu']
         ),
-        CUDAExtension(
-            name='iou3d_op', 
+        make_extension(
+            name='iou3d_op',
             sources=['iou3d/iou3d.cpp',
-                     'iou3d/iou3d_kernel.cu',
+                     'iou3d/iou3d_cpu.cpp',
                     ],
-            define_macros=[('WITH_CUDA', None)]    
+            cuda_sources=['iou3d/iou3d_kernel.cu']
         )
     ],
     cmdclass={
         'build_ext': BuildExtension
-    })
\ No newline at end of file
+    })
@@ -2,7 +2,7 @@
 
 import torch
 import torch.nn as nn
-from .voxel_op import hard_voxelize
+from .voxel_op import hard_voxelize, hard_voxelize_batch, dynamic_voxelize
 import numpy as np
 import numba
 
@@ -293,6 +293,42 @@ class Voxelization(nn.Module):
         num_points_per_voxel = torch.from_numpy(voxel_parts[2]).to(device=input.device)
         return voxels, coors, num_points_per_voxel
 
+    def forward_batch(self, points, offsets):
+        """
+        points: shape=(N, c), the points of all samples concatenated, on cpu or cuda
+        offsets: shape=(bs + 1, ), points of sample b are points[offsets[b]:offsets[b + 1]]
+        return: voxels (M, max_num_points, c), coors (M, 1 + 3) as (batch index, x, y, z),
+                num_points_per_voxel (M, ), the voxels of every sample as points_to_voxel would give them
+        """
+        if self.training:
+            max_voxels = self.max_voxels[0]
+        else:
+            max_voxels = self.max_voxels[1]
+        batch_size = len(offsets) - 1
+        points = points.detach().contiguous()
+        # the cpu kernel clears every voxel it creates, skip zeroing batch_size * max_voxels voxels
+        new_tensor = points.new_zeros if points.is_cuda else points.new_empty
+        voxels = new_tensor(size=(batch_size * max_voxels, self.max_num_points, points.size(1)))
+        coors = new_tensor(size=(batch_size * max_voxels, 1 + 3), dtype=torch.int)
+        num_points_per_voxel = new_tensor(size=(batch_size * max_voxels, ), dtype=torch.int)
+        offsets = offsets.to(device=points.device, dtype=torch.long)
+        voxel_num = hard_voxelize_batch(points, offsets, voxels, coors, num_points_per_voxel,
+                                        self.voxel_size, self.point_cloud_range,
+                                        self.max_num_points, max_voxels, 3)
+        return voxels[:voxel_num], coors[:voxel_num], num_points_per_voxel[:voxel_num]
+
+    def forward_dynamic(self, points):
+        """
+        points: shape=(N, c), on cpu or cuda
+        return: coors (N, 3) int as (x, y, z) voxel of every point, -1 for the points out of point_cloud_range
+        """
+        points = points.detach().contiguous()
+        coors = points.new_zeros(size=(points.size(0), 3), dtype=torch.int)
+        dynamic_voxelize(points, coors, self.voxel_size, self.point_cloud_range, 3)
+        # the cuda kernel only sets the leading coors of an out of range point to -1
+        coors[coors[:, 0] == -1] = -1
+        return coors.flip(-1) # (z, y, x) -> (x, y, z)
+
     def __repr__(self):
         tmpstr = self.__class__.__name__ + '('
         tmpstr += 'voxel_size=' + str(self.voxel_size)
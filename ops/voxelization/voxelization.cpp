@@ -5,6 +5,8 @@ namespace voxelization {
 
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("hard_voxelize", &hard_voxelize, "hard voxelize");
+  m.def("hard_voxelize_batch", &hard_voxelize_batch, "hard voxelize a batch of point clouds");
+  m.def("dynamic_voxelize", &dynamic_voxelize, "dynamic voxelize");
 }
 
 } // namespace voxelization
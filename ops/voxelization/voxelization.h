@@ -12,7 +12,33 @@ int hard_voxelize_cpu(const at::Tensor &points, at::Tensor &voxels,
                       const int max_points, const int max_voxels,
                       const int NDim = 3);
 
+int hard_voxelize_batch_cpu(const at::Tensor &points, const at::Tensor &offsets,
+                            at::Tensor &voxels, at::Tensor &coors,
+                            at::Tensor &num_points_per_voxel,
+                            const std::vector<float> voxel_size,
+                            const std::vector<float> coors_range,
+                            const int max_points, const int max_voxels,
+                            const int NDim = 3);
+
+void dynamic_voxelize_cpu(const at::Tensor &points, at::Tensor &coors,
+                          const std::vector<float> voxel_size,
+                          const std::vector<float> coors_range,
+                          const int NDim = 3);
+
 #ifdef WITH_CUDA
+void dynamic_voxelize_gpu(const at::Tensor &points, at::Tensor &coors,
+                          const std::vector<float> voxel_size,
+                          const std::vector<float> coors_range,
+                          const int NDim = 3);
+
+int hard_voxelize_batch_gpu(const at::Tensor &points, const at::Tensor &offsets,
+                            at::Tensor &voxels, at::Tensor &coors,
+                            at::Tensor &num_points_per_voxel,
+                            const std::vector<float> voxel_size,
+                            const std::vector<float> coors_range,
+                            const int max_points, const int max_voxels,
+                            const int NDim = 3);
+
 int hard_voxelize_gpu(const at::Tensor &points, at::Tensor &voxels,
                       at::Tensor &coors, at::Tensor &num_points_per_voxel,
                       const std::vector<float> voxel_size,
@@ -54,6 +80,45 @@ inline int hard_voxelize(const at::Tensor &points, at::Tensor &voxels,
                            NDim);
 }
 
+// points of sample b are points[offsets[b]:offsets[b + 1]], the outputs hold
+// batch_size * max_voxels voxels and coors are (batch index, x, y, z).
+// The voxels of all samples are returned packed in sample order.
+// The cuda outputs must be zero-initialized, the cpu outputs need not be.
+inline int hard_voxelize_batch(const at::Tensor &points, const at::Tensor &offsets,
+                               at::Tensor &voxels, at::Tensor &coors,
+                               at::Tensor &num_points_per_voxel,
+                               const std::vector<float> voxel_size,
+                               const std::vector<float> coors_range,
+                               const int max_points, const int max_voxels,
+                               const int NDim = 3) {
+  if (points.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return hard_voxelize_batch_gpu(points, offsets, voxels, coors, num_points_per_voxel,
+                                   voxel_size, coors_range, max_points, max_voxels,
+                                   NDim);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return hard_voxelize_batch_cpu(points, offsets, voxels, coors, num_points_per_voxel,
+                                 voxel_size, coors_range, max_points, max_voxels,
+                                 NDim);
+}
+
+// coors of every point as (z, y, x), -1 for the points out of coors_range
+inline void dynamic_voxelize(const at::Tensor &points, at::Tensor &coors,
+                             const std::vector<float> voxel_size,
+                             const std::vector<float> coors_range,
+                             const int NDim = 3) {
+  if (points.device().is_cuda()) {
+#ifdef WITH_CUDA
+    return dynamic_voxelize_gpu(points, coors, voxel_size, coors_range, NDim);
+#else
+    AT_ERROR("Not compiled with GPU support");
+#endif
+  }
+  return dynamic_voxelize_cpu(points, coors, voxel_size, coors_range, NDim);
+}
 
 inline reduce_t convert_reduce_type(const std::string &reduce_type) {
   if (reduce_type == "max")
@@ -1,5 +1,9 @@
 #include <ATen/TensorUtils.h>
 #include <torch/extension.h>
+
+#include <algorithm>
+#include <cstring>
+#include <numeric>
 // #include "voxelization.h"
 
 namespace {
@@ -42,64 +46,189 @@ void dynamic_voxelize_kernel(const torch::TensorAccessor<T, 2> points,
   return;
 }
 
+// Open addressing map from the linear voxel coordinate to the voxel index.
+// It is sized by the number of voxels one call can create instead of the
+// whole grid, so finer voxel sizes do not grow the memory.
+class VoxelHashMap {
+ public:
+  explicit VoxelHashMap(const int64_t max_entries) { reset(max_entries); }
+
+  // drop all entries, keeping the load factor under 0.5 for max_entries
+  void reset(const int64_t max_entries) {
+    bits_ = 4;
+    while ((int64_t(1) << bits_) < 2 * max_entries) ++bits_;
+    mask_ = (int64_t(1) << bits_) - 1;
+    keys_.assign(mask_ + 1, -1);
+    values_.resize(mask_ + 1);
+  }
+
+  // bucket holding key, or the empty bucket it would be inserted in
+  int64_t bucket(const int64_t key) const {
+    int64_t b = (uint64_t(key) * 0x9E3779B97F4A7C15ull) >> (64 - bits_);
+    while (keys_[b] != -1 && keys_[b] != key) b = (b + 1) & mask_;
+    return b;
+  }
+
+  bool occupied(const int64_t b) const { return keys_[b] != -1; }
+
+  int value(const int64_t b) const { return values_[b]; }
+
+  void insert(const int64_t b, const int64_t key, const int value) {
+    keys_[b] = key;
+    values_[b] = value;
+  }
+
+ private:
+  int bits_;
+  int64_t mask_;
+  std::vector<int64_t> keys_;
+  std::vector<int> values_;
+};
+
+// linear index of the voxel holding point i, x fastest, -1 if out of range
+template <typename T>
+inline int64_t voxel_key(const torch::TensorAccessor<T, 2>& points,
+                         const int64_t i, const std::vector<float>& voxel_size,
+                         const std::vector<float>& coors_range,
+                         const std::vector<int>& grid_size, const int NDim) {
+  int64_t key = 0;
+  for (int j = NDim - 1; j >= 0; --j) {
+    int c = floor((points[i][j] - coors_range[j]) / voxel_size[j]);
+    if (c < 0 || c >= grid_size[j]) return -1;
+    key = key * grid_size[j] + c;
+  }
+  return key;
+}
+
 template <typename T, typename T_int>
 void hard_voxelize_kernel(const torch::TensorAccessor<T, 2> points,
                           torch::TensorAccessor<T, 3> voxels,
                           torch::TensorAccessor<T_int, 2> coors,
                           torch::TensorAccessor<T_int, 1> num_points_per_voxel,
-                          torch::TensorAccessor<T_int, 3> coor_to_voxelidx,
                           int& voxel_num, const std::vector<float> voxel_size,
                           const std::vector<float> coors_range,
                           const std::vector<int> grid_size,
                           const int max_points, const int max_voxels,
                           const int num_points, const int num_features,
                           const int NDim) {
-  // declare a temp coors
-  at::Tensor temp_coors = at::zeros(
-      {num_points, NDim}, at::TensorOptions().dtype(at::kInt).device(at::kCPU));
-
-  // First use dynamic voxelization to get coors,
-  // then check max points/voxels constraints
-  dynamic_voxelize_kernel<T, int>(points, temp_coors.accessor<int, 2>(),
-                                  voxel_size, coors_range, grid_size,
-                                  num_points, num_features, NDim);
+  // 1. voxel of every point, in parallel
+  std::vector<int64_t> keys(num_points);
+#pragma omp parallel for schedule(static)
+  for (int i = 0; i < num_points; ++i) {
+    keys[i] = voxel_key(points, i, voxel_size, coors_range, grid_size, NDim);
+  }
 
+  // 2. voxels are numbered in the order their first point comes, which
+  // has to be serial, and every kept point gets its slot in the voxel
+  const int64_t max_entries =
+      max_voxels == -1 ? num_points : std::min(num_points, max_voxels);
+  VoxelHashMap coor_to_voxelidx(max_entries);
+  std::vector<int> point_voxelidx(num_points, -1);
+  std::vector<int> point_slot(num_points);
   int voxelidx, num;
-  auto coor = temp_coors.accessor<int, 2>();
 
   for (int i = 0; i < num_points; ++i) {
-    // T_int* coor = temp_coors.data_ptr<int>() + i * NDim;
-
-    if (coor[i][0] == -1) continue;
+    if (keys[i] == -1) continue;
 
-    voxelidx = coor_to_voxelidx[coor[i][0]][coor[i][1]][coor[i][2]];
-
-    // record voxel
-    if (voxelidx == -1) {
-      voxelidx = voxel_num;
+    const int64_t b = coor_to_voxelidx.bucket(keys[i]);
+    if (coor_to_voxelidx.occupied(b)) {
+      voxelidx = coor_to_voxelidx.value(b);
+    } else {
+      // record voxel
       if (max_voxels != -1 && voxel_num >= max_voxels) continue;
+      voxelidx = voxel_num;
       voxel_num += 1;
+      coor_to_voxelidx.insert(b, keys[i], voxelidx);
 
-      coor_to_voxelidx[coor[i][0]][coor[i][1]][coor[i][2]] = voxelidx;
-
+      // coors are (z, y, x)
+      int64_t key = keys[i];
       for (int k = 0; k < NDim; ++k) {
-        coors[voxelidx][k] = coor[i][k];
+        coors[voxelidx][NDim - 1 - k] = key % grid_size[k];
+        key /= grid_size[k];
       }
     }
 
-    // put points into voxel
     num = num_points_per_voxel[voxelidx];
     if (max_points == -1 || num < max_points) {
-      for (int k = 0; k < num_features; ++k) {
-        voxels[voxelidx][num][k] = points[i][k];
-      }
+      point_voxelidx[i] = voxelidx;
+      point_slot[i] = num;
       num_points_per_voxel[voxelidx] += 1;
     }
   }
 
+  // 3. put points into voxels, in parallel
+#pragma omp parallel for schedule(static)
+  for (int i = 0; i < num_points; ++i) {
+    if (point_voxelidx[i] == -1) continue;
+    for (int k = 0; k < num_features; ++k) {
+      voxels[point_voxelidx[i]][point_slot[i]][k] = points[i][k];
+    }
+  }
+
   return;
 }
 
+template <typename T, typename T_int>
+void hard_voxelize_batch_kernel(const torch::TensorAccessor<T, 2> points,
+                                const int64_t* offsets,
+                                torch::TensorAccessor<T, 3> voxels,
+                                torch::TensorAccessor<T_int, 2> coors,
+                                torch::TensorAccessor<T_int, 1> num_points_per_voxel,
+                                std::vector<int>& voxel_nums,
+                                const std::vector<float> voxel_size,
+                                const std::vector<float> coors_range,
+                                const std::vector<int> grid_size,
+                                const int max_points, const int max_voxels,
+                                const int batch_size, const int num_features,
+                                const int NDim) {
+  // samples are independent, sample b fills voxels [b * max_voxels, (b + 1) * max_voxels)
+#pragma omp parallel
+  {
+    // one voxel map per thread, reset for every sample
+    VoxelHashMap coor_to_voxelidx(0);
+
+#pragma omp for schedule(dynamic)
+    for (int b = 0; b < batch_size; ++b) {
+      const int first_voxel = b * max_voxels;
+      int voxel_num = 0;
+      coor_to_voxelidx.reset(std::min<int64_t>(offsets[b + 1] - offsets[b], max_voxels));
+      for (int64_t i = offsets[b]; i < offsets[b + 1]; ++i) {
+        int64_t key = voxel_key(points, i, voxel_size, coors_range, grid_size, NDim);
+        if (key == -1) continue;
+
+        int voxelidx;
+        const int64_t bucket = coor_to_voxelidx.bucket(key);
+        if (coor_to_voxelidx.occupied(bucket)) {
+          voxelidx = coor_to_voxelidx.value(bucket);
+        } else {
+          // like points_to_voxel, the rest of the sample is dropped once it has max_voxels
+          if (voxel_num >= max_voxels) break;
+          voxelidx = first_voxel + voxel_num;
+          voxel_num += 1;
+          coor_to_voxelidx.insert(bucket, key, voxelidx);
+          // outputs may be uninitialized, clear the voxel when it is created
+          std::memset(&voxels[voxelidx][0][0], 0, sizeof(T) * max_points * num_features);
+          num_points_per_voxel[voxelidx] = 0;
+          coors[voxelidx][0] = b;
+          for (int k = 0; k < NDim; ++k) {
+            coors[voxelidx][k + 1] = key % grid_size[k];
+            key /= grid_size[k];
+          }
+        }
+
+        int num = num_points_per_voxel[voxelidx];
+        if (num < max_points) {
+          for (int k = 0; k < num_features; ++k) {
+            voxels[voxelidx][num][k] = points[i][k];
+          }
+          num_points_per_voxel[voxelidx] += 1;
+        }
+      }
+      voxel_nums[b] = voxel_num;
+    }
+  }
+}
+
 }  // namespace
 
 namespace voxelization {
@@ -123,19 +252,14 @@ int hard_voxelize_cpu(const at::Tensor& points, at::Tensor& voxels,
         round((coors_range[NDim + i] - coors_range[i]) / voxel_size[i]);
   }
 
-  // coors, num_points_per_voxel, coor_to_voxelidx are int Tensor
-  // printf("cpu coor_to_voxelidx size: [%d, %d, %d]\n", grid_size[2],
-  // grid_size[1], grid_size[0]);
-  at::Tensor coor_to_voxelidx =
-      -at::ones({grid_size[2], grid_size[1], grid_size[0]}, coors.options());
-
+  // coors, num_points_per_voxel are int Tensor
   int voxel_num = 0;
   AT_DISPATCH_FLOATING_TYPES_AND_HALF(
       points.scalar_type(), "hard_voxelize_forward", [&] {
         hard_voxelize_kernel<scalar_t, int>(
             points.accessor<scalar_t, 2>(), voxels.accessor<scalar_t, 3>(),
             coors.accessor<int, 2>(), num_points_per_voxel.accessor<int, 1>(),
-            coor_to_voxelidx.accessor<int, 3>(), voxel_num, voxel_size,
+            voxel_num, voxel_size,
             coors_range, grid_size, max_points, max_voxels, num_points,
             num_features, NDim);
       });
@@ -143,6 +267,63 @@ int hard_voxelize_cpu(const at::Tensor& points, at::Tensor& voxels,
   return voxel_num;
 }
 
+int hard_voxelize_batch_cpu(const at::Tensor& points, const at::Tensor& offsets,
+                            at::Tensor& voxels, at::Tensor& coors,
+                            at::Tensor& num_points_per_voxel,
+                            const std::vector<float> voxel_size,
+                            const std::vector<float> coors_range,
+                            const int max_points, const int max_voxels,
+                            const int NDim = 3) {
+  // check device
+  AT_ASSERTM(points.device().is_cpu(), "points must be a CPU tensor");
+  AT_ASSERTM(offsets.device().is_cpu(), "offsets must be a CPU tensor");
+  AT_ASSERTM(voxels.is_contiguous() && coors.is_contiguous() && num_points_per_voxel.is_contiguous(),
+             "outputs must be contiguous");
+
+  std::vector<int> grid_size(NDim);
+  const int batch_size = offsets.size(0) - 1;
+  const int num_features = points.size(1);
+
+  for (int i = 0; i < NDim; ++i) {
+    grid_size[i] =
+        round((coors_range[NDim + i] - coors_range[i]) / voxel_size[i]);
+  }
+
+  at::Tensor offsets_long = offsets.to(at::kLong).contiguous();
+  std::vector<int> voxel_nums(batch_size, 0);
+  AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+      points.scalar_type(), "hard_voxelize_batch_forward", [&] {
+        hard_voxelize_batch_kernel<scalar_t, int>(
+            points.accessor<scalar_t, 2>(), offsets_long.data_ptr<int64_t>(),
+            voxels.accessor<scalar_t, 3>(), coors.accessor<int, 2>(),
+            num_points_per_voxel.accessor<int, 1>(), voxel_nums, voxel_size,
+            coors_range, grid_size, max_points, max_voxels, batch_size,
+            num_features, NDim);
+
+        // move the voxels of every sample right after those of the previous one
+        const int64_t voxel_stride = voxels.stride(0);
+        const int64_t coors_stride = coors.stride(0);
+        int voxel_num = 0;
+        for (int b = 0; b < batch_size; ++b) {
+          const int64_t src = (int64_t)b * max_voxels;
+          if (src != voxel_num && voxel_nums[b] > 0) {
+            std::memmove(voxels.data_ptr<scalar_t>() + voxel_num * voxel_stride,
+                         voxels.data_ptr<scalar_t>() + src * voxel_stride,
+                         sizeof(scalar_t) * voxel_nums[b] * voxel_stride);
+            std::memmove(coors.data_ptr<int>() + voxel_num * coors_stride,
+                         coors.data_ptr<int>() + src * coors_stride,
+                         sizeof(int) * voxel_nums[b] * coors_stride);
+            std::memmove(num_points_per_voxel.data_ptr<int>() + voxel_num,
+                         num_points_per_voxel.data_ptr<int>() + src,
+                         sizeof(int) * voxel_nums[b]);
+          }
+          voxel_num += voxel_nums[b];
+        }
+      });
+
+  return std::accumulate(voxel_nums.begin(), voxel_nums.end(), 0);
+}
+
 void dynamic_voxelize_cpu(const at::Tensor& points, at::Tensor& coors,
                           const std::vector<float> voxel_size,
                           const std::vector<float> coors_range,
@@ -3,6 +3,9 @@
 #include <c10/cuda/CUDAGuard.h>
 #include <torch/types.h>
 
+#include <limits>
+#include <tuple>
+
 #include <ATen/cuda/CUDAApplyUtils.cuh>
 
 #define CHECK_CUDA(x) \
@@ -226,6 +229,35 @@ __global__ void nondisterministic_assign_point_voxel(
   }
 }
 
+template <typename T, typename T_int>
+__global__ void batch_assign_point_to_voxel(
+    const int num_points, const T* points, const T_int* coor,
+    const bool* kept, const int64_t* sample_ids, const int64_t* voxel_idx,
+    const int64_t* pos_in_voxel, T* voxels, T_int* voxel_coors,
+    T_int* num_points_per_voxel, const int max_points, const int num_features,
+    const int NDim) {
+  CUDA_1D_KERNEL_LOOP(index, num_points) {
+    if (!kept[index]) continue;
+    const int64_t voxelidx = voxel_idx[index];
+    const int64_t num = pos_in_voxel[index];
+    auto voxels_offset = voxels + (voxelidx * max_points + num) * num_features;
+    auto points_offset = points + index * num_features;
+    for (int k = 0; k < num_features; ++k) {
+      voxels_offset[k] = points_offset[k];
+    }
+    // integer counts, the result does not depend on the order of the adds
+    atomicAdd(num_points_per_voxel + voxelidx, 1);
+    if (num == 0) {
+      // (z, y, x) -> (batch index, x, y, z)
+      auto coors_offset = voxel_coors + voxelidx * (NDim + 1);
+      coors_offset[0] = sample_ids[index];
+      for (int k = 0; k < NDim; ++k) {
+        coors_offset[k + 1] = coor[index * NDim + NDim - 1 - k];
+      }
+    }
+  }
+}
+
 namespace voxelization {
 
 int hard_voxelize_gpu(const at::Tensor& points, at::Tensor& voxels,
@@ -372,6 +404,115 @@ int hard_voxelize_gpu(const at::Tensor& points, at::Tensor& voxels,
   return voxel_num_int;
 }
 
+int hard_voxelize_batch_gpu(const at::Tensor& points, const at::Tensor& offsets,
+                            at::Tensor& voxels, at::Tensor& coors,
+                            at::Tensor& num_points_per_voxel,
+                            const std::vector<float> voxel_size,
+                            const std::vector<float> coors_range,
+                            const int max_points, const int max_voxels,
+                            const int NDim = 3) {
+  // sort based: the voxels of every point come from one stable sort of the
+  // (sample, voxel) keys instead of a search over the previous points
+  CHECK_INPUT(points);
+
+  at::cuda::CUDAGuard device_guard(points.device());
+
+  const int num_points = points.size(0);
+  const int num_features = points.size(1);
+  const int batch_size = offsets.size(0) - 1;
+
+  if (num_points == 0)
+    return 0;
+
+  const float voxel_x = voxel_size[0];
+  const float voxel_y = voxel_size[1];
+  const float voxel_z = voxel_size[2];
+  const float coors_x_min = coors_range[0];
+  const float coors_y_min = coors_range[1];
+  const float coors_z_min = coors_range[2];
+  const float coors_x_max = coors_range[3];
+  const float coors_y_max = coors_range[4];
+  const float coors_z_max = coors_range[5];
+
+  const int grid_x = round((coors_x_max - coors_x_min) / voxel_x);
+  const int grid_y = round((coors_y_max - coors_y_min) / voxel_y);
+  const int grid_z = round((coors_z_max - coors_z_min) / voxel_z);
+
+  at::Tensor offsets_long = offsets.to(points.device(), at::kLong).contiguous();
+  at::Tensor temp_coors =
+      at::zeros({num_points, NDim}, points.options().dtype(at::kInt));
+
+  // one thread per point, dynamic_voxelize_kernel does not loop over more points than threads
+  dim3 grid(at::cuda::ATenCeilDiv(num_points, 512));
+  dim3 block(512);
+  cudaStream_t stream = at::cuda::getCurrentCUDAStream();
+
+  // 1. link point to corresponding voxel coors
+  AT_DISPATCH_FLOATING_TYPES(
+      points.scalar_type(), "hard_voxelize_batch_kernel", ([&] {
+        dynamic_voxelize_kernel<scalar_t, int><<<grid, block, 0, stream>>>(
+            points.contiguous().data_ptr<scalar_t>(),
+            temp_coors.data_ptr<int>(), voxel_x, voxel_y, voxel_z,
+            coors_x_min, coors_y_min, coors_z_min, coors_x_max, coors_y_max,
+            coors_z_max, grid_x, grid_y, grid_z, num_points, num_features,
+            NDim);
+      }));
+  AT_CUDA_CHECK(cudaGetLastError());
+
+  // 2. one key per (sample, voxel), out of range points sort last. the stable
+  // sort keeps the points of a voxel in point order, so a point's position in
+  // its run of equal keys is its position in the voxel
+  const int64_t invalid_key = std::numeric_limits<int64_t>::max();
+  at::Tensor point_ids = at::arange(num_points, offsets_long.options());
+  at::Tensor sample_ids = at::searchsorted(offsets_long, point_ids, false, true) - 1;
+  at::Tensor coor_long = temp_coors.to(at::kLong);
+  at::Tensor valid = coor_long.select(1, 0).ge(0);
+  at::Tensor keys = sample_ids * ((int64_t)grid_x * grid_y * grid_z) +
+      (coor_long.select(1, 0) * grid_y + coor_long.select(1, 1)) * grid_x + coor_long.select(1, 2);
+  keys = at::where(valid, keys, invalid_key);
+  at::Tensor sorted_keys, order;
+  std::tie(sorted_keys, order) = at::sort(keys, true, 0, false);
+
+  at::Tensor head = at::cat({at::ones({1}, valid.options()),
+                             sorted_keys.slice(0, 1).ne(sorted_keys.slice(0, 0, num_points - 1))});
+  at::Tensor run_start = std::get<0>(at::cummax(at::where(head, point_ids, 0), 0));
+  at::Tensor pos_in_voxel = at::empty_like(point_ids).scatter_(0, order, point_ids - run_start);
+  // first point of the voxel of every point
+  at::Tensor first_point = at::empty_like(point_ids).scatter_(0, order, order.index_select(0, run_start));
+
+  // 3. like points_to_voxel, voxels are numbered in order of their first point
+  // and the rest of a sample is dropped at the point that would create voxel
+  // max_voxels + 1
+  at::Tensor is_new = valid.logical_and(pos_in_voxel.eq(0));
+  at::Tensor new_num = at::cumsum(is_new, 0, at::kLong);
+  at::Tensor sample_base = at::cat({at::zeros({1}, new_num.options()), new_num}).index_select(0, offsets_long);
+  at::Tensor voxel_rank = new_num - 1 - sample_base.index_select(0, sample_ids);
+  at::Tensor cutoff = offsets_long.slice(0, 1).clone().scatter_reduce_(
+      0, sample_ids, at::where(is_new.logical_and(voxel_rank.eq(max_voxels)), point_ids, invalid_key),
+      "amin", true);
+  at::Tensor kept = valid.logical_and(point_ids.lt(cutoff.index_select(0, sample_ids)))
+                         .logical_and(pos_in_voxel.lt(max_points));
+  at::Tensor sample_voxel_num = at::clamp_max(sample_base.slice(0, 1) - sample_base.slice(0, 0, batch_size), max_voxels);
+  at::Tensor out_base = at::cat({at::zeros({1}, sample_voxel_num.options()), sample_voxel_num.cumsum(0)});
+  at::Tensor voxel_idx = out_base.index_select(0, sample_ids) + voxel_rank.index_select(0, first_point);
+
+  // 4. copy the point features and the coors, with the batch index
+  AT_DISPATCH_FLOATING_TYPES(
+      points.scalar_type(), "batch_assign_point_to_voxel", ([&] {
+        batch_assign_point_to_voxel<scalar_t, int><<<grid, block, 0, stream>>>(
+            num_points, points.contiguous().data_ptr<scalar_t>(),
+            temp_coors.data_ptr<int>(), kept.data_ptr<bool>(),
+            sample_ids.data_ptr<int64_t>(), voxel_idx.data_ptr<int64_t>(),
+            pos_in_voxel.data_ptr<int64_t>(), voxels.data_ptr<scalar_t>(),
+            coors.data_ptr<int>(), num_points_per_voxel.data_ptr<int>(),
+            max_points, num_features, NDim);
+      }));
+  AT_CUDA_CHECK(cudaGetLastError());
+
+  // the only host sync, the caller slices the outputs with the voxel count
+  return (int)out_base[batch_size].item<int64_t>();
+}
+
 int nondisterministic_hard_voxelize_gpu(
     const at::Tensor &points, at::Tensor &voxels,
     at::Tensor &coors, at::Tensor &num_points_per_voxel,
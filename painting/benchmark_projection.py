@@ -0,0 +1,89 @@
+import argparse
+import time
+import torch
+from painting import paint_points
+
+# Waymo camera layout: front, front left, front right, side left, side right
+IMAGE_SHAPES = [(1280, 1920), (1280, 1920), (1280, 1920), (886, 1920), (886, 1920)]
+YAWS = [0., 0.8, -0.8, 1.6, -1.6]
+
+
+def get_calib(device):
+    """Pinhole cameras around the vehicle, camera looking along +x of the lidar frame rotated by yaw."""
+    calib = {'R0_rect': torch.eye(4, device=device)}
+    velo_to_cam = torch.tensor([[0., -1., 0., 0.],
+                                [0., 0., -1., 0.],
+                                [1., 0., 0., 0.],
+                                [0., 0., 0., 1.]])
+    for i, ((h, w), yaw) in enumerate(zip(IMAGE_SHAPES, YAWS)):
+        rot = torch.eye(4)
+        rot[0, 0], rot[0, 1], rot[1, 0], rot[1, 1] = \
+            torch.cos(torch.tensor(-yaw)), -torch.sin(torch.tensor(-yaw)), torch.sin(torch.tensor(-yaw)), torch.cos(torch.tensor(-yaw))
+        calib['Tr_velo_to_cam_' + str(i)] = (velo_to_cam @ rot).to(device)
+        calib['P' + str(i)] = torch.tensor([[2000., 0., w / 2, 0.],
+                                            [0., 2000., h / 2, 0.],
+                                            [0., 0., 1., 0.],
+                                            [0., 0., 0., 1.]], device=device)
+    return calib
+
+
+def paint_points_per_camera(class_scores, lidar_raw, calib, cam_sync):
+    """The original painting: one projection per camera and the (0,1),(0,2),(1,3),(2,4) overlaps halved."""
+    num_classes = class_scores[0].shape[2]
+    lidar_velo_coords = lidar_raw[:, :4].clone()
+    lidar_velo_coords[:, -1] = 1
+    augmented_lidar = torch.cat((lidar_raw[:, :5], torch.zeros((lidar_raw.shape[0], num_classes), device=lidar_raw.device)), axis=1)
+    visible = []
+    for i, scores in enumerate(class_scores):
+        lidar_cam_coords = calib['Tr_velo_to_cam_' + str(i)].matmul(lidar_velo_coords.transpose(0, 1)).transpose(0, 1)
+        lidar_cam_coords[:, -1] = 1
+        projected = calib['P' + str(i)].matmul(calib['R0_rect'].matmul(lidar_cam_coords.transpose(0, 1))).transpose(0, 1)
+        projected = projected / (projected[:, 2].reshape(-1, 1))
+        on_img = (0 < projected[:, 0]) & (projected[:, 0] < scores.shape[1]) & \
+            (0 < projected[:, 1]) & (projected[:, 1] < scores.shape[0]) & (lidar_cam_coords[:, 2] > 0)
+        projected = torch.floor(projected[on_img]).int()
+        augmented_lidar[on_img, -num_classes:] += scores[projected[:, 1], projected[:, 0]].reshape(-1, num_classes)
+        visible.append(on_img)
+    for i, j in [(0, 1), (0, 2), (1, 3), (2, 4)]:
+        both = visible[i] & visible[j]
+        augmented_lidar[both, -num_classes:] = 0.5 * augmented_lidar[both, -num_classes:]
+    if cam_sync:
+        augmented_lidar = augmented_lidar[torch.stack(visible).any(dim=0)]
+    return augmented_lidar
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        out = fn()
+    return (time.perf_counter() - start) / repeat * 1000, out
+
+
+def main(args):
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    points = torch.rand(args.num_points, 6, device=device)
+    points[:, :2] = points[:, :2] * 149.76 - 74.88
+    points[:, 2] = points[:, 2] * 6 - 2
+    class_scores = [torch.rand(h, w, 6, device=device) for h, w in IMAGE_SHAPES]
+    calib = get_calib(device)
+
+    with torch.no_grad():
+        ms_per_camera, out_per_camera = timeit(lambda: paint_points_per_camera(class_scores, points, calib, args.cam_sync), args.repeat)
+        ms_batched, out_batched = timeit(lambda: paint_points(class_scores, points, calib, args.cam_sync), args.repeat)
+
+    print(f'points: {args.num_points}, cameras: {len(IMAGE_SHAPES)}, device: {args.device}, threads: {torch.get_num_threads()}')
+    print(f'per camera: {ms_per_camera:.2f} ms/frame')
+    print(f'batched:  {ms_batched:.2f} ms/frame')
+    print(f'identical output: {torch.equal(out_per_camera, out_batched)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-frame latency of point painting projection')
+    parser.add_argument('--num_points', type=int, default=150000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--cam_sync', action='store_true', help='only use objects visible to a camera')
+    args = parser.parse_args()
+    main(args)
@@ -1,16 +1,107 @@
 import os
+import io
+import re
+import json
+import glob
+import hashlib
+import fcntl
+import uuid
+import contextlib
 import numpy as np
 import torch
 from torchvision import transforms
 from PIL import Image
 import copy
 import sys
+import time
+import queue
+import threading
+import multiprocessing
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 sys.path.append('..')
 import deeplabv3plus.network as network
 import argparse
 #fix segmentation network
 
+# groups of segmentation classes merged into each painted class score, in painted channel order:
+# background, bicycle, vehicles, person, rider, motorcycle. the cognata and waymo datasets of
+# deeplabv3plus are remapped to the cityscapes train ids, so their checkpoints use the same groups
+CLASS_GROUPS = {
+    'cityscapes': [list(range(11)), [18], [13, 14, 15, 16], [11], [12], [17]],
+}
+
+def get_class_aggregation(class_groups, num_classes=19):
+    """
+    :param class_groups: list of lists of segmentation class ids, one list per painted class
+    :return aggregation: (num_classes, n_groups) 0/1 tensor, 1 where the class belongs to the group
+    """
+    aggregation = torch.zeros(num_classes, len(class_groups))
+    for k, group in enumerate(class_groups):
+        aggregation[group, k] = 1.
+    return aggregation
+
+def reduce_class_scores(logits, aggregation):
+    """
+    Softmax over the segmentation classes and sum of the probabilities of every class group,
+    computed directly on the CHW logits: no HWC permute and no full softmax tensor.
+
+    :param logits: (num_classes, ...) segmentation network output, e.g. (num_classes, H, W)
+    :param aggregation: (num_classes, n_groups) tensor from get_class_aggregation
+    :return scores: (..., n_groups) probability of every class group
+    """
+    num_classes = logits.shape[0]
+    shape = logits.shape[1:]
+    logits = logits.reshape(num_classes, -1)
+    exp_logits = (logits - logits.max(dim=0, keepdim=True)[0]).exp_() # (num_classes, H * W)
+    scores = exp_logits.t().matmul(aggregation) # (H * W, n_groups)
+    scores /= exp_logits.sum(dim=0)[:, None]
+    return scores.view(*shape, -1)
+
+class SparseScores:
+    """
+    Segmentation logits of one camera image, reduced to class group scores only at the pixels the
+    lidar points land on instead of at every pixel. The logits may have a lower resolution than the
+    image, they are then bilinearly interpolated at those pixels like the final upsampling of the
+    segmentation network.
+    """
+    def __init__(self, logits, image_shape, aggregation):
+        self.logits = logits # (num_classes, h, w)
+        self.aggregation = aggregation
+        self.shape = (*image_shape, aggregation.shape[1]) # (H, W, n_groups) of the dense scores
+
+    def lookup(self, pixel_inds):
+        """
+        :param pixel_inds: (n,) long tensor, row * W + col in the full resolution image
+        :return scores: (n, n_groups) class group scores at these pixels
+        """
+        H, W = self.shape[:2]
+        num_classes, h, w = self.logits.shape
+        if (h, w) == (H, W):
+            logits = self.logits.reshape(num_classes, -1).index_select(1, pixel_inds) # (num_classes, n)
+        else:
+            # pixel centers in [-1, 1], matches F.interpolate(mode='bilinear', align_corners=False)
+            rows = torch.div(pixel_inds, W, rounding_mode='floor')
+            cols = pixel_inds - rows * W
+            grid = torch.stack([(cols + 0.5) * (2. / W) - 1., (rows + 0.5) * (2. / H) - 1.], dim=1).to(self.logits.dtype)
+            logits = torch.nn.functional.grid_sample(self.logits[None], grid[None, None], mode='bilinear',
+                                                     padding_mode='border', align_corners=False)[0, :, 0] # (num_classes, n)
+        return reduce_class_scores(logits, self.aggregation.to(logits))
+
+def lookup_scores(scores, pixel_inds):
+    """
+    :param scores: (H, W, n_groups) tensor or SparseScores
+    :param pixel_inds: (n,) long tensor, row * W + col
+    :return: (n, n_groups) scores at these pixels
+    """
+    if isinstance(scores, SparseScores):
+        return scores.lookup(pixel_inds)
+    return scores.reshape(-1, scores.shape[2]).index_select(0, pixel_inds)
+
+# cameras with overlapping fields of view, in Waymo order: front, front left, front right, side left, side right
+CAMERA_OVERLAP_PAIRS = [(0, 1), (0, 2), (1, 3), (2, 4)]
+
 def get_calib_from_file(calib_file):
     """Read in a calibration file and parse into a dictionary."""
     data = {}
@@ -31,12 +122,269 @@ def get_calib_from_file(calib_file):
 
     return data
 
+def get_num_cameras(calib):
+    """Number of cameras in a calib dict, one P{i} matrix per camera."""
+    return len([key for key in calib if re.fullmatch(r'P\d+', key)])
+
+def project_points_to_cameras(lidar_raw, projection_mats, image_shapes):
+    """
+    Projects lidar points onto every camera at once. The (C, 4, 4) camera matrices are stacked
+    so each projection stage is a single matmul over all cameras.
+
+    :param lidar_raw: (n_points, >=3) tensor (x,y,z,...) in velodyne coordinates
+    :param projection_mats: calib dict with P{i}, R0_rect and Tr_velo_to_cam_{i} as (4, 4) tensors
+    :param image_shapes: list of (H, W), one per camera
+    :return pixel_inds: (C, n_points) long tensor, row * W + col of the pixel every point lands on
+    :return visible: (C, n_points) bool tensor, True where the point lands on the camera image
+    """
+    num_cameras = len(image_shapes)
+    num_points = lidar_raw.shape[0]
+    tr_velo_to_cam = torch.stack([projection_mats['Tr_velo_to_cam_' + str(i)] for i in range(num_cameras)]) # (C, 4, 4)
+    R0_rect = torch.block_diag(*[projection_mats['R0_rect']] * num_cameras) # (C * 4, C * 4)
+    P = torch.block_diag(*[projection_mats['P' + str(i)] for i in range(num_cameras)]) # (C * 4, C * 4)
+
+    lidar_velo_coords = torch.nn.functional.pad(lidar_raw[:, :3], (0, 1), value=1.) # homogeneous coords, (n_points, 4)
+    lidar_cam_coords = tr_velo_to_cam.reshape(-1, 4).matmul(lidar_velo_coords.transpose(0, 1)) # (C * 4, n_points)
+    points_projected_on_mask = P.matmul(R0_rect.matmul(lidar_cam_coords)).view(num_cameras, 4, num_points)
+    x_on_img = points_projected_on_mask[:, 0] / points_projected_on_mask[:, 2] # (C, n_points)
+    y_on_img = points_projected_on_mask[:, 1] / points_projected_on_mask[:, 2]
+
+    image_shapes = torch.tensor(image_shapes, dtype=x_on_img.dtype, device=lidar_raw.device) # (C, 2)
+    true_where_x_on_img = (0 < x_on_img) & (x_on_img < image_shapes[:, 1:]) #x in img coords is cols of img
+    true_where_y_on_img = (0 < y_on_img) & (y_on_img < image_shapes[:, :1])
+    visible = true_where_x_on_img & true_where_y_on_img & (lidar_cam_coords.view(num_cameras, 4, num_points)[:, 2] > 0)
+
+    # using floor so you don't end up indexing num_rows+1th row or col, only valid where visible
+    pixel_inds = torch.floor(y_on_img).long() * image_shapes[:, 1:].long() + torch.floor(x_on_img).long()
+    return pixel_inds, visible
+
+def paint_points(class_scores, lidar_raw, projection_mats, cam_sync=False, overlap_pairs=CAMERA_OVERLAP_PAIRS):
+    """
+    Appends to every lidar point the sum of the class scores of all cameras the point is visible in,
+    halved once for every pair of overlap_pairs that sees it. For the Waymo cameras this is the
+    mean of the two scores of a point in an overlap, the same as the original per camera painting.
+
+    :param class_scores: list of (H, W, n_classes) tensors or SparseScores, one per camera
+    :param lidar_raw: (n_points, >=5) tensor (x,y,z,r,e,...) in velodyne coordinates
+    :param projection_mats: calib dict with P{i}, R0_rect and Tr_velo_to_cam_{i} as (4, 4) tensors
+    :param cam_sync: only keep the points visible to at least one camera
+    :param overlap_pairs: list of (i, j) camera pairs with overlapping fields of view
+    :return augmented_lidar: (n_points, 5 + n_classes) tensor
+    """
+    image_shapes = [tuple(scores.shape[:2]) for scores in class_scores]
+    pixel_inds, visible = project_points_to_cameras(lidar_raw, projection_mats, image_shapes)
+
+    num_classes = class_scores[0].shape[2]
+    augmented_lidar = torch.zeros((lidar_raw.shape[0], 5 + num_classes), dtype=lidar_raw.dtype, device=lidar_raw.device)
+    augmented_lidar[:, :5] = lidar_raw[:, :5]
+    point_scores = augmented_lidar[:, 5:]
+    for i, scores in enumerate(class_scores):
+        point_ids = torch.nonzero(visible[i], as_tuple=True)[0]
+        point_scores.index_add_(0, point_ids, lookup_scores(scores, pixel_inds[i, point_ids]))
+    for i, j in overlap_pairs:
+        if j < len(class_scores):
+            point_scores[visible[i] & visible[j]] *= 0.5
+
+    if cam_sync:
+        augmented_lidar = augmented_lidar[visible.any(dim=0)]
+    return augmented_lidar
+
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+class PaintManifest:
+    """
+    Records size and md5 of every painted frame in save_path/manifest_<name>.jsonl, one file per shard.
+    All manifests in save_path are read back so a restarted or re-sharded job can skip finished frames.
+    """
+    def __init__(self, save_path, name):
+        self.records = {}
+        for manifest_file in sorted(glob.glob(os.path.join(save_path, 'manifest_*.jsonl'))):
+            with open(manifest_file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # partially written line of a crashed job
+                    self.records[record['sample_idx']] = record
+        self.file = open(os.path.join(save_path, 'manifest_%s.jsonl' % name), 'a')
+
+    def is_complete(self, sample_idx, file_path):
+        record = self.records.get(sample_idx)
+        if record is None or not os.path.exists(file_path) or os.path.getsize(file_path) != record['size']:
+            return False
+        return file_md5(file_path) == record['md5']
+
+    def add(self, sample_idx, size, md5):
+        record = dict(sample_idx=sample_idx, size=size, md5=md5)
+        self.records[sample_idx] = record
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ScoreCache:
+    """
+    On-disk cache of the (H, W, n_groups) class scores of Painter.get_score, one .npy per camera image
+    under cache_dir/<checkpoint md5>_<class groups md5>/, so scores of a different checkpoint or
+    class grouping are never reused.
+    Scores are stored as float16 or quantized to uint8 and memory-mapped on read. Once the files
+    in cache_dir exceed max_bytes, the least recently used ones are deleted.
+    The index of the files and their access order is the journal cache_dir/index.jsonl, shared by all
+    processes using cache_dir: every access appends to it under an exclusive lock of cache_dir/index.lock
+    and reads the records other processes appended first, so max_bytes holds for all of them together.
+    """
+    def __init__(self, cache_dir, checkpoint_file, max_bytes, dtype='float16', class_groups=CLASS_GROUPS['cityscapes']):
+        assert dtype in ['float16', 'uint8']
+        groups_md5 = hashlib.md5(json.dumps(class_groups).encode()).hexdigest()[:8]
+        self.cache_dir = cache_dir
+        self.cache_path = os.path.join(cache_dir, file_md5(checkpoint_file) + '_' + groups_md5)
+        os.makedirs(self.cache_path, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.lock = threading.Lock()
+        self.journal_path = os.path.join(cache_dir, 'index.jsonl')
+        self.lock_path = os.path.join(cache_dir, 'index.lock')
+
+        # the journal as of journal_offset, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.generation, self.journal_offset = None, 0
+        with self.locked():
+            if not os.path.exists(self.journal_path):
+                # first use of cache_dir or a cache of an older version, the file mtime is the last access time
+                cache_files = [(os.stat(file_path), file_path) for file_path in glob.glob(os.path.join(cache_dir, '*', '*.npy'))]
+                for stat, file_path in sorted(cache_files, key=lambda item: item[0].st_mtime):
+                    self.entries[file_path] = stat.st_size
+                self.total_bytes = sum(self.entries.values())
+                self.compact()
+            self.sync()
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock, open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def sync(self):
+        """
+        Applies the records appended to the journal since the last sync, called with the lock held.
+        """
+        with open(self.journal_path, 'r') as f:
+            generation = f.readline()
+            if generation != self.generation:
+                # rewritten by compact, read it from the start
+                self.entries.clear()
+                self.total_bytes = 0
+                self.generation, self.journal_offset = generation, f.tell()
+            f.seek(self.journal_offset)
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # partially written line of a crashed process
+                file_path = record['path']
+                if record['op'] == 'put':
+                    self.total_bytes += record['size'] - self.entries.pop(file_path, 0)
+                    self.entries[file_path] = record['size']
+                elif record['op'] == 'get' and file_path in self.entries:
+                    self.entries.move_to_end(file_path)
+                elif record['op'] == 'del':
+                    self.total_bytes -= self.entries.pop(file_path, 0)
+            self.journal_offset = f.tell()
+
+    def append(self, records):
+        with open(self.journal_path, 'a') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.journal_offset = os.path.getsize(self.journal_path)
+
+    def compact(self):
+        """
+        Rewrites the journal with one put per entry under a new generation, called with the lock held.
+        """
+        self.generation = uuid.uuid4().hex + '\n'
+        with open(self.journal_path + '.tmp', 'w') as f:
+            f.write(self.generation)
+            f.write(''.join(json.dumps(dict(op='put', path=file_path, size=size)) + '\n'
+                            for file_path, size in self.entries.items()))
+        os.replace(self.journal_path + '.tmp', self.journal_path)
+        self.journal_offset = os.path.getsize(self.journal_path)
+
+    def get_path(self, sample_idx, camera):
+        return os.path.join(self.cache_path, '%s_%d.npy' % (sample_idx, camera))
+
+    def get(self, sample_idx, camera):
+        """
+        Returns the memory-mapped scores in the stored dtype, or None on a miss. Use to_scores to decode.
+        """
+        file_path = self.get_path(sample_idx, camera)
+        with self.locked():
+            self.sync()
+            if file_path not in self.entries:
+                return None
+            self.entries.move_to_end(file_path)
+            self.append([dict(op='get', path=file_path)])
+        try:
+            scores = np.load(file_path, mmap_mode='c')
+        except (FileNotFoundError, ValueError):
+            return None # evicted by another process
+        return torch.from_numpy(scores)
+
+    def to_scores(self, cached, device):
+        scores = cached.to(device=device).float()
+        if self.dtype == 'uint8':
+            scores /= 255.
+        return scores
+
+    def put(self, sample_idx, camera, scores):
+        scores = scores.cpu().numpy()
+        if self.dtype == 'uint8':
+            scores = np.round(np.clip(scores, 0., 1.) * 255.).astype(np.uint8)
+        else:
+            scores = scores.astype(np.float16)
+        file_path = self.get_path(sample_idx, camera)
+        # unique per process and thread, the rename into place happens under the lock
+        tmp_path = '%s.%d.%d.tmp' % (file_path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, scores)
+        size = os.path.getsize(tmp_path)
+
+        with self.locked():
+            self.sync()
+            if file_path in self.entries and os.path.exists(file_path):
+                # cached by another process in the meantime
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, file_path)
+            self.total_bytes += size - self.entries.pop(file_path, 0)
+            self.entries[file_path] = size
+            records = [dict(op='put', path=file_path, size=size)]
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                evicted_path, evicted_size = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                records.append(dict(op='del', path=evicted_path))
+                try:
+                    os.remove(evicted_path)
+                except FileNotFoundError:
+                    pass
+            self.append(records)
+            # the gets make the journal grow without bound, rewrite it once it is mostly stale
+            if self.journal_offset > 4 * 128 * len(self.entries) + (1 << 20):
+                self.compact()
+
 class Painter:
     def __init__(self, args):
         self.root_split_path = args.training_path
         self.save_path = os.path.join(args.training_path, "painted_lidar/")
-        if not os.path.exists(self.save_path):
-            os.mkdir(self.save_path)
+        os.makedirs(self.save_path, exist_ok=True)
 
         self.seg_net_index = 0
         self.model = None
@@ -49,7 +397,36 @@ class Painter:
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         model.to(device)
         self.model = model
+        self.device = device
         self.cam_sync = args.cam_sync
+        # segmentation classes merged into every painted class, a CLASS_GROUPS name or a list of id lists
+        class_groups = getattr(args, 'class_groups', 'cityscapes')
+        self.class_groups = CLASS_GROUPS[class_groups] if isinstance(class_groups, str) else class_groups
+        self.class_aggregation = get_class_aggregation(self.class_groups).to(device)
+        # batched segmentation: all cameras of batch_frames frames go through one forward pass per image shape
+        self.batched = getattr(args, 'batched', False)
+        self.batch_frames = getattr(args, 'batch_frames', 1)
+        # pipelined painting: I/O workers prefetch frames while the device paints, a writer thread saves results
+        self.pipelined = getattr(args, 'pipelined', False)
+        self.num_workers = getattr(args, 'num_workers', 4)
+        self.prefetch = getattr(args, 'prefetch', 8)
+        self.write_queue_size = getattr(args, 'write_queue_size', 8)
+        # sharding and resuming: paint every num_shards-th frame, skip frames recorded complete in a manifest
+        self.num_shards = getattr(args, 'num_shards', 1)
+        self.shard_id = getattr(args, 'shard_id', 0)
+        self.skip_existing = getattr(args, 'skip_existing', False)
+        self.manifest = None
+        # segmentation score cache, re-painting with the same checkpoint only costs the projection
+        self.score_cache = None
+        if getattr(args, 'score_cache_dir', None):
+            self.score_cache = ScoreCache(args.score_cache_dir, checkpoint_file,
+                                          int(getattr(args, 'score_cache_size', 100.) * 2**30),
+                                          getattr(args, 'score_cache_dtype', 'float16'), self.class_groups)
+        # sparse scores: class scores only at the pixels lidar points land on, optionally from the
+        # low resolution decoder output instead of the upsampled logits
+        self.sparse_scores = getattr(args, 'sparse_scores', False)
+        self.sparse_lowres = self.sparse_scores and getattr(args, 'sparse_lowres', False)
+        assert not (self.sparse_scores and self.score_cache is not None), 'sparse scores cannot be cached'
 
         
     def get_lidar(self, idx):
@@ -57,6 +434,13 @@ class Painter:
         return torch.from_numpy(np.fromfile(str(lidar_file), dtype=np.float32).reshape(-1, 6))
 
     def get_image(self, idx, camera):
+        input_batch = self.load_image(idx, camera)
+        # move the input and model to GPU for speed if available
+        if torch.cuda.is_available():
+            input_batch = input_batch.to('cuda')
+        return input_batch
+
+    def load_image(self, idx, camera):
         filename = os.path.join(self.root_split_path, camera + ('%s.jpg' % idx))
         input_image = Image.open(filename)
         preprocess = transforms.Compose([
@@ -66,171 +450,358 @@ class Painter:
 
         input_tensor = preprocess(input_image)
         input_batch = input_tensor.unsqueeze(0) # create a mini-batch as expected by the model
-        if torch.cuda.is_available():
-            input_batch = input_batch.to('cuda')
-        # move the input and model to GPU for speed if available
-        if torch.cuda.is_available():
-            input_batch = input_batch.to('cuda')
         return input_batch
     
+    def get_num_cameras(self, idx):
+        calib_file = os.path.join(self.root_split_path, 'calib/' + ('%s.txt' % idx))
+        return get_num_cameras(get_calib_from_file(calib_file))
+
+    def get_images(self, idx, num_cameras=None):
+        if num_cameras is None:
+            num_cameras = self.get_num_cameras(idx)
+        return [self.get_image(idx, 'image_' + str(i) + '/') for i in range(num_cameras)]
+
+    def load_camera_inputs(self, idx, num_cameras=None):
+        """
+        Returns per camera either the cached scores (images[i] is None) or the decoded image (cached[i] is None).
+        The number of cameras is read from the calib file of the frame if not given.
+        """
+        if num_cameras is None:
+            num_cameras = self.get_num_cameras(idx)
+        images, cached = [], []
+        for i in range(num_cameras):
+            cached.append(self.score_cache.get(idx, i) if self.score_cache is not None else None)
+            images.append(self.load_image(idx, 'image_' + str(i) + '/') if cached[-1] is None else None)
+        return images, cached
+
+    def forward_model(self, input_batch):
+        if self.sparse_lowres:
+            # skips the bilinear upsampling to the input size, SparseScores interpolates at the points
+            return self.model.classifier(self.model.backbone(input_batch))
+        return self.model(input_batch)
+
     def get_model_output(self, input_batch):
         with torch.no_grad():
-            output = self.model(input_batch)[0]
+            output = self.forward_model(input_batch)[0]
         return output
 
+    def get_model_output_batched(self, input_batches):
+        """
+        Runs the segmentation network once per image resolution instead of once per image.
+
+        :param input_batches: list of (1, 3, H, W) tensors, H and W may differ between cameras
+        :return outputs: list of (19, H, W) tensors in the same order as input_batches,
+                         (19, H / 4, W / 4) with sparse_lowres
+        """
+        buckets = {}
+        for i, input_batch in enumerate(input_batches):
+            buckets.setdefault(tuple(input_batch.shape[-2:]), []).append(i)
+
+        outputs = [None] * len(input_batches)
+        with torch.no_grad():
+            for inds in buckets.values():
+                bucket_output = self.forward_model(torch.cat([input_batches[i] for i in inds], dim=0))
+                for j, i in enumerate(inds):
+                    outputs[i] = bucket_output[j]
+        return outputs
+
     def get_score(self, model_output):
-        sf = torch.nn.Softmax(dim=2)
-        output_permute = model_output.permute(1,2,0)
-        output_permute = sf(output_permute)
-        output_reassign = torch.zeros(output_permute.size(0),output_permute.size(1), 6).to(device=model_output.device)
-        output_reassign[:,:,0] = torch.sum(output_permute[:,:,:11], dim=2) # background
-        output_reassign[:,:,1] = output_permute[:,:,18] #bicycle
-        output_reassign[:,:,2] = torch.sum(output_permute[:,:,[13, 14, 15, 16]], dim=2) # vehicles
-        output_reassign[:,:,3] = output_permute[:,:,11] #person
-        output_reassign[:,:,4] = output_permute[:,:,12] #rider
-        output_reassign[:,:,5] = output_permute[:,:,17] # motorcycle
-
-        return output_reassign
-    
+        '''
+        :param model_output: (19, H, W) segmentation logits
+        :return: (H, W, n_groups) class group probabilities, see CLASS_GROUPS
+        '''
+        return reduce_class_scores(model_output, self.class_aggregation.to(model_output))
+
     def get_calib_fromfile(self, idx, device):
+        """
+        Reads the calib of a frame with the P{i} and Tr_velo_to_cam_{i} of every camera in it
+        and R0_rect as (4, 4) tensors on device.
+        """
         calib_file = os.path.join(self.root_split_path, 'calib/' + ('%s.txt' % idx))
         calib = get_calib_from_file(calib_file)
-        calib['P0'] = torch.cat([calib['P0'], torch.tensor([[0., 0., 0., 1.]])], axis=0).to(device=device)
-        calib['P1'] = torch.cat([calib['P1'], torch.tensor([[0., 0., 0., 1.]])], axis=0).to(device=device)
-        calib['P2'] = torch.cat([calib['P2'], torch.tensor([[0., 0., 0., 1.]])], axis=0).to(device=device)
-        calib['P3'] = torch.cat([calib['P3'], torch.tensor([[0., 0., 0., 1.]])], axis=0).to(device=device)
-        calib['P4'] = torch.cat([calib['P4'], torch.tensor([[0., 0., 0., 1.]])], axis=0).to(device=device)
+        for key in list(calib):
+            if re.fullmatch(r'P\d+|Tr_velo_to_cam_\d+', key):
+                calib[key] = torch.cat([calib[key], torch.tensor([[0., 0., 0., 1.]])], axis=0).to(device=device)
         calib['R0_rect'] = torch.zeros([4, 4], dtype=calib['R0'].dtype, device=device)
         calib['R0_rect'][3, 3] = 1.
         calib['R0_rect'][:3, :3] = calib['R0'].to(device=device)
-        calib['Tr_velo_to_cam_0'] = torch.cat([calib['Tr_velo_to_cam_0'], torch.tensor([[0., 0., 0., 1.]], )], axis=0).to(device=device)
-        calib['Tr_velo_to_cam_1'] = torch.cat([calib['Tr_velo_to_cam_1'], torch.tensor([[0., 0., 0., 1.]], )], axis=0).to(device=device)
-        calib['Tr_velo_to_cam_2'] = torch.cat([calib['Tr_velo_to_cam_2'], torch.tensor([[0., 0., 0., 1.]], )], axis=0).to(device=device)
-        calib['Tr_velo_to_cam_3'] = torch.cat([calib['Tr_velo_to_cam_3'], torch.tensor([[0., 0., 0., 1.]], )], axis=0).to(device=device)
-        calib['Tr_velo_to_cam_4'] = torch.cat([calib['Tr_velo_to_cam_4'], torch.tensor([[0., 0., 0., 1.]], )], axis=0).to(device=device)
         return calib
-    
-    def cam_to_lidar(self, pointcloud, projection_mats, camera_num):
+
+    def augment_lidar_class_scores_both(self, class_scores, lidar_raw, projection_mats):
+        """
+        Projects lidar points onto segmentation map, appends class score each point projects onto.
+        Works for any number of cameras, see paint_points for how the scores of overlapping cameras are merged.
         """
-        Takes in lidar in velo coords, returns lidar points in camera coords
+        return paint_points(class_scores, lidar_raw, projection_mats, self.cam_sync)
 
-        :param pointcloud: (n_points, 4) np.array (x,y,z,r) in velodyne coordinates
-        :return lidar_cam_coords: (n_points, 4) np.array (x,y,z,r) in camera coordinates
+    def get_scores_from_cam(self, sample_ids):
         """
+        Returns the class scores of every camera of every frame in sample_ids, list[list[(H, W, 6)]].
+        """
+        input_batches, cached, keys, offsets = [], [], [], [0]
+        for sample_idx in sample_ids:
+            images, cached_scores = self.load_camera_inputs(sample_idx)
+            input_batches.extend(images)
+            cached.extend(cached_scores)
+            keys.extend((sample_idx, i) for i in range(len(images)))
+            offsets.append(len(input_batches))
+        scores = self.get_scores(input_batches, cached, keys)
+        return [scores[offsets[i]:offsets[i + 1]] for i in range(len(sample_ids))]
 
-        lidar_velo_coords = copy.deepcopy(pointcloud)
-        reflectances = copy.deepcopy(lidar_velo_coords[:, -1]) #copy reflectances column
-        lidar_velo_coords[:, -1] = 1 # for multiplying with homogeneous matrix
-        lidar_cam_coords = projection_mats['Tr_velo_to_cam_' + str(camera_num)].matmul(lidar_velo_coords.transpose(0, 1))
-        lidar_cam_coords = lidar_cam_coords.transpose(0, 1)
-        lidar_cam_coords[:, -1] = reflectances
-        
-        return lidar_cam_coords
+    def get_scores(self, input_batches, cached=None, keys=None):
+        """
+        Returns the (H, W, 6) class scores of every input, list[(H, W, 6)], or list[SparseScores] with sparse_scores.
 
-    def project_points_mask(self, lidar_cam_points, projection_mats, class_scores, camera_num):
-        points_projected_on_mask = projection_mats['P' + str(camera_num)].matmul(projection_mats['R0_rect'].matmul(lidar_cam_points.transpose(0, 1)))
-        points_projected_on_mask = points_projected_on_mask.transpose(0, 1)
-        points_projected_on_mask = points_projected_on_mask/(points_projected_on_mask[:,2].reshape(-1,1))
+        :param input_batches: list of (1, 3, H, W) images, None where cached holds the scores
+        :param cached: list of scores from self.score_cache.get, None where the image must be segmented
+        :param keys: list of (sample_idx, camera) of every input, segmented scores are added to the cache
+        """
+        if cached is None:
+            cached = [None] * len(input_batches)
+        todo = [i for i, cached_scores in enumerate(cached) if cached_scores is None]
+        todo_batches = [input_batches[i].to(self.device, non_blocking=True) for i in todo]
+        if self.batched:
+            outputs = self.get_model_output_batched(todo_batches)
+        else:
+            outputs = [self.get_model_output(input_batch) for input_batch in todo_batches]
 
-        true_where_x_on_img = (0 < points_projected_on_mask[:, 0]) & (points_projected_on_mask[:, 0] < class_scores[camera_num].shape[1]) #x in img coords is cols of img
-        true_where_y_on_img = (0 < points_projected_on_mask[:, 1]) & (points_projected_on_mask[:, 1] < class_scores[camera_num].shape[0])
-        true_where_point_on_img = true_where_x_on_img & true_where_y_on_img & (lidar_cam_points[:, 2] > 0)
+        scores = [None] * len(input_batches)
+        for i, output in zip(todo, outputs):
+            if self.sparse_scores:
+                scores[i] = SparseScores(output, input_batches[i].shape[-2:], self.class_aggregation)
+                continue
+            scores[i] = self.get_score(output)
+            if self.score_cache is not None and keys is not None:
+                self.score_cache.put(*keys[i], scores[i])
+        for i, cached_scores in enumerate(cached):
+            if cached_scores is not None:
+                scores[i] = self.score_cache.to_scores(cached_scores, self.device)
+        return scores
 
-        points_projected_on_mask = points_projected_on_mask[true_where_point_on_img] # filter out points that don't project to image
-        points_projected_on_mask = torch.floor(points_projected_on_mask).int() # using floor so you don't end up indexing num_rows+1th row or col
-        points_projected_on_mask = points_projected_on_mask[:, :2] #drops homogenous coord 1 from every point, giving (N_pts, 2) int array
-        return (points_projected_on_mask, true_where_point_on_img)
+    def paint(self, sample_idx, scores_from_cam):
+        # points: N * 4(x, y, z, r)
+        points = self.get_lidar(sample_idx)
+        # scores_from_cam: H * W * 4/5, each pixel have 4/5 scores(0: background, 1: bicycle, 2: car, 3: person, 4: rider)
+        device = self.device
+        # get calibration data
+        calib_fromfile = self.get_calib_fromfile(sample_idx, device)
+        points = points.to(device=device)
 
-    def augment_lidar_class_scores_both(self, class_scores, lidar_raw, projection_mats):
+        # paint the point clouds
+        # points: N * 8
+        points = self.augment_lidar_class_scores_both(scores_from_cam, points, calib_fromfile).cpu()
+
+        self.save_painted(sample_idx, points.numpy())
+
+    def get_painted_path(self, sample_idx):
+        return self.save_path + ("%s.npy" % sample_idx)
+
+    def save_painted(self, sample_idx, points):
         """
-        Projects lidar points onto segmentation map, appends class score each point projects onto.
+        Writes the painted points atomically and records their size and md5 in the manifest.
         """
-        #lidar_cam_coords = self.cam_to_lidar(lidar_raw, projection_mats)
-        # TODO: Project lidar points onto left and right segmentation maps. How to use projection_mats? 
-        ################################
-        lidar_cam_coords = self.cam_to_lidar(lidar_raw[:,:4], projection_mats, 0)
+        buffer = io.BytesIO()
+        np.save(buffer, points)
+        data = buffer.getbuffer()
+        file_path = self.get_painted_path(sample_idx)
+        with open(file_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(file_path + '.tmp', file_path)
+        if self.manifest is not None:
+            self.manifest.add(sample_idx, len(data), hashlib.md5(data).hexdigest())
 
-        # right
-        lidar_cam_coords[:, -1] = 1 #homogenous coords for projection
-        # TODO: change projection_mats['P2'] and projection_mats['R0_rect'] to be?
-        points_projected_on_mask_0, true_where_point_on_img_0 = self.project_points_mask(lidar_cam_coords, projection_mats, class_scores, 0)
-        
-        # left
-        lidar_cam_coords = self.cam_to_lidar(lidar_raw[:,:4], projection_mats, 1)
-        lidar_cam_coords[:, -1] = 1 #homogenous coords for projection
-        # TODO: change projection_mats['P2'] and projection_mats['R0_rect'] to be?
-        points_projected_on_mask_1, true_where_point_on_img_1 = self.project_points_mask(lidar_cam_coords, projection_mats, class_scores, 1)
-        
-        lidar_cam_coords = self.cam_to_lidar(lidar_raw[:,:4], projection_mats, 2)
-        lidar_cam_coords[:, -1] = 1
-        points_projected_on_mask_2, true_where_point_on_img_2 = self.project_points_mask(lidar_cam_coords, projection_mats, class_scores, 2)
-        
-        lidar_cam_coords = self.cam_to_lidar(lidar_raw[:,:4], projection_mats, 3)
-        lidar_cam_coords[:, -1] = 1
-        points_projected_on_mask_3, true_where_point_on_img_3 = self.project_points_mask(lidar_cam_coords, projection_mats, class_scores, 3)
-        
-        lidar_cam_coords = self.cam_to_lidar(lidar_raw[:,:4], projection_mats, 4)
-        lidar_cam_coords[:, -1] = 1
-        points_projected_on_mask_4, true_where_point_on_img_4 = self.project_points_mask(lidar_cam_coords, projection_mats, class_scores, 4)
-
-        true_where_point_on_both_0_1 = true_where_point_on_img_0 & true_where_point_on_img_1
-        true_where_point_on_both_0_2 = true_where_point_on_img_0 & true_where_point_on_img_2
-        true_where_point_on_both_1_3 = true_where_point_on_img_1 & true_where_point_on_img_3
-        true_where_point_on_both_2_4 = true_where_point_on_img_2 & true_where_point_on_img_4
-        true_where_point_on_img = true_where_point_on_img_1 | true_where_point_on_img_0 | true_where_point_on_img_2 | true_where_point_on_img_3 | true_where_point_on_img_4
-
-        point_scores_0 = class_scores[0][points_projected_on_mask_0[:, 1], points_projected_on_mask_0[:, 0]].reshape(-1, class_scores[0].shape[2])
-        point_scores_1 = class_scores[1][points_projected_on_mask_1[:, 1], points_projected_on_mask_1[:, 0]].reshape(-1, class_scores[1].shape[2])
-        point_scores_2 = class_scores[2][points_projected_on_mask_2[:, 1], points_projected_on_mask_2[:, 0]].reshape(-1, class_scores[2].shape[2])
-        point_scores_3 = class_scores[3][points_projected_on_mask_3[:, 1], points_projected_on_mask_3[:, 0]].reshape(-1, class_scores[3].shape[2])
-        point_scores_4 = class_scores[4][points_projected_on_mask_4[:, 1], points_projected_on_mask_4[:, 0]].reshape(-1, class_scores[4].shape[2])
-
-        augmented_lidar = torch.cat((lidar_raw[:,:5], torch.zeros((lidar_raw.shape[0], class_scores[1].shape[2])).to(device=lidar_raw.device)), axis=1)
-        augmented_lidar[true_where_point_on_img_0, -class_scores[0].shape[2]:] += point_scores_0
-        augmented_lidar[true_where_point_on_img_1, -class_scores[1].shape[2]:] += point_scores_1
-        augmented_lidar[true_where_point_on_img_2, -class_scores[2].shape[2]:] += point_scores_2
-        augmented_lidar[true_where_point_on_img_3, -class_scores[3].shape[2]:] += point_scores_3
-        augmented_lidar[true_where_point_on_img_4, -class_scores[4].shape[2]:] += point_scores_4
-        augmented_lidar[true_where_point_on_both_0_1, -class_scores[0].shape[2]:] = 0.5 * augmented_lidar[true_where_point_on_both_0_1, -class_scores[0].shape[2]:]
-        augmented_lidar[true_where_point_on_both_0_2, -class_scores[0].shape[2]:] = 0.5 * augmented_lidar[true_where_point_on_both_0_2, -class_scores[0].shape[2]:]
-        augmented_lidar[true_where_point_on_both_1_3, -class_scores[1].shape[2]:] = 0.5 * augmented_lidar[true_where_point_on_both_1_3, -class_scores[1].shape[2]:]
-        augmented_lidar[true_where_point_on_both_2_4, -class_scores[2].shape[2]:] = 0.5 * augmented_lidar[true_where_point_on_both_2_4, -class_scores[2].shape[2]:]
-        if self.cam_sync:
-            augmented_lidar = augmented_lidar[true_where_point_on_img]
-
-        return augmented_lidar
+    def load_frame(self, sample_idx):
+        """
+        Reads the lidar points, camera images and calibration of one frame into host memory.
+        """
+        start_time = time.perf_counter()
+        calib = self.get_calib_fromfile(sample_idx, 'cpu')
+        images, cached = self.load_camera_inputs(sample_idx, get_num_cameras(calib))
+        frame = dict(
+            sample_idx=sample_idx,
+            points=self.get_lidar(sample_idx),
+            images=images,
+            cached=cached,
+            calib=calib
+        )
+        return frame, time.perf_counter() - start_time
 
-    def run(self):
+    def run_pipelined(self, sample_ids):
+        """
+        Paints sample_ids with three overlapping stages:
+        1. a pool of num_workers threads decodes images, lidar and calib up to prefetch frames ahead,
+        2. the main thread runs segmentation and projection on self.device,
+        3. a writer thread saves the painted points, at most write_queue_size frames are waiting.
+        Returns the accumulated seconds spent in every stage.
+        """
+        timings = dict(load=0., segmentation=0., projection=0., write=0.)
+        write_queue = queue.Queue(maxsize=self.write_queue_size)
+        write_errors = []
+
+        def write_worker():
+            while True:
+                item = write_queue.get()
+                if item is None:
+                    break
+                if write_errors:
+                    continue
+                start_time = time.perf_counter()
+                try:
+                    self.save_painted(*item)
+                except Exception as e:
+                    write_errors.append(e)
+                timings['write'] += time.perf_counter() - start_time
+
+        writer = threading.Thread(target=write_worker, daemon=True)
+        writer.start()
+        batch_frames = self.batch_frames if self.batched else 1
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as pool, tqdm(total=len(sample_ids)) as pbar:
+                pending = deque()
+                next_id = 0
+                while next_id < len(sample_ids) or pending:
+                    # keep the I/O workers busy with the next frames
+                    while next_id < len(sample_ids) and len(pending) < max(self.prefetch, batch_frames):
+                        pending.append(pool.submit(self.load_frame, sample_ids[next_id]))
+                        next_id += 1
+
+                    frames = []
+                    for _ in range(min(batch_frames, len(pending))):
+                        frame, load_time = pending.popleft().result()
+                        timings['load'] += load_time
+                        frames.append(frame)
+
+                    start_time = time.perf_counter()
+                    input_batches = [image for frame in frames for image in frame['images']]
+                    cached = [cached_scores for frame in frames for cached_scores in frame['cached']]
+                    keys = [(frame['sample_idx'], i) for frame in frames for i in range(len(frame['images']))]
+                    scores = self.get_scores(input_batches, cached, keys)
+                    timings['segmentation'] += time.perf_counter() - start_time
+
+                    start_time = time.perf_counter()
+                    start = 0
+                    for frame in frames:
+                        calib = {k: v.to(self.device) for k, v in frame['calib'].items()}
+                        end = start + len(frame['images'])
+                        points = self.augment_lidar_class_scores_both(scores[start:end],
+                                                                      frame['points'].to(self.device), calib).cpu().numpy()
+                        start = end
+                        write_queue.put((frame['sample_idx'], points))
+                    timings['projection'] += time.perf_counter() - start_time
+
+                    if write_errors:
+                        raise write_errors[0]
+                    pbar.update(len(frames))
+        finally:
+            write_queue.put(None)
+            writer.join()
+        if write_errors:
+            raise write_errors[0]
+
+        print('Per-stage time (ms/frame): ' + ', '.join(f'{k}: {v / max(len(sample_ids), 1) * 1000:.1f}' for k, v in timings.items()))
+        return timings
+
+    def get_sample_ids(self):
+        """
+        Returns the frames of this shard that still need painting.
+        """
         image_files = os.listdir(os.path.join(self.root_split_path, 'image_0'))
-        for img_file in tqdm(image_files):
-            
-            sample_idx = os.path.splitext(img_file)[0]
-            # points: N * 4(x, y, z, r)
-            points = self.get_lidar(sample_idx)
-            
-            # get segmentation score from network
-            scores_from_cam = []
-            for i in range(5):
-                input_batch = self.get_image(sample_idx, 'image_' + str(i) + '/')
-                output = self.get_model_output(input_batch)
-                scores_from_cam.append(self.get_score(output))
-            # scores_from_cam: H * W * 4/5, each pixel have 4/5 scores(0: background, 1: bicycle, 2: car, 3: person, 4: rider)
-            device = scores_from_cam[0].device
-            # get calibration data
-            calib_fromfile = self.get_calib_fromfile(sample_idx, device)
-            points = points.to(device=device)
-            
-            # paint the point clouds
-            # points: N * 8
-            points = self.augment_lidar_class_scores_both(scores_from_cam, points, calib_fromfile).cpu()
-            
-            np.save(self.save_path + ("%s.npy" % sample_idx), points)
+        # sorted so that every process derives the same shards
+        sample_ids = sorted(os.path.splitext(img_file)[0] for img_file in image_files)
+        sample_ids = sample_ids[self.shard_id::self.num_shards]
+        if self.skip_existing:
+            num_frames = len(sample_ids)
+            sample_ids = [sample_idx for sample_idx in sample_ids
+                          if not self.manifest.is_complete(sample_idx, self.get_painted_path(sample_idx))]
+            print(f'Shard {self.shard_id}/{self.num_shards}: skipping {num_frames - len(sample_ids)} of {num_frames} painted frames')
+        return sample_ids
+
+    def run(self):
+        self.manifest = PaintManifest(self.save_path, '%dof%d' % (self.shard_id, self.num_shards))
+        try:
+            sample_ids = self.get_sample_ids()
+            if self.pipelined:
+                self.run_pipelined(sample_ids)
+            else:
+                self.run_serial(sample_ids)
+        finally:
+            self.manifest.close()
+            self.manifest = None
+
+    def run_serial(self, sample_ids):
+        batch_frames = self.batch_frames if self.batched else 1
+        with tqdm(total=len(sample_ids)) as pbar:
+            for i in range(0, len(sample_ids), batch_frames):
+                batch_ids = sample_ids[i:i + batch_frames]
+                # get segmentation score from network
+                batch_scores = self.get_scores_from_cam(batch_ids)
+                for sample_idx, scores_from_cam in zip(batch_ids, batch_scores):
+                    self.paint(sample_idx, scores_from_cam)
+                pbar.update(len(batch_ids))
+
+def paint_shard(proc_id, args, cores):
+    """
+    Entry point of one launcher process, paints shard proc_id of the num_procs shards of args.shard_id.
+    """
+    if cores:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(proc_id % torch.cuda.device_count())
+    args = copy.copy(args)
+    args.shard_id = args.shard_id * args.num_procs + proc_id
+    args.num_shards = args.num_shards * args.num_procs
+    painter = Painter(args)
+    painter.run()
+
+def launch(args):
+    """
+    Splits this machine's shard over num_procs processes, each pinned to its own group of cores.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        core_groups = [group.tolist() for group in np.array_split(cores, args.num_procs)]
+    else:
+        core_groups = [None] * args.num_procs
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=paint_shard, args=(i, args, core_groups[i])) for i in range(args.num_procs)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    failed = [i for i, proc in enumerate(procs) if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'painting processes {failed} failed, rerun with --skip_existing to resume')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Configuration Parameters')
     parser.add_argument('--training_path', help='your data root for the training data', required=True)
     parser.add_argument('--model_path', help='path to segmentation model', required=True)
     parser.add_argument('--cam_sync', action='store_true', help='only use objects visible to a camera')
+    parser.add_argument('--batched', action='store_true', help='run all cameras of a frame through the segmentation network in one forward pass')
+    parser.add_argument('--batch_frames', type=int, default=1, help='number of frames per forward pass when --batched is set')
+    parser.add_argument('--pipelined', action='store_true', help='overlap I/O, segmentation and writing of painted points')
+    parser.add_argument('--num_workers', type=int, default=4, help='number of I/O workers when --pipelined is set')
+    parser.add_argument('--prefetch', type=int, default=8, help='number of frames loaded ahead when --pipelined is set')
+    parser.add_argument('--write_queue_size', type=int, default=8, help='max painted frames waiting to be saved when --pipelined is set')
+    parser.add_argument('--num_shards', type=int, default=1, help='split the frames into this many shards, e.g. one per machine')
+    parser.add_argument('--shard_id', type=int, default=0, help='which shard to paint, in [0, num_shards)')
+    parser.add_argument('--skip_existing', action='store_true', help='skip frames whose output matches the size and md5 in the manifest')
+    parser.add_argument('--num_procs', type=int, default=1, help='number of painting processes, each pinned to a group of cores')
+    parser.add_argument('--score_cache_dir', default=None, help='cache segmentation scores here, keyed by checkpoint and image')
+    parser.add_argument('--score_cache_size', type=float, default=100., help='max size of the score cache in GB')
+    parser.add_argument('--score_cache_dtype', default='float16', choices=['float16', 'uint8'], help='storage type of cached scores')
+    parser.add_argument('--class_groups', default='cityscapes',
+                        help='segmentation classes merged into each painted class, a name in CLASS_GROUPS or a json list of class id lists')
+    parser.add_argument('--sparse_scores', action='store_true', help='compute class scores only at the pixels lidar points project onto')
+    parser.add_argument('--sparse_lowres', action='store_true',
+                        help='with --sparse_scores, interpolate the low resolution decoder output at the points instead of upsampling it')
     args = parser.parse_args()
-    painter = Painter(args)
-    painter.run()
\ No newline at end of file
+    if args.class_groups not in CLASS_GROUPS:
+        args.class_groups = json.loads(args.class_groups)
+    assert 0 <= args.shard_id < args.num_shards
+    if args.num_procs > 1:
+        launch(args)
+    else:
+        painter = Painter(args)
+        painter.run()
\ No newline at end of file
@@ -5,7 +5,7 @@ from tqdm import tqdm
 import pdb
 
 from utils import setup_seed
-from dataset import Waymo, get_dataloader
+from dataset import Waymo, get_dataloader, to_device
 from model import PointPillars
 from loss import Loss
 from torch.utils.tensorboard import SummaryWriter
@@ -25,20 +25,22 @@ def save_summary(writer, loss_dict, global_step, tag, lr=None, momentum=None):
 def main(rank, args, world_size):
     setup_seed()
     train_dataset = Waymo(data_root=args.data_root,
-                          split='train', painted=args.painted, cam_sync=args.cam_sync, interval = args.load_interval)
+                          split='train', painted=args.painted, cam_sync=args.cam_sync, interval = args.load_interval,
+                          packed=args.packed)
     train_dataloader, sampler = get_dataloader(dataset=train_dataset, 
                                       batch_size=args.batch_size, 
                                       num_workers=args.num_workers,
                                       rank=rank,
                                       world_size=world_size,
-                                      shuffle=True)
+                                      shuffle=True,
+                                      concat_pts=args.concat_pts)
 
     if not args.no_cuda:
-        pointpillars = PointPillars(nclasses=args.nclasses, painted=args.painted).cuda()
+        pointpillars = PointPillars(nclasses=args.nclasses, painted=args.painted, max_num_points=args.max_num_points, dynamic_pillars=args.dynamic_pillars).cuda()
         pointpillars = torch.nn.SyncBatchNorm.convert_sync_batchnorm(pointpillars)
         pointpillars = DDP(pointpillars, device_ids=[rank], output_device=rank)
     else:
-        pointpillars = PointPillars(nclasses=args.nclasses, painted=args.painted)
+        pointpillars = PointPillars(nclasses=args.nclasses, painted=args.painted, max_num_points=args.max_num_points, dynamic_pillars=args.dynamic_pillars)
     loss_func = Loss()
 
     init_lr = args.init_lr
@@ -78,10 +80,7 @@ def main(rank, args, world_size):
             for i, data_dict in enumerate(train_dataloader):
                 if not args.no_cuda:
                     # move the tensors to the cuda
-                    for key in data_dict:
-                        for j, item in enumerate(data_dict[key]):
-                            if torch.is_tensor(item):
-                                data_dict[key][j] = data_dict[key][j].cuda()
+                    data_dict = to_device(data_dict, 'cuda')
                 
                 optimizer.zero_grad()
 
@@ -93,7 +92,8 @@ def main(rank, args, world_size):
                     pointpillars(batched_pts=batched_pts, 
                                 mode='train',
                                 batched_gt_bboxes=batched_gt_bboxes, 
-                                batched_gt_labels=batched_labels)
+                                batched_gt_labels=batched_labels,
+                                batched_pts_offsets=data_dict.get('batched_pts_offsets'))
                 
                 bbox_cls_pred = bbox_cls_pred.permute(0, 2, 3, 1).reshape(-1, args.nclasses)
                 bbox_pred = bbox_pred.permute(0, 2, 3, 1).reshape(-1, 7)
@@ -175,6 +175,10 @@ if __name__ == '__main__':
     parser.add_argument('--ckpt_freq_epoch', type=int, default=5)
     parser.add_argument('--painted', action='store_true', help='if using painted lidar points')
     parser.add_argument('--cam_sync', action='store_true', help='only use objects visible to a camera')
+    parser.add_argument('--packed', action='store_true', help='read infos and points from the packed stores of data_prep/pack_points.py')
+    parser.add_argument('--concat_pts', action='store_true', help='collate the points of a batch into one pinned tensor')
+    parser.add_argument('--dynamic_pillars', action='store_true', help='encode pillars from the flat point list instead of padding them to max_num_points')
+    parser.add_argument('--max_num_points', type=int, default=20, help='max points per pillar, -1 keeps all points with --dynamic_pillars')
     parser.add_argument('--no_cuda', action='store_true',
                         help='whether to use cuda')
     parser.add_argument('--local-rank', default=0, type=int)
@@ -1,9 +1,13 @@
 from .io import read_pickle, write_pickle, read_points, write_points, read_calib, \
-    read_label, write_label
+    read_label, write_label, PointStore, write_point_store, InfoStore, write_info_store
 from .process import bbox_camera2lidar, bbox3d2bevcorners, box_collision_test, \
     remove_pts_in_bboxes, limit_period, bbox3d2corners, points_lidar2image, \
     keep_bbox_from_image_range, keep_bbox_from_lidar_range, \
     points_camera2lidar, setup_seed, remove_outside_points, points_in_bboxes_v2, \
-    get_points_num_in_bbox, iou2d_nearest, iou2d, iou3d, iou3d_camera, iou_bev, \
-    bbox3d2corners_camera, points_camera2image
+    get_points_num_in_bbox, iou2d_nearest, iou2d, iou2d_aligned, nearest_bev, iou3d, iou3d_camera, iou_bev, \
+    iou3d_camera_aligned, iou_bev_aligned, bbox3d2corners_camera, points_camera2image
+from .evaluation import get_score_thresholds, get_pair_inds, compute_frame_ious, compute_ious, \
+    get_breakdowns, get_breakdown_masks, restrict_ignores, get_ignores, collect_tp_scores, compute_statistics, \
+    compute_ap, collect_events, IncrementalEvaluator, \
+    EVAL_TYPES, MIN_IOUS, MIN_HEIGHT, LEVEL_2_MAX_POINTS
 from .vis_o3d import vis_pc, vis_img_3d
\ No newline at end of file
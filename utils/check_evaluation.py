@@ -0,0 +1,328 @@
+import argparse
+import os
+import sys
+import numpy as np
+import torch
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(BASE))
+
+from utils import iou2d, iou_bev, iou3d_camera, compute_ious, get_score_thresholds, IncrementalEvaluator, \
+    EVAL_TYPES, MIN_IOUS, MIN_HEIGHT
+
+
+CLASSES = {'Pedestrian': 0, 'Cyclist': 1, 'Car': 2}
+NAMES = np.array(['Pedestrian', 'Cyclist', 'Car', 'Van', 'Person_sitting', 'DontCare'])
+
+
+def make_frames(num_frames, seed, score_decimals=None):
+    '''
+    Synthetic gt and det annos. The dets are noisy copies of the gts, some with another class,
+    next to empty frames, frames without dets, ignored difficulties, DontCare, Van and Person_sitting.
+    score_decimals: round the scores, so that several dets share a score
+    return: gt_annos, det_annos, lists of the annos of the frames
+    '''
+    rng = np.random.default_rng(seed)
+    gt_annos, det_annos = [], []
+    for _ in range(num_frames):
+        # n gts and one more box that only dets are made of
+        n = rng.integers(0, 8) if rng.random() > 0.1 else 0
+        location, dimensions = rng.uniform(-40, 40, (n + 1, 3)), rng.uniform(0.5, 4, (n + 1, 3))
+        corner = rng.uniform(0, 1000, (n + 1, 2))
+        objects = {'name': rng.choice(NAMES, n + 1, p=[.25, .15, .3, .1, .1, .1]),
+                   'difficulty': rng.choice([-1, 0, 1], n + 1, p=[.1, .8, .1]),
+                   'bbox': np.concatenate([corner, corner + rng.uniform(5, 200, (n + 1, 2))], axis=-1),
+                   'alpha': rng.uniform(-3, 3, n + 1),
+                   'location': location,
+                   'dimensions': dimensions,
+                   'rotation_y': rng.uniform(-3, 3, n + 1),
+                   'num_points_in_gt': rng.integers(0, 20, n + 1)}
+        gt = {key: value[:n] for key, value in objects.items()}
+
+        m = rng.integers(0, 12) if rng.random() > 0.15 else 0
+        src = rng.integers(0, n + 1, m)
+        names = np.where(rng.random(m) < 0.8, objects['name'][src], rng.choice(NAMES[:3], m))
+        scores = rng.random(m)
+        det = {'name': np.where(np.isin(names, NAMES[:3]), names, 'Car'),
+               'bbox': objects['bbox'][src] + rng.normal(0, 3, (m, 4)),
+               'alpha': objects['alpha'][src] + rng.normal(0, 0.3, m),
+               'location': location[src] + rng.normal(0, 0.15, (m, 3)),
+               'dimensions': dimensions[src] * rng.uniform(0.8, 1.2, (m, 3)),
+               'rotation_y': objects['rotation_y'][src] + rng.normal(0, 0.1, m),
+               'score': scores if score_decimals is None else np.round(scores, score_decimals)}
+        gt_annos.append(gt)
+        det_annos.append(det)
+    return gt_annos, det_annos
+
+
+def reference_ious(gt_annos, det_annos):
+    '''
+    The 2d, bev and 3d ious frame by frame, as step 1 of the original do_eval on the cpu.
+    return: dict(eval_type -> [(n_i, m_i) ious of frame i])
+    '''
+    ious = {eval_type: [] for eval_type in EVAL_TYPES}
+    for gt_anno, det_anno in zip(gt_annos, det_annos):
+        gt_bboxes2d = gt_anno['bbox'].astype(np.float32)
+        det_bboxes2d = det_anno['bbox'].astype(np.float32)
+        ious['bbox_2d'].append(iou2d(torch.from_numpy(gt_bboxes2d), torch.from_numpy(det_bboxes2d)).numpy())
+
+        gt_bboxes3d = np.concatenate([gt_anno['location'], gt_anno['dimensions'], gt_anno['rotation_y'][:, None]],
+                                     axis=-1).astype(np.float32)
+        det_bboxes3d = np.concatenate([det_anno['location'].reshape(-1, 3), det_anno['dimensions'].reshape(-1, 3),
+                                       det_anno['rotation_y'][:, None]], axis=-1).astype(np.float32)
+        gt_bev, det_bev = gt_bboxes3d[:, [0, 2, 3, 5, 6]], det_bboxes3d[:, [0, 2, 3, 5, 6]]
+        ious['bbox_bev'].append(iou_bev(torch.from_numpy(gt_bev), torch.from_numpy(det_bev)).numpy())
+        ious['bbox_3d'].append(iou3d_camera(torch.from_numpy(gt_bboxes3d), torch.from_numpy(det_bboxes3d)).numpy())
+    return ious
+
+
+def check_ious(gt_annos, det_annos, ref_ious, frames_per_chunk, num_workers):
+    '''
+    return: whether the ious of compute_ious are those of the frame by frame functions, the
+            dontcare ious those of iou2d(det bboxes, dontcare bboxes, metric=1)
+    '''
+    ious = compute_ious(gt_annos, det_annos, frames_per_chunk=frames_per_chunk, num_workers=num_workers)
+    ok = True
+    for eval_type in EVAL_TYPES:
+        eval_ious, iou_offsets = ious[eval_type]
+        for i, ref in enumerate(ref_ious[eval_type]):
+            ok &= np.array_equal(eval_ious[iou_offsets[i]:iou_offsets[i + 1]], ref.reshape(-1))
+    dc_ious, dc_iou_offsets = ious['dontcare']
+    for i, (gt_anno, det_anno) in enumerate(zip(gt_annos, det_annos)):
+        dc_bboxes = gt_anno['bbox'][gt_anno['name'] == 'DontCare']
+        ref = iou2d(torch.from_numpy(det_anno['bbox']), torch.from_numpy(dc_bboxes), metric=1).numpy().T
+        ok &= np.array_equal(dc_ious[dc_iou_offsets[i]:dc_iou_offsets[i + 1]], ref.reshape(-1))
+    return ok
+
+
+def reference_eval(gt_annos, det_annos, ious, difficulty=0, gt_in=None, det_in=None):
+    '''
+    The AP and AOS of the python loops of the original do_eval.
+    ious: dict(eval_type -> [(n_i, m_i) ious of frame i]), as reference_ious gives
+    gt_in, det_in: [(n_i, ) bool], [(m_i, ) bool], the gts and dets of a breakdown, the valid ones
+                   outside it are ignored
+    return: ap_results: dict(eval_type -> dict(cls -> [AP])), aos_results: dict(cls -> [AOS])
+    '''
+    ap_results, aos_results = {}, {}
+    for e_ind, eval_type in enumerate(EVAL_TYPES):
+        eval_ious = ious[eval_type]
+        ap_results[eval_type] = {}
+        for cls in CLASSES:
+            CLS_MIN_IOU = MIN_IOUS[cls][e_ind]
+            # 1. bbox property
+            total_gt_ignores, total_det_ignores, total_dc_bboxes = [], [], []
+            for i, (gt_anno, det_anno) in enumerate(zip(gt_annos, det_annos)):
+                gt_ignores, dc_bboxes = [], []
+                for j, cur_gt_name in enumerate(gt_anno['name']):
+                    ignore = gt_anno['difficulty'][j] < 0 or gt_anno['difficulty'][j] > difficulty
+                    if cur_gt_name == cls:
+                        valid_class = 1
+                    elif cls == 'Pedestrian' and cur_gt_name == 'Person_sitting':
+                        valid_class = 0
+                    elif cls == 'Car' and cur_gt_name == 'Van':
+                        valid_class = 0
+                    else:
+                        valid_class = -1
+                    if valid_class == 1 and not ignore:
+                        gt_ignores.append(0)
+                    elif valid_class == 0 or (valid_class == 1 and ignore):
+                        gt_ignores.append(1)
+                    else:
+                        gt_ignores.append(-1)
+                    if gt_in is not None and gt_ignores[-1] == 0 and not gt_in[i][j]:
+                        gt_ignores[-1] = 1
+                    if cur_gt_name == 'DontCare':
+                        dc_bboxes.append(gt_anno['bbox'][j])
+                total_gt_ignores.append(gt_ignores)
+                total_dc_bboxes.append(np.array(dc_bboxes))
+
+                det_ignores = []
+                for j, cur_det_name in enumerate(det_anno['name']):
+                    if det_anno['bbox'][j, 3] - det_anno['bbox'][j, 1] < MIN_HEIGHT[difficulty]:
+                        det_ignores.append(1)
+                    elif cur_det_name == cls:
+                        det_ignores.append(0)
+                    else:
+                        det_ignores.append(-1)
+                    if det_in is not None and det_ignores[-1] == 0 and not det_in[i][j]:
+                        det_ignores[-1] = 1
+                total_det_ignores.append(det_ignores)
+
+            # 2. calculate scores thresholds for PR curve
+            tp_scores = []
+            for i, det_anno in enumerate(det_annos):
+                cur_eval_ious, scores = eval_ious[i], det_anno['score']
+                gt_ignores, det_ignores = total_gt_ignores[i], total_det_ignores[i]
+                nn, mm = cur_eval_ious.shape
+                assigned = np.zeros((mm, ), dtype=np.bool_)
+                for j in range(nn):
+                    if gt_ignores[j] == -1:
+                        continue
+                    match_id, match_score = -1, -1
+                    for k in range(mm):
+                        if not assigned[k] and det_ignores[k] >= 0 and cur_eval_ious[j, k] > CLS_MIN_IOU and \
+                            scores[k] > match_score:
+                            match_id = k
+                            match_score = scores[k]
+                    if match_id != -1:
+                        assigned[match_id] = True
+                        if det_ignores[match_id] == 0 and gt_ignores[j] == 0:
+                            tp_scores.append(match_score)
+            total_num_valid_gt = np.sum([np.sum(np.array(gt_ignores) == 0) for gt_ignores in total_gt_ignores])
+            score_thresholds = get_score_thresholds(tp_scores, total_num_valid_gt)
+
+            # 3. draw PR curve and calculate mAP
+            tps, fns, fps, total_aos = [], [], [], []
+            for score_threshold in score_thresholds:
+                tp, fn, fp, aos = 0, 0, 0, 0
+                for i, (gt_anno, det_anno) in enumerate(zip(gt_annos, det_annos)):
+                    cur_eval_ious, scores = eval_ious[i], det_anno['score']
+                    gt_ignores, det_ignores = total_gt_ignores[i], total_det_ignores[i]
+                    nn, mm = cur_eval_ious.shape
+                    assigned = np.zeros((mm, ), dtype=np.bool_)
+                    for j in range(nn):
+                        if gt_ignores[j] == -1:
+                            continue
+                        match_id, match_iou = -1, -1
+                        for k in range(mm):
+                            if not assigned[k] and det_ignores[k] >= 0 and scores[k] >= score_threshold and \
+                                cur_eval_ious[j, k] > CLS_MIN_IOU:
+                                if det_ignores[k] == 0 and cur_eval_ious[j, k] > match_iou:
+                                    match_iou = cur_eval_ious[j, k]
+                                    match_id = k
+                                elif det_ignores[k] == 1 and match_iou == -1:
+                                    match_id = k
+                        if match_id != -1:
+                            assigned[match_id] = True
+                            if det_ignores[match_id] == 0 and gt_ignores[j] == 0:
+                                tp += 1
+                                if eval_type == 'bbox_2d':
+                                    aos += (1 + np.cos(gt_anno['alpha'][j] - det_anno['alpha'][match_id])) / 2
+                        elif gt_ignores[j] == 0:
+                            fn += 1
+                    for k in range(mm):
+                        if det_ignores[k] == 0 and scores[k] >= score_threshold and not assigned[k]:
+                            fp += 1
+
+                    # in case 2d bbox evaluation, we should consider dontcare bboxes
+                    dc_bboxes = total_dc_bboxes[i]
+                    if eval_type == 'bbox_2d' and len(dc_bboxes) > 0:
+                        ious_dc_det = iou2d(torch.from_numpy(det_anno['bbox']), torch.from_numpy(dc_bboxes),
+                                            metric=1).numpy().T
+                        for j in range(len(dc_bboxes)):
+                            for k in range(mm):
+                                if det_ignores[k] == 0 and scores[k] >= score_threshold and not assigned[k] and \
+                                    ious_dc_det[j, k] > CLS_MIN_IOU:
+                                    fp -= 1
+                                    assigned[k] = True
+                tps.append(tp)
+                fns.append(fn)
+                fps.append(fp)
+                total_aos.append(aos)
+
+            tps, fns, fps = np.array(tps), np.array(fns), np.array(fps)
+            precisions = tps / (tps + fps)
+            for i in range(len(score_thresholds)):
+                precisions[i] = np.max(precisions[i:])
+            ap_results[eval_type][cls] = [sum(precisions[i] for i in range(0, len(score_thresholds), 4)) / 11 * 100]
+            if eval_type == 'bbox_2d':
+                similarity = np.array(total_aos) / (tps + fps)
+                for i in range(len(score_thresholds)):
+                    similarity[i] = np.max(similarity[i:])
+                aos_results[cls] = [sum(similarity[i] for i in range(0, len(score_thresholds), 4)) / 11 * 100]
+    return ap_results, aos_results
+
+
+def reference_breakdown_masks(gt_annos, det_annos, range_bins):
+    '''
+    The gts and dets of the LEVEL_1, LEVEL_2 and range breakdowns frame by frame.
+    return: list of (gt_in, det_in), lists of the (n_i, ) and (m_i, ) bool of the frames, in the order
+            of the breakdowns after 'overall'
+    '''
+    def in_range(annos, low, high):
+        return [(low <= dist) & (dist < high) for dist in
+                [np.linalg.norm(anno['location'].reshape(-1, 3)[:, [0, 2]], axis=-1) for anno in annos]]
+    all_dets = [np.ones(len(det_anno['name']), dtype=np.bool_) for det_anno in det_annos]
+    masks = [([gt_anno['num_points_in_gt'] > 5 for gt_anno in gt_annos], all_dets),
+             ([np.ones(len(gt_anno['name']), dtype=np.bool_) for gt_anno in gt_annos], all_dets)]
+    for low, high in zip(range_bins, list(range_bins[1:]) + [np.inf]):
+        masks.append((in_range(gt_annos, low, high), in_range(det_annos, low, high)))
+    return masks
+
+
+def main(args):
+    ok = True
+    for seed in range(args.num_sets):
+        gt_annos, det_annos = make_frames(args.num_frames, seed, score_decimals=2 if seed % 2 else None)
+        ref_ious = reference_ious(gt_annos, det_annos)
+        ref_ap, ref_aos = reference_eval(gt_annos, det_annos, ref_ious)
+
+        # the ious in chunks of frames, in one process and in a pool
+        for frames_per_chunk in args.frames_per_chunk:
+            for num_workers in [0, args.num_workers]:
+                iou_match = check_ious(gt_annos, det_annos, ref_ious, frames_per_chunk, num_workers)
+                ok &= iou_match
+                print(f'set {seed}, {frames_per_chunk} frames per chunk, {num_workers} workers: iou match {iou_match}')
+
+        # the ap has to be the same, the aos sums the same terms in another order
+        for frames_per_chunk in args.frames_per_chunk:
+            evaluator = IncrementalEvaluator(CLASSES, frames_per_chunk=frames_per_chunk)
+            for frame_id, (gt_anno, det_anno) in enumerate(zip(gt_annos, det_annos)):
+                evaluator.update(frame_id, det_anno, gt_anno)
+            ap, aos = evaluator.compute()
+            ap_match = ap == ref_ap
+            aos_diff = max(abs(aos[cls][0] - ref_aos[cls][0]) for cls in CLASSES)
+            ok &= ap_match and aos_diff < 1e-10
+            print(f'set {seed}, {frames_per_chunk} frames per chunk: AP match {ap_match}, max AOS diff {aos_diff:.2g}')
+
+        # rounded scores bound the state, the ap is sampled at the rounded scores
+        evaluator = IncrementalEvaluator(CLASSES, score_bins=args.score_bins)
+        for frame_id, (gt_anno, det_anno) in enumerate(zip(gt_annos, det_annos)):
+            evaluator.update(frame_id, det_anno, gt_anno)
+        ap, _ = evaluator.compute()
+        bounded = all(len(state['event_scores'][0]) <= args.score_bins + 1 and
+                      len(state['tp_scores'][0]) <= args.score_bins + 1 for state in evaluator.states.values())
+        ap_diff = max(abs(ap[eval_type][cls][0] - ref_ap[eval_type][cls][0]) for eval_type in EVAL_TYPES for cls in CLASSES)
+        ok &= bounded
+        print(f'set {seed}, {args.score_bins} score bins: bounded state {bounded}, max AP diff {ap_diff:.2g}')
+
+        # the breakdowns are matched in the same pass as the overall results
+        evaluator = IncrementalEvaluator(CLASSES, range_bins=args.range_bins, levels=True)
+        for frame_id, (gt_anno, det_anno) in enumerate(zip(gt_annos, det_annos)):
+            evaluator.update(frame_id, det_anno, gt_anno)
+        ap, _ = evaluator.compute()
+        ok &= ap == ref_ap
+        print(f'set {seed}, with breakdowns: overall AP match {ap == ref_ap}')
+        for breakdown, (gt_in, det_in) in zip(evaluator.breakdowns[1:],
+                                              reference_breakdown_masks(gt_annos, det_annos, args.range_bins)):
+            ap, _ = evaluator.compute(breakdown)
+            ap_match = ap == reference_eval(gt_annos, det_annos, ref_ious, gt_in=gt_in, det_in=det_in)[0]
+            ok &= ap_match
+            print(f'set {seed}, {breakdown}: AP match {ap_match}')
+
+    # the levels need num_points_in_gt
+    gt_annos = [{key: value for key, value in gt_anno.items() if key != 'num_points_in_gt'} for gt_anno in gt_annos]
+    evaluator = IncrementalEvaluator(CLASSES, levels=True)
+    try:
+        evaluator.update(0, det_annos[0], gt_annos[0])
+        evaluator.compute()
+        raised = False
+    except ValueError:
+        raised = True
+    ok &= raised
+    print(f'levels without num_points_in_gt: ValueError {raised}')
+    print('OK' if ok else 'MISMATCH')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the ious and the AP of the evaluation against the frame by frame ious and the python loops of do_eval')
+    parser.add_argument('--num_sets', type=int, default=4, help='synthetic sets, every other one with tied scores')
+    parser.add_argument('--num_frames', type=int, default=100, help='frames per set')
+    parser.add_argument('--frames_per_chunk', type=int, nargs='*', default=[1, 7, 256],
+                        help='chunk sizes of the iou stage and of the evaluator to check')
+    parser.add_argument('--score_bins', type=int, default=100, help='score bins of the bounded evaluator')
+    parser.add_argument('--range_bins', type=float, nargs='*', default=[0, 20, 40],
+                        help='edges of the range bins of the breakdowns to check')
+    parser.add_argument('--num_workers', type=int, default=2, help='processes of the pooled iou stage to check')
+    args = parser.parse_args()
+    sys.exit(0 if main(args) else 1)
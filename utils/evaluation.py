@@ -0,0 +1,621 @@
+import multiprocessing
+import numba
+import numpy as np
+import torch
+from .process import iou2d_aligned, iou3d_camera_aligned, iou_bev_aligned
+
+
+EVAL_TYPES = ['bbox_2d', 'bbox_bev', 'bbox_3d']
+# the iou thresholds of the eval types and the min det heights of the difficulties
+MIN_IOUS = {
+    'Pedestrian': [0.5, 0.5, 0.5],
+    'Cyclist': [0.5, 0.5, 0.5],
+    'Car': [0.7, 0.7, 0.7]
+}
+MIN_HEIGHT = [-1, -1, -1]
+# gts with at most this many lidar points are LEVEL_2, as in the waymo metrics
+LEVEL_2_MAX_POINTS = 5
+
+
+def get_score_thresholds(tp_scores, total_num_valid_gt, num_sample_pts=41):
+    score_thresholds = []
+    tp_scores = sorted(tp_scores)[::-1]
+    cur_recall, pts_ind = 0, 0
+    for i, score in enumerate(tp_scores):
+        lrecall = (i + 1) / total_num_valid_gt
+        rrecall = (i + 2) / total_num_valid_gt
+
+        if i == len(tp_scores) - 1:
+            score_thresholds.append(score)
+            break
+
+        if (lrecall + rrecall) / 2 < cur_recall:
+            continue
+
+        score_thresholds.append(score)
+        pts_ind += 1
+        cur_recall = pts_ind / (num_sample_pts - 1)
+    return score_thresholds
+
+
+def get_pair_inds(gt_offsets, det_offsets):
+    '''
+    gt_offsets: (frames + 1, ), det_offsets: (frames + 1, )
+    return:
+        gt_inds: (p, ), det_inds: (p, ), the (gt, det) pairs of all frames, those of frame i
+                 are the (n_i, m_i) matrix of frame i in row major order
+        iou_offsets: (frames + 1, ), the pairs of frame i start at iou_offsets[i]
+    '''
+    nums_gt, nums_det = np.diff(gt_offsets), np.diff(det_offsets)
+    iou_offsets = np.cumsum(np.concatenate([[0], nums_gt * nums_det]))
+    pair_frames = np.repeat(np.arange(len(nums_gt)), nums_gt * nums_det)
+    pair_inds = np.arange(iou_offsets[-1]) - iou_offsets[pair_frames]
+    gt_inds = gt_offsets[pair_frames] + pair_inds // nums_det[pair_frames]
+    det_inds = det_offsets[pair_frames] + pair_inds % nums_det[pair_frames]
+    return gt_inds, det_inds, iou_offsets
+
+
+def compute_frame_ious(gt_bboxes2d, gt_bboxes3d, gt_offsets, det_bboxes2d, det_bboxes3d, det_offsets,
+                       dc_bboxes, dc_det_bboxes, dc_offsets, device='cpu'):
+    '''
+    gt_bboxes2d: (n, 4), gt_bboxes3d: (n, 7), gt_offsets: (frames + 1, ), the gt bboxes of frame i start
+                 at gt_offsets[i]
+    det_bboxes2d: (m, 4), det_bboxes3d: (m, 7), det_offsets: (frames + 1, )
+    dc_bboxes: (n_dc, 4), dc_offsets: (frames + 1, ), the dontcare bboxes
+    dc_det_bboxes: (m, 4), the det bboxes in their own dtype for the dontcare ious
+    device: str, where the bev and 3d ious are computed, the 2d ones stay on the cpu
+    return: dict(eval_type -> (ious, iou_offsets)), the (n_i, m_i) ious of frame i flattened
+            at iou_offsets[i], 'dontcare' holds the (n_dc_i, m_i) ious over the det area
+    '''
+    gt_inds, det_inds, iou_offsets = get_pair_inds(gt_offsets, det_offsets)
+    gt_inds, det_inds = torch.from_numpy(gt_inds), torch.from_numpy(det_inds)
+    ious = {}
+
+    # 1. 2d bboxes iou
+    ious['bbox_2d'] = iou2d_aligned(torch.from_numpy(gt_bboxes2d)[gt_inds], torch.from_numpy(det_bboxes2d)[det_inds])
+
+    # 2. bev and 3d bboxes iou, one copy of the bboxes and of the pairs each way
+    gt_bboxes3d = torch.from_numpy(gt_bboxes3d).to(device)
+    det_bboxes3d = torch.from_numpy(det_bboxes3d).to(device)
+    gt_inds_device, det_inds_device = gt_inds.to(device), det_inds.to(device)
+    gt_bev, det_bev = gt_bboxes3d[:, [0, 2, 3, 5, 6]], det_bboxes3d[:, [0, 2, 3, 5, 6]]
+    ious['bbox_bev'] = iou_bev_aligned(gt_bev[gt_inds_device], det_bev[det_inds_device]).cpu()
+    ious['bbox_3d'] = iou3d_camera_aligned(gt_bboxes3d[gt_inds_device], det_bboxes3d[det_inds_device]).cpu()
+    ious = {eval_type: (eval_ious.numpy(), iou_offsets) for eval_type, eval_ious in ious.items()}
+
+    # 3. dets over the dontcare bboxes, for the 2d evaluation
+    dc_inds, dc_det_inds, dc_iou_offsets = get_pair_inds(dc_offsets, det_offsets)
+    dc_ious = iou2d_aligned(torch.from_numpy(dc_det_bboxes)[dc_det_inds], torch.from_numpy(dc_bboxes)[dc_inds], metric=1)
+    ious['dontcare'] = (dc_ious.numpy(), dc_iou_offsets)
+    return ious
+
+
+def compute_ious(gt_annos, det_annos, device='cpu', frames_per_chunk=1024, num_workers=0):
+    '''
+    gt_annos, det_annos: lists of the gt and det annos of the frames
+    device: str, where the bev and 3d ious are computed, 'cuda' or 'cpu'
+    frames_per_chunk: int, the frames of a chunk are computed together in a few kernel launches
+    num_workers: int, on the cpu the chunks are spread over this many processes if > 0
+    return: dict(eval_type -> (ious, iou_offsets)) of compute_frame_ious for all frames,
+            the same values as iou2d, iou_bev and iou3d_camera frame by frame
+    '''
+    def pack(annos, key, dim, dtype=np.float32):
+        return np.concatenate([np.zeros((0, dim), dtype=dtype)] +
+                              [anno[key].astype(dtype).reshape(-1, dim) for anno in annos])
+    def pack3d(annos):
+        return np.concatenate([pack(annos, 'location', 3), pack(annos, 'dimensions', 3),
+                               pack(annos, 'rotation_y', 1)], axis=-1)
+
+    dc_annos = [{'bbox': gt_anno['bbox'][gt_anno['name'] == 'DontCare']} for gt_anno in gt_annos]
+    dc_dtype = np.result_type(np.float32, *[anno['bbox'].dtype for anno in gt_annos + det_annos])
+    gt_bboxes2d, gt_bboxes3d = pack(gt_annos, 'bbox', 4), pack3d(gt_annos)
+    det_bboxes2d, det_bboxes3d = pack(det_annos, 'bbox', 4), pack3d(det_annos)
+    dc_bboxes, dc_det_bboxes = pack(dc_annos, 'bbox', 4, dc_dtype), pack(det_annos, 'bbox', 4, dc_dtype)
+    gt_offsets = np.cumsum([0] + [len(anno['name']) for anno in gt_annos])
+    det_offsets = np.cumsum([0] + [len(anno['name']) for anno in det_annos])
+    dc_offsets = np.cumsum([0] + [len(anno['bbox']) for anno in dc_annos])
+
+    chunks = []
+    for start in range(0, len(gt_annos), frames_per_chunk):
+        end = min(start + frames_per_chunk, len(gt_annos))
+        gt_slice = slice(gt_offsets[start], gt_offsets[end])
+        det_slice = slice(det_offsets[start], det_offsets[end])
+        dc_slice = slice(dc_offsets[start], dc_offsets[end])
+        chunks.append((gt_bboxes2d[gt_slice], gt_bboxes3d[gt_slice], gt_offsets[start:end + 1] - gt_offsets[start],
+                       det_bboxes2d[det_slice], det_bboxes3d[det_slice], det_offsets[start:end + 1] - det_offsets[start],
+                       dc_bboxes[dc_slice], dc_det_bboxes[det_slice], dc_offsets[start:end + 1] - dc_offsets[start],
+                       device))
+
+    if device == 'cpu' and num_workers > 0 and len(chunks) > 1:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(num_workers, initializer=torch.set_num_threads, initargs=(1, )) as pool:
+            chunk_ious = pool.starmap(compute_frame_ious, chunks)
+    else:
+        chunk_ious = [compute_frame_ious(*chunk) for chunk in chunks]
+
+    # the chunks one after the other, the offsets of a chunk continue from the end of the previous one
+    ious = {}
+    for eval_type in ['bbox_2d', 'bbox_bev', 'bbox_3d', 'dontcare']:
+        eval_ious = [item[eval_type][0] for item in chunk_ious]
+        chunk_starts = np.cumsum([0] + [len(item) for item in eval_ious])
+        iou_offsets = [item[eval_type][1][1:] + chunk_start for item, chunk_start in zip(chunk_ious, chunk_starts)]
+        ious[eval_type] = (np.concatenate([np.zeros((0, ), dtype=np.float32)] + eval_ious),
+                           np.concatenate([[0]] + iou_offsets))
+    return ious
+
+
+def get_ignores(gt_names, gt_difficulty, det_names, det_heights, cls, difficulty, min_height=-1):
+    '''
+    gt_names: (n, ), gt_difficulty: (n, ), the gt bboxes of all frames
+    det_names: (m, ), det_heights: (m, ), the det bboxes of all frames
+    return:
+        gt_ignores: (n, ), 0 for a valid gt of cls, 1 for an ignored one, -1 for the other classes
+        det_ignores: (m, ), 0 for a det of cls, 1 for an ignored one, -1 for the other classes
+    '''
+    ignore = (gt_difficulty < 0) | (gt_difficulty > difficulty)
+    valid_class = np.where(gt_names == cls, 1, -1)
+    if cls == 'Pedestrian':
+        valid_class[gt_names == 'Person_sitting'] = 0
+    elif cls == 'Car':
+        valid_class[gt_names == 'Van'] = 0
+    gt_ignores = np.full(len(gt_names), -1, dtype=np.int64)
+    gt_ignores[(valid_class == 0) | ((valid_class == 1) & ignore)] = 1
+    gt_ignores[(valid_class == 1) & ~ignore] = 0
+
+    det_ignores = np.where(det_names == cls, 0, -1)
+    det_ignores[det_heights < min_height] = 1
+    return gt_ignores, det_ignores
+
+
+def get_breakdowns(range_bins=None, levels=False):
+    '''
+    range_bins: list, the edges of the range bins in meters, the last bin is open ended
+    levels: bool, whether to break down by LEVEL_1 / LEVEL_2
+    return: list of the breakdown names, 'overall' first
+    '''
+    breakdowns = ['overall']
+    if levels:
+        breakdowns += ['LEVEL_1', 'LEVEL_2']
+    if range_bins:
+        for low, high in zip(range_bins, list(range_bins[1:]) + [np.inf]):
+            breakdowns.append(f'{low:g}-{high:g}m' if high != np.inf else f'{low:g}m+')
+    return breakdowns
+
+
+def get_breakdown_masks(gt_annos, det_annos, range_bins=None, levels=False):
+    '''
+    gt_annos, det_annos: lists of the gt and det annos of the frames
+    range_bins, levels: as in get_breakdowns, the levels need the num_points_in_gt of the gt annos
+    return: dict(breakdown -> (gt_in, det_in)), (n, ) and (m, ) bool, the gts and dets of the breakdown,
+            each bbox gets its range bin and level once
+    '''
+    num_gt = sum(len(gt_anno['name']) for gt_anno in gt_annos)
+    num_det = sum(len(det_anno['name']) for det_anno in det_annos)
+    masks = {'overall': (np.ones(num_gt, dtype=np.bool_), np.ones(num_det, dtype=np.bool_))}
+    if levels:
+        if not all('num_points_in_gt' in gt_anno for gt_anno in gt_annos):
+            raise ValueError('the LEVEL_1/LEVEL_2 breakdown needs num_points_in_gt in the gt annos, '
+                             'the infos of data_prep/create_info.py do not have it')
+        num_points = np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                    [gt_anno['num_points_in_gt'] for gt_anno in gt_annos])
+        is_level_1 = num_points > LEVEL_2_MAX_POINTS
+        # LEVEL_2 holds all gts, the dets are not split by level
+        masks['LEVEL_1'] = (is_level_1, masks['overall'][1])
+        masks['LEVEL_2'] = masks['overall']
+    if range_bins:
+        # the distance on the ground plane of the camera frame, x right and z forward
+        def get_bin_ids(annos):
+            location = np.concatenate([np.zeros((0, 3))] + [anno['location'].reshape(-1, 3) for anno in annos])
+            return np.digitize(np.linalg.norm(location[:, [0, 2]], axis=-1), range_bins) - 1
+        gt_bin_ids, det_bin_ids = get_bin_ids(gt_annos), get_bin_ids(det_annos)
+        for i, breakdown in enumerate(get_breakdowns(range_bins)[1:]):
+            masks[breakdown] = (gt_bin_ids == i, det_bin_ids == i)
+    return masks
+
+
+def restrict_ignores(gt_ignores, det_ignores, gt_in, det_in):
+    '''
+    gt_ignores, det_ignores: as in get_ignores
+    gt_in, det_in: the gts and dets of a breakdown as in get_breakdown_masks
+    return: gt_ignores, det_ignores with the valid gts and dets outside the breakdown ignored,
+            so the dets matching them are neither true nor false positives
+    '''
+    gt_ignores = np.where((gt_ignores == 0) & ~gt_in, 1, gt_ignores)
+    det_ignores = np.where((det_ignores == 0) & ~det_in, 1, det_ignores)
+    return gt_ignores, det_ignores
+
+
+@numba.jit(nopython=True)
+def collect_tp_scores(ious, iou_offsets, gt_offsets, det_offsets, gt_ignores, det_ignores, scores, min_iou):
+    '''
+    ious: the (n_i, m_i) ious of frame i flattened at iou_offsets[i]
+    gt_offsets: (frames + 1, ), det_offsets: (frames + 1, ), the bboxes of frame i
+                                                            start at gt_offsets[i] and det_offsets[i]
+    gt_ignores: (b, n), det_ignores: (b, m), the ignores of b breakdowns, which only differ in the
+                valid (0) bboxes some of them ignore (1), as restrict_ignores gives
+    scores: (m, )
+    return: tp_scores: (b, n), num_tps: (b, ), the scores of the true positives of breakdown i are
+            tp_scores[i, :num_tps[i]], every gt takes the highest scoring det left
+    '''
+    # the bboxes taking part in the matching are the same in all breakdowns, so is the matching
+    num_breakdowns = gt_ignores.shape[0]
+    tp_scores = np.empty(gt_ignores.shape, dtype=scores.dtype)
+    num_tps = np.zeros(num_breakdowns, dtype=np.int64)
+    for i in range(len(gt_offsets) - 1):
+        gt_start, det_start = gt_offsets[i], det_offsets[i]
+        nn, mm = gt_offsets[i + 1] - gt_start, det_offsets[i + 1] - det_start
+        cur_ious = ious[iou_offsets[i]:iou_offsets[i + 1]].reshape(nn, mm)
+        assigned = np.zeros((mm, ), dtype=np.bool_)
+        for j in range(nn):
+            if gt_ignores[0, gt_start + j] == -1:
+                continue
+            match_id, match_score = -1, -1.0
+            for k in range(mm):
+                if not assigned[k] and det_ignores[0, det_start + k] >= 0 and cur_ious[j, k] > min_iou and \
+                    scores[det_start + k] > match_score:
+                    match_id = k
+                    match_score = scores[det_start + k]
+            if match_id != -1:
+                assigned[match_id] = True
+                for b in range(num_breakdowns):
+                    if det_ignores[b, det_start + match_id] == 0 and gt_ignores[b, gt_start + j] == 0:
+                        tp_scores[b, num_tps[b]] = match_score
+                        num_tps[b] += 1
+    return tp_scores, num_tps
+
+
+@numba.jit(nopython=True)
+def compute_statistics(ious, iou_offsets, gt_offsets, det_offsets, gt_ignores, det_ignores, scores,
+                       aos_terms, dc_ious, dc_iou_offsets, dc_offsets, min_iou, dc_min_iou, score_thresholds,
+                       compute_aos):
+    '''
+    ious, iou_offsets, gt_offsets, det_offsets, scores: as in collect_tp_scores
+    gt_ignores: (n, ), det_ignores: (m, ), the ignores of one breakdown
+    aos_terms: (1 + cos(gt alpha - det alpha)) / 2 in the layout of ious, read if compute_aos
+    dc_ious: the (n_dc_i, m_i) ious over the det area of the dontcare bboxes of frame i
+             flattened at dc_iou_offsets[i], dc_offsets: (frames + 1, )
+    min_iou, dc_min_iou: the iou thresholds in the dtypes of ious and dc_ious
+    score_thresholds: (t, )
+    return: tps, fns, fps: (t, ), aos: (t, ), the sums run in the order of the frames and gts
+    '''
+    num_thresholds = len(score_thresholds)
+    tps = np.zeros(num_thresholds, dtype=np.int64)
+    fns = np.zeros(num_thresholds, dtype=np.int64)
+    fps = np.zeros(num_thresholds, dtype=np.int64)
+    aos = np.zeros(num_thresholds, dtype=aos_terms.dtype)
+    for t in range(num_thresholds):
+        score_threshold = score_thresholds[t]
+        for i in range(len(gt_offsets) - 1):
+            gt_start, det_start = gt_offsets[i], det_offsets[i]
+            nn, mm = gt_offsets[i + 1] - gt_start, det_offsets[i + 1] - det_start
+            cur_ious = ious[iou_offsets[i]:iou_offsets[i + 1]].reshape(nn, mm)
+            assigned = np.zeros((mm, ), dtype=np.bool_)
+            for j in range(nn):
+                gt_ignore = gt_ignores[gt_start + j]
+                if gt_ignore == -1:
+                    continue
+                match_id, match_iou = -1, -1.0
+                for k in range(mm):
+                    det_ignore = det_ignores[det_start + k]
+                    if not assigned[k] and det_ignore >= 0 and scores[det_start + k] >= score_threshold and \
+                        cur_ious[j, k] > min_iou:
+                        if det_ignore == 0 and cur_ious[j, k] > match_iou:
+                            match_iou = cur_ious[j, k]
+                            match_id = k
+                        elif det_ignore == 1 and match_iou == -1:
+                            match_id = k
+
+                if match_id != -1:
+                    assigned[match_id] = True
+                    if det_ignores[det_start + match_id] == 0 and gt_ignore == 0:
+                        tps[t] += 1
+                        if compute_aos:
+                            aos[t] += aos_terms[iou_offsets[i] + j * mm + match_id]
+                elif gt_ignore == 0:
+                    fns[t] += 1
+
+            for k in range(mm):
+                if det_ignores[det_start + k] == 0 and scores[det_start + k] >= score_threshold and not assigned[k]:
+                    fps[t] += 1
+
+            # dets in dontcare areas are not false positives
+            n_dc = dc_offsets[i + 1] - dc_offsets[i]
+            cur_dc_ious = dc_ious[dc_iou_offsets[i]:dc_iou_offsets[i + 1]].reshape(n_dc, mm)
+            for j in range(n_dc):
+                for k in range(mm):
+                    if det_ignores[det_start + k] == 0 and scores[det_start + k] >= score_threshold and \
+                        not assigned[k] and cur_dc_ious[j, k] > dc_min_iou:
+                        fps[t] -= 1
+                        assigned[k] = True
+    return tps, fns, fps, aos
+
+
+def compute_ap(tps, fns, fps, aos=None):
+    '''
+    tps, fns, fps: (t, ), the counts at the score thresholds
+    aos: (t, ) or None
+    return: AP and, with aos, AOS of the 11 point interpolated PR curve
+    '''
+    recalls = tps / (tps + fns)
+    precisions = tps / (tps + fps)
+    for i in range(len(precisions)):
+        precisions[i] = np.max(precisions[i:])
+
+    sums_AP = 0
+    for i in range(0, len(precisions), 4):
+        sums_AP += precisions[i]
+    mAP = sums_AP / 11 * 100
+    if aos is None:
+        return mAP
+
+    similarity = aos / (tps + fps)
+    for i in range(len(similarity)):
+        similarity[i] = np.max(similarity[i:])
+    sums_similarity = 0
+    for i in range(0, len(similarity), 4):
+        sums_similarity += similarity[i]
+    mSimilarity = sums_similarity / 11 * 100
+    return mAP, mSimilarity
+
+
+@numba.jit(nopython=True)
+def collect_events(ious, iou_offsets, gt_offsets, det_offsets, gt_ignores, det_ignores, scores,
+                   aos_terms, dc_ious, dc_iou_offsets, dc_offsets, min_iou, dc_min_iou, compute_aos):
+    '''
+    arguments: as in compute_statistics, but gt_ignores: (b, n), det_ignores: (b, m) of b breakdowns
+               as in collect_tp_scores
+    return: event_scores: (b, m), event_counts: (b, m, 3), event_aos: (b, m), num_events: (b, ), the
+            tp, fn, fp and aos of compute_statistics for breakdown i at a score threshold t are the
+            sums over its first num_events[i] events with a score >= t, on top of fn = the number
+            of valid gts
+    '''
+    num_breakdowns = gt_ignores.shape[0]
+    event_scores = np.empty(det_ignores.shape, dtype=scores.dtype)
+    event_counts = np.zeros((num_breakdowns, len(scores), 3), dtype=np.int64)
+    event_aos = np.zeros(det_ignores.shape, dtype=aos_terms.dtype)
+    num_events = np.zeros(num_breakdowns, dtype=np.int64)
+    for i in range(len(gt_offsets) - 1):
+        gt_start, det_start = gt_offsets[i], det_offsets[i]
+        nn, mm = gt_offsets[i + 1] - gt_start, det_offsets[i + 1] - det_start
+        cur_ious = ious[iou_offsets[i]:iou_offsets[i + 1]].reshape(nn, mm)
+        cur_aos_terms = aos_terms[iou_offsets[i]:iou_offsets[i + 1]].reshape(nn, mm)
+        n_dc = dc_offsets[i + 1] - dc_offsets[i]
+        cur_dc_ious = dc_ious[dc_iou_offsets[i]:dc_iou_offsets[i + 1]].reshape(n_dc, mm)
+
+        # 1. only the dets over the iou threshold of a gt take part in the matching, the others
+        #    are false positives from their score on unless they are in a dontcare area. the
+        #    candidates are the same in all breakdowns
+        is_candidate = np.zeros((mm, ), dtype=np.bool_)
+        for k in range(mm):
+            if det_ignores[0, det_start + k] < 0:
+                continue
+            for j in range(nn):
+                if gt_ignores[0, gt_start + j] != -1 and cur_ious[j, k] > min_iou:
+                    is_candidate[k] = True
+                    break
+            if not is_candidate[k]:
+                in_dc = False
+                for j in range(n_dc):
+                    if cur_dc_ious[j, k] > dc_min_iou:
+                        in_dc = True
+                if in_dc:
+                    continue
+                for b in range(num_breakdowns):
+                    if det_ignores[b, det_start + k] == 0:
+                        event_scores[b, num_events[b]] = scores[det_start + k]
+                        event_counts[b, num_events[b], 2] = 1
+                        num_events[b] += 1
+        candidates = np.nonzero(is_candidate)[0]
+        n_cand = len(candidates)
+        if n_cand == 0:
+            continue
+
+        # 2. the matching changes only at the scores of the candidates, the frame restricted to
+        #    them gives the statistics there. the restricted frame is shared, the matching
+        #    depends on the valid dets of the breakdown
+        cand_scores = scores[det_start + candidates]
+        score_thresholds = np.unique(cand_scores)[::-1]
+        cand_ious = np.ascontiguousarray(cur_ious[:, candidates]).reshape(-1)
+        cand_aos_terms = np.ascontiguousarray(cur_aos_terms[:, candidates]).reshape(-1)
+        cand_dc_ious = np.ascontiguousarray(cur_dc_ious[:, candidates]).reshape(-1)
+        for b in range(num_breakdowns):
+            cand_gt_ignores = gt_ignores[b, gt_start:gt_start + nn]
+            tps, fns, fps, aos = compute_statistics(
+                cand_ious, np.array([0, nn * n_cand]), np.array([0, nn]), np.array([0, n_cand]),
+                cand_gt_ignores, det_ignores[b][det_start + candidates], cand_scores, cand_aos_terms,
+                cand_dc_ious, np.array([0, n_dc * n_cand]), np.array([0, n_dc]), min_iou, dc_min_iou,
+                score_thresholds, compute_aos)
+            prev_tp, prev_fn, prev_fp, prev_aos = 0, np.sum(cand_gt_ignores == 0), 0, 0.0
+            for t in range(len(score_thresholds)):
+                event_scores[b, num_events[b]] = score_thresholds[t]
+                event_counts[b, num_events[b], 0] = tps[t] - prev_tp
+                event_counts[b, num_events[b], 1] = fns[t] - prev_fn
+                event_counts[b, num_events[b], 2] = fps[t] - prev_fp
+                event_aos[b, num_events[b]] = aos[t] - prev_aos
+                prev_tp, prev_fn, prev_fp, prev_aos = tps[t], fns[t], fps[t], aos[t]
+                num_events[b] += 1
+    return event_scores, event_counts, event_aos, num_events
+
+
+class IncrementalEvaluator():
+    '''
+    The KITTI style AP and AOS accumulated frame by frame. update() buffers the dets and gts of a
+    frame, every frames_per_chunk frames their ious are computed and matched, and only the counts
+    of the tp scores and the changes of the tp, fn, fp and aos counts at the det scores are kept
+    per eval type, class and breakdown. compute() gives the results of the frames seen so far.
+    The breakdowns by range bin and level share the ious, ignores and alignment of a chunk and are
+    matched in one pass over its frames, the dets that take part in the matching are found once.
+    By default the results are those of the original do_eval loops (utils/check_evaluation.py) and
+    the state holds one entry per distinct det score, so it grows with the number of frames. With
+    score_bins the scores in [0, 1] are rounded down to multiples of 1 / score_bins, the state has
+    at most score_bins + 1 entries per eval type, class and breakdown, and the PR curve is sampled
+    at the rounded scores.
+    '''
+    def __init__(self, CLASSES, device='cpu', frames_per_chunk=256, difficulty=0, range_bins=None, levels=False,
+                 score_bins=None):
+        self.CLASSES = CLASSES
+        self.device = device
+        self.frames_per_chunk = frames_per_chunk
+        self.difficulty = difficulty
+        self.range_bins = range_bins
+        self.levels = levels
+        self.score_bins = score_bins
+        self.breakdowns = get_breakdowns(range_bins, levels)
+        self.frame_ids = set()
+        self.pending = []
+        self.states = {(eval_type, cls, breakdown): {'tp_scores': [], 'tp_counts': [], 'num_valid_gt': 0,
+                                                     'event_scores': [], 'event_counts': [], 'event_aos': []}
+                       for eval_type in EVAL_TYPES for cls in CLASSES for breakdown in self.breakdowns}
+
+    def update(self, frame_id, dets, gts):
+        '''
+        frame_id: a frame is counted once, repeated ids are skipped
+        dets: dict, the formatted results of the frame
+        gts: dict, the annos of the frame
+        '''
+        if frame_id in self.frame_ids:
+            return
+        self.frame_ids.add(frame_id)
+        self.pending.append((dets, gts))
+        if len(self.pending) >= self.frames_per_chunk:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        det_annos, gt_annos = [item[0] for item in self.pending], [item[1] for item in self.pending]
+        self.pending = []
+
+        ious = compute_ious(gt_annos, det_annos, device=self.device, frames_per_chunk=len(gt_annos))
+        dc_ious, dc_iou_offsets = ious.pop('dontcare')
+        gt_names = np.concatenate([gt_anno['name'].astype(str) for gt_anno in gt_annos])
+        gt_difficulty = np.concatenate([gt_anno['difficulty'] for gt_anno in gt_annos])
+        det_names = np.concatenate([det_anno['name'].astype(str) for det_anno in det_annos])
+        det_heights = np.concatenate([det_anno['bbox'].reshape(-1, 4)[:, 3] - det_anno['bbox'].reshape(-1, 4)[:, 1]
+                                      for det_anno in det_annos])
+        scores = np.concatenate([det_anno['score'] for det_anno in det_annos])
+        gt_offsets = np.cumsum([0] + [len(gt_anno['name']) for gt_anno in gt_annos])
+        det_offsets = np.cumsum([0] + [len(det_anno['name']) for det_anno in det_annos])
+        dc_offsets = np.cumsum([0] + [np.sum(gt_anno['name'] == 'DontCare') for gt_anno in gt_annos])
+        no_dc_ious, no_dc_offsets = np.zeros((0, ), dtype=dc_ious.dtype), np.zeros_like(dc_offsets)
+
+        gt_inds, det_inds, _ = get_pair_inds(gt_offsets, det_offsets)
+        gt_alpha = np.concatenate([gt_anno['alpha'] for gt_anno in gt_annos])
+        det_alpha = np.concatenate([det_anno['alpha'] for det_anno in det_annos])
+        aos_terms = (1 + np.cos(gt_alpha[gt_inds] - det_alpha[det_inds])) / 2
+        masks = get_breakdown_masks(gt_annos, det_annos, self.range_bins, self.levels)
+
+        for e_ind, eval_type in enumerate(EVAL_TYPES):
+            eval_ious, iou_offsets = ious[eval_type]
+            # in case 2d bbox evaluation, we should consider dontcare bboxes
+            if eval_type == 'bbox_2d':
+                dc_args = (dc_ious, dc_iou_offsets, dc_offsets)
+            else:
+                dc_args = (no_dc_ious, no_dc_offsets, no_dc_offsets)
+            for cls in self.CLASSES:
+                min_iou = eval_ious.dtype.type(MIN_IOUS[cls][e_ind])
+                dc_min_iou = dc_ious.dtype.type(MIN_IOUS[cls][e_ind])
+                cls_gt_ignores, cls_det_ignores = get_ignores(gt_names, gt_difficulty, det_names, det_heights,
+                                                              cls, self.difficulty, MIN_HEIGHT[self.difficulty])
+                # the ignores of all breakdowns, matched in one pass over the frames
+                breakdown_ignores = [restrict_ignores(cls_gt_ignores, cls_det_ignores, *masks[breakdown])
+                                     for breakdown in self.breakdowns]
+                gt_ignores = np.stack([item[0] for item in breakdown_ignores])
+                det_ignores = np.stack([item[1] for item in breakdown_ignores])
+                tp_scores, num_tps = collect_tp_scores(eval_ious, iou_offsets, gt_offsets, det_offsets,
+                                                       gt_ignores, det_ignores, scores, min_iou)
+                event_scores, event_counts, event_aos, num_events = collect_events(
+                    eval_ious, iou_offsets, gt_offsets, det_offsets, gt_ignores, det_ignores, scores, aos_terms,
+                    *dc_args, min_iou, dc_min_iou, eval_type == 'bbox_2d')
+                for b, breakdown in enumerate(self.breakdowns):
+                    state = self.states[(eval_type, cls, breakdown)]
+                    state['tp_scores'].append(tp_scores[b, :num_tps[b]])
+                    state['tp_counts'].append(np.ones(num_tps[b], dtype=np.int64))
+                    state['num_valid_gt'] += np.sum(gt_ignores[b] == 0)
+                    self.add_events(state, (event_scores[b, :num_events[b]], event_counts[b, :num_events[b]],
+                                            event_aos[b, :num_events[b]]))
+
+    def add_events(self, state, events):
+        for key, value in zip(['event_scores', 'event_counts', 'event_aos'], events):
+            state[key].append(value)
+        self.compact(state)
+
+    def round_scores(self, scores):
+        if self.score_bins is None:
+            return scores
+        return np.floor(scores * self.score_bins) / self.score_bins
+
+    def compact(self, state):
+        '''
+        Merge the events and the tp scores of the same (rounded) score, so a state holds one entry
+        per distinct score.
+        '''
+        event_scores, inverse = np.unique(self.round_scores(np.concatenate(state['event_scores'])), return_inverse=True)
+        event_counts = np.zeros((len(event_scores), 3), dtype=np.int64)
+        np.add.at(event_counts, inverse, np.concatenate(state['event_counts']))
+        event_aos = np.zeros(len(event_scores))
+        np.add.at(event_aos, inverse, np.concatenate(state['event_aos']))
+        state['event_scores'], state['event_counts'], state['event_aos'] = [event_scores], [event_counts], [event_aos]
+        tp_scores, inverse = np.unique(self.round_scores(np.concatenate(state['tp_scores'])), return_inverse=True)
+        tp_counts = np.zeros(len(tp_scores), dtype=np.int64)
+        np.add.at(tp_counts, inverse, np.concatenate(state['tp_counts']))
+        state['tp_scores'], state['tp_counts'] = [tp_scores], [tp_counts]
+
+    def state_dict(self):
+        '''
+        return: the accumulated statistics, another evaluator adds them with merge()
+        '''
+        self.flush()
+        return {'frame_ids': self.frame_ids, 'states': self.states}
+
+    def merge(self, state_dict):
+        '''
+        Adds the statistics of the frames of another evaluator, e.g. of another rank, the results
+        are those of evaluating all the frames in one evaluator.
+        '''
+        self.flush()
+        assert len(self.frame_ids & state_dict['frame_ids']) == 0, 'a frame is in both evaluators'
+        self.frame_ids |= state_dict['frame_ids']
+        for key, other in state_dict['states'].items():
+            if len(other['event_scores']) == 0:
+                continue
+            state = self.states[key]
+            for item in ['tp_scores', 'tp_counts', 'event_scores', 'event_counts', 'event_aos']:
+                state[item] += other[item]
+            state['num_valid_gt'] += other['num_valid_gt']
+            self.compact(state)
+
+    def compute(self, breakdown='overall'):
+        '''
+        breakdown: one of self.breakdowns
+        return: ap_results: dict(eval_type -> dict(cls -> [AP])), aos_results: dict(cls -> [AOS]),
+                over the frames seen so far, restricted to the breakdown
+        '''
+        self.flush()
+        ap_results, aos_results = {eval_type: {} for eval_type in EVAL_TYPES}, {}
+        for eval_type in EVAL_TYPES:
+            for cls in self.CLASSES:
+                state = self.states[(eval_type, cls, breakdown)]
+                if len(state['event_scores']) == 0:
+                    ap_results[eval_type][cls] = [0.0]
+                    if eval_type == 'bbox_2d':
+                        aos_results[cls] = [0.0]
+                    continue
+                event_scores, event_counts, event_aos = \
+                    state['event_scores'][0], state['event_counts'][0], state['event_aos'][0]
+                tp_scores = np.repeat(state['tp_scores'][0], state['tp_counts'][0])
+                score_thresholds = np.array(get_score_thresholds(tp_scores, state['num_valid_gt']),
+                                            dtype=event_scores.dtype)
+
+                # the sums over the events with a score >= threshold, the events are in ascending score order
+                counts = np.concatenate([np.cumsum(event_counts[::-1], axis=0)[::-1], np.zeros((1, 3), dtype=np.int64)])
+                aos = np.concatenate([np.cumsum(event_aos[::-1])[::-1], [0.0]])
+                inds = np.searchsorted(event_scores, score_thresholds, side='left')
+                tps, fns, fps = counts[inds, 0], counts[inds, 1] + state['num_valid_gt'], counts[inds, 2]
+                if eval_type == 'bbox_2d':
+                    mAP, mSimilarity = compute_ap(tps, fns, fps, aos[inds])
+                    aos_results[cls] = [mSimilarity]
+                else:
+                    mAP = compute_ap(tps, fns, fps)
+                ap_results[eval_type][cls] = [mAP]
+        return ap_results, aos_results
@@ -1,3 +1,4 @@
+import json
 import numpy as np
 import os
 import pickle
@@ -21,11 +22,160 @@ def read_points(file_path, dim=4):
     if suffix == '.bin':
         return np.fromfile(file_path, dtype=np.float32).reshape(-1, dim)
     elif suffix == '.npy':
-        return np.load(file_path).astype(np.float32)
+        return np.load(file_path).astype(np.float32, copy=False)
     else:
         raise NotImplementedError
 
 
+class PointStore():
+    '''
+    Point clouds of a whole split packed column-major into one memory-mapped file.
+    path/points.npy: float32 (n_columns, n_points_total), frame i owns points offsets[i]:offsets[i+1]
+    path/index.npz: keys (n_frames, ) str, e.g. the velodyne_path of the info file; offsets (n_frames + 1, ) int64
+    '''
+    def __init__(self, path):
+        self.points = np.load(os.path.join(path, 'points.npy'), mmap_mode='r')
+        index = np.load(os.path.join(path, 'index.npz'))
+        self.offsets = index['offsets']
+        self.key_ids = {key: i for i, key in enumerate(index['keys'].tolist())}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __contains__(self, key):
+        return key in self.key_ids
+
+    def read(self, key, columns=slice(None)):
+        '''
+        key: str, frame key
+        columns: slice of the point features, e.g. slice(0, 5) for x, y, z, intensity, elongation
+        return: (n, n_selected_columns) read-only view into the memory map, no data is copied
+        '''
+        i = self.key_ids[key]
+        return self.points[columns, self.offsets[i]:self.offsets[i + 1]].T
+
+
+def write_point_store(path, keys, file_paths, dim):
+    '''
+    Packs the point cloud files into a PointStore at path.
+    keys: list of str, one per file
+    file_paths: list of .bin / .npy point cloud files
+    dim: number of point features
+    '''
+    counts = []
+    for file_path in file_paths:
+        if os.path.splitext(file_path)[1] == '.npy':
+            counts.append(np.load(file_path, mmap_mode='r').shape[0])
+        else:
+            counts.append(os.path.getsize(file_path) // (4 * dim))
+    offsets = np.zeros(len(file_paths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    os.makedirs(path, exist_ok=True)
+    points = np.lib.format.open_memmap(os.path.join(path, 'points.npy.tmp'), mode='w+',
+                                       dtype=np.float32, shape=(dim, int(offsets[-1])))
+    for i, file_path in enumerate(file_paths):
+        points[:, offsets[i]:offsets[i + 1]] = read_points(file_path, dim).T
+    points.flush()
+    del points
+    with open(os.path.join(path, 'index.npz.tmp'), 'wb') as f:
+        np.savez(f, keys=np.array(keys), offsets=offsets)
+    # the index is written last, a store is only complete once it exists
+    os.replace(os.path.join(path, 'points.npy.tmp'), os.path.join(path, 'points.npy'))
+    os.replace(os.path.join(path, 'index.npz.tmp'), os.path.join(path, 'index.npz'))
+
+
+# info dicts holding per-object arrays with a shared first dim, stored as tables like lists of dicts
+INFO_TABLES = ('annos', 'cam_sync_annos')
+
+
+def _concat_rows(parts):
+    # frames without objects may hold (0, ) float arrays even for string or (n, 3) columns
+    non_empty = [part for part in parts if len(part) > 0]
+    return np.concatenate(non_empty if non_empty else parts, axis=0)
+
+
+def _pack_info_node(values, name, columns):
+    first = values[0]
+    if isinstance(first, dict) and name.split('.')[-1] not in INFO_TABLES:
+        return {'type': 'dict', 'items': {k: _pack_info_node([v[k] for v in values], f'{name}.{k}' if name else k, columns)
+                                          for k in first}}
+    if isinstance(first, list):
+        keys = list(dict.fromkeys(k for v in values for row in v for k in row))
+        counts = [len(v) for v in values]
+        parts = {k: [np.stack([np.asarray(row[k]) for row in v]) for v in values if len(v) > 0] for k in keys}
+    elif isinstance(first, dict):
+        keys = list(first)
+        counts = [len(v[keys[0]]) for v in values]
+        parts = {k: [np.asarray(v[k]) for v in values] for k in keys}
+    else:
+        columns[name] = np.stack([np.asarray(v) for v in values])
+        return {'type': 'leaf', 'name': name}
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    columns[name + '.offsets'] = offsets
+    for k in keys:
+        columns[f'{name}.{k}'] = _concat_rows(parts[k])
+    return {'type': 'list' if isinstance(first, list) else 'table', 'name': name, 'keys': keys}
+
+
+class InfoStore():
+    '''
+    Read-only list of the info dicts of a split, stored column-wise with one memory-mapped .npy per
+    leaf so that all DataLoader workers share the same pages instead of each unpickling a copy.
+    Frame leaves (calib matrices, image_idx, velodyne_path, ...) are stacked, (n_frames, ...).
+    Lists of dicts (image.camera, sweeps) and the per-object arrays of INFO_TABLES are concatenated,
+    (n_rows, ...), <name>.offsets.npy (n_frames + 1, ) holds the rows of every frame.
+    path/schema.json describes how the columns nest into an info dict.
+    '''
+    def __init__(self, path):
+        with open(os.path.join(path, 'schema.json'), 'r') as f:
+            schema = json.load(f)
+        self.num_frames = schema['num_frames']
+        self.root = schema['root']
+        self.columns = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in schema['columns']}
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_frames
+        if not 0 <= index < self.num_frames:
+            raise IndexError(index)
+        return self._get_node(self.root, index)
+
+    def _get_leaf(self, name, row):
+        value = self.columns[name][row]
+        # scalars become python values, arrays are copied out of the memory map, they are a few KB per frame
+        return value.item() if value.ndim == 0 else np.array(value)
+
+    def _get_node(self, node, index):
+        if node['type'] == 'dict':
+            return {k: self._get_node(item, index) for k, item in node['items'].items()}
+        if node['type'] == 'leaf':
+            return self._get_leaf(node['name'], index)
+        start, end = self.columns[node['name'] + '.offsets'][index:index + 2]
+        if node['type'] == 'table':
+            return {k: np.array(self.columns[f"{node['name']}.{k}"][start:end]) for k in node['keys']}
+        return [{k: self._get_leaf(f"{node['name']}.{k}", row) for k in node['keys']} for row in range(start, end)]
+
+
+def write_info_store(data_infos, path):
+    '''
+    Writes the list of info dicts as an InfoStore at path.
+    '''
+    columns = {}
+    root = _pack_info_node(data_infos, '', columns)
+    os.makedirs(path, exist_ok=True)
+    for name, column in columns.items():
+        np.save(os.path.join(path, name + '.npy'), column)
+    # the schema is written last, a store is only complete once it exists
+    with open(os.path.join(path, 'schema.json.tmp'), 'w') as f:
+        json.dump(dict(num_frames=len(data_infos), root=root, columns=list(columns)), f)
+    os.replace(os.path.join(path, 'schema.json.tmp'), os.path.join(path, 'schema.json'))
+
+
 def write_points(lidar_points, file_path):
     suffix = os.path.splitext(file_path)[1] 
     assert suffix in ['.bin', '.ply']
@@ -4,7 +4,7 @@ import numpy as np
 import random
 import torch
 import pdb
-from ops.iou3d_module import boxes_overlap_bev, boxes_iou_bev
+from ops.iou3d_module import boxes_overlap_bev, boxes_iou_bev, boxes_overlap_bev_aligned, boxes_iou_bev_aligned
 
 
 def setup_seed(seed=0, deterministic = True):
@@ -397,12 +397,13 @@ def remove_pts_in_bboxes(points, bboxes, rm=True):
 # modified from https://github.com/open-mmlab/mmdetection3d/blob/master/mmdet3d/core/bbox/structures/utils.py#L11
 def limit_period(val, offset=0.5, period=np.pi):
     """
-    val: array or float
+    val: array, tensor or float
     offset: float
     period: float
     return: Value in the range of [-offset * period, (1-offset) * period]
     """
-    limited_val = val - np.floor(val / period + offset) * period
+    floor = torch.floor if isinstance(val, torch.Tensor) else np.floor
+    limited_val = val - floor(val / period + offset) * period
     return limited_val
 
 
@@ -452,6 +453,33 @@ def iou2d(bboxes1, bboxes2, metric=0):
     return iou
 
 
+def iou2d_aligned(bboxes1, bboxes2, metric=0):
+    '''
+    bboxes1: (n, 4), (x1, y1, x2, y2)
+    bboxes2: (n, 4), (x1, y1, x2, y2)
+    return: (n, ), iou of bboxes1[i] and bboxes2[i], the same values as iou2d
+    '''
+    bboxes_x1 = torch.maximum(bboxes1[:, 0], bboxes2[:, 0]) # (n, )
+    bboxes_y1 = torch.maximum(bboxes1[:, 1], bboxes2[:, 1]) # (n, )
+    bboxes_x2 = torch.minimum(bboxes1[:, 2], bboxes2[:, 2])
+    bboxes_y2 = torch.minimum(bboxes1[:, 3], bboxes2[:, 3])
+
+    bboxes_w = torch.clamp(bboxes_x2 - bboxes_x1, min=0)
+    bboxes_h = torch.clamp(bboxes_y2 - bboxes_y1, min=0)
+
+    iou_area = bboxes_w * bboxes_h # (n, )
+    
+    bboxes1_wh = bboxes1[:, 2:] - bboxes1[:, :2]
+    area1 = bboxes1_wh[:, 0] * bboxes1_wh[:, 1] # (n, )
+    bboxes2_wh = bboxes2[:, 2:] - bboxes2[:, :2]
+    area2 = bboxes2_wh[:, 0] * bboxes2_wh[:, 1] # (n, )
+    if metric == 0:
+        iou = iou_area / (area1 + area2 - iou_area + 1e-8)
+    elif metric == 1:
+        iou = iou_area / (area1 + 1e-8)
+    return iou
+
+
 def iou2d_nearest(bboxes1, bboxes2):
     '''
     bboxes1: (n, 7), (x, y, z, w, l, h, theta)
@@ -536,6 +564,40 @@ def iou3d_camera(bboxes1, bboxes2):
     return iou
 
 
+def iou3d_camera_aligned(bboxes1, bboxes2):
+    '''
+    bboxes1: (n, 7), (x, y, z, w, l, h, theta)
+    bboxes2: (n, 7)
+    return: (n, ), iou of bboxes1[i] and bboxes2[i], the same values as iou3d_camera
+    '''
+    # 1. height overlap
+    bboxes1_bottom, bboxes2_bottom = bboxes1[:, 1] - bboxes1[:, 4], bboxes2[:, 1] -  bboxes2[:, 4] # (n, ), (n, )
+    bboxes1_top, bboxes2_top = bboxes1[:, 1], bboxes2[:, 1] # (n, ), (n, )
+    bboxes_bottom = torch.maximum(bboxes1_bottom, bboxes2_bottom) # (n, )
+    bboxes_top = torch.minimum(bboxes1_top, bboxes2_top)
+    height_overlap =  torch.clamp(bboxes_top - bboxes_bottom, min=0)
+
+    # 2. bev overlap
+    bboxes1_x1y1 = bboxes1[:, [0, 2]] - bboxes1[:, [3, 5]] / 2
+    bboxes1_x2y2 = bboxes1[:, [0, 2]] + bboxes1[:, [3, 5]] / 2
+    bboxes2_x1y1 = bboxes2[:, [0, 2]] - bboxes2[:, [3, 5]] / 2
+    bboxes2_x2y2 = bboxes2[:, [0, 2]] + bboxes2[:, [3, 5]] / 2
+    bboxes1_bev = torch.cat([bboxes1_x1y1, bboxes1_x2y2, bboxes1[:, 6:]], dim=-1)
+    bboxes2_bev = torch.cat([bboxes2_x1y1, bboxes2_x2y2, bboxes2[:, 6:]], dim=-1)
+    bev_overlap = boxes_overlap_bev_aligned(bboxes1_bev, bboxes2_bev) # (n, )
+
+    # 3. overlap and volume
+    overlap = height_overlap * bev_overlap
+    volume1 = bboxes1[:, 3] * bboxes1[:, 4] * bboxes1[:, 5]
+    volume2 = bboxes2[:, 3] * bboxes2[:, 4] * bboxes2[:, 5]
+    volume = volume1 + volume2 # (n, )
+
+    # 4. iou
+    iou = overlap / (volume - overlap + 1e-8)
+
+    return iou
+
+
 def iou_bev(bboxes1, bboxes2):
     '''
     bboxes1: (n, 5), (x, z, w, h, theta)
@@ -553,6 +615,23 @@ def iou_bev(bboxes1, bboxes2):
     return bev_overlap
 
 
+def iou_bev_aligned(bboxes1, bboxes2):
+    '''
+    bboxes1: (n, 5), (x, z, w, h, theta)
+    bboxes2: (n, 5)
+    return: (n, ), iou of bboxes1[i] and bboxes2[i], the same values as iou_bev
+    '''
+    bboxes1_x1y1 = bboxes1[:, :2] - bboxes1[:, 2:4] / 2
+    bboxes1_x2y2 = bboxes1[:, :2] + bboxes1[:, 2:4] / 2
+    bboxes2_x1y1 = bboxes2[:, :2] - bboxes2[:, 2:4] / 2
+    bboxes2_x2y2 = bboxes2[:, :2] + bboxes2[:, 2:4] / 2
+    bboxes1_bev = torch.cat([bboxes1_x1y1, bboxes1_x2y2, bboxes1[:, 4:]], dim=-1)
+    bboxes2_bev = torch.cat([bboxes2_x1y1, bboxes2_x2y2, bboxes2[:, 4:]], dim=-1)
+    bev_overlap = boxes_iou_bev_aligned(bboxes1_bev, bboxes2_bev) # (n, )
+
+    return bev_overlap
+
+
 def keep_bbox_from_image_range(result, calib_info, num_images, image_info, cam_sync=False):
     r0_rect = calib_info['R0_rect']
     lidar_bboxes = result['lidar_bboxes']